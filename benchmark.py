@@ -0,0 +1,769 @@
+"""
+Benchmarks for reading and processing data files.
+
+Synthetic data in the same format as the files collected by the app is generated
+into a temporary folder, so that no real data is needed.
+
+Every benchmark also checks that the new code gives the same results as the old one, and the
+k-way merge of chunk files is checked against a simple merge on random chunks, see check_chunk_merge.
+The exit status is 1 if any of the checks fails.
+
+Usage:
+    python benchmark.py [-n rows=1000000]
+"""
+
+import argparse
+import contextlib
+import datetime
+import gzip
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import chunk_merge
+import file_process
+import resample
+import sensor_cache
+import smoothing
+import unzip
+import utils
+import views
+import writer
+
+
+def write_raw_sensor_file(filename, num_rows, sensor='acc', incomplete_tail=True):
+    """
+    Write a synthetic raw motion sensor file, e.g. 'raw_acc.txt', sampled at 200 Hz.
+
+    Parameters
+    ----------
+    filename : str
+        The path of the file to be written
+
+    num_rows : int
+        The number of complete data lines
+
+    sensor : str, default='acc'
+        The sensor name used in the header
+
+    incomplete_tail : boolean, default=True
+        If True, append a truncated line at the end, as the app sometimes does.
+    """
+    rng = np.random.default_rng(0)
+    sys_time = 1508813124141 + np.arange(num_rows, dtype=np.int64) * 5
+    xyz = rng.normal(0.0, 3.0, size=(num_rows, 3))
+    with open(filename, 'w') as fp:
+        fp.write('"timestamp","sys_time","abs_timestamp","raw_x_%s","raw_y_%s","raw_z_%s"\n' % (sensor, sensor, sensor))
+        for i in range(num_rows):
+            fp.write('"%.1f","%d","%d","%.7g","%.7g","%.7g"\n' % (i * 5.0, sys_time[i], sys_time[i] * 1000 + 7,
+                                                                  xyz[i, 0], xyz[i, 1], xyz[i, 2]))
+        if incomplete_tail:
+            fp.write('"%.1f","%d","24427' % (num_rows * 5.0, sys_time[-1] + 5))
+
+
+def write_gps_file(filename, num_rows):
+    """
+    Write a synthetic 'gps.txt', sampled at 1 Hz.
+    """
+    rng = np.random.default_rng(0)
+    system_time = 1508813134944 + np.arange(num_rows, dtype=np.int64) * 1000
+    speed = np.abs(rng.normal(10.0, 5.0, size=num_rows))
+    with open(filename, 'w') as fp:
+        fp.write('"timestamp","system_time","lat","lon","speed","bearing","provider"\n')
+        for i in range(num_rows):
+            fp.write('"%d","%d","43.00384848113872","-78.78813112418695","%.7g","0.0","gps"\n'
+                     % (system_time[i] + 7000, system_time[i], speed[i]))
+
+
+def legacy_read_csv_file(filename, columns=None, with_header=True):
+    """
+    The cell by cell reader that utils.read_csv_file used to be, kept as the baseline.
+    """
+    data_type = filename.split(os.sep)[-1]
+    is_gps = data_type.startswith('gps')
+
+    with open(filename, 'r') as f:
+        if with_header:
+            header = f.readline()
+            header = header.replace('"', '').strip()
+            col_names = [name.lower() for name in header.split(',')]
+
+        result = []
+        num_columns = None
+        selected_cols = []
+        for line in f:
+            line = line.replace('"', '').strip()
+            elements = line.split(',')
+
+            if not num_columns:
+                num_columns = len(elements)
+                if columns:
+                    if type(columns[0]) is int:
+                        selected_cols = columns
+                    elif type(columns[0]) is str:
+                        selected_cols = [col_names.index(col.lower()) for col in columns]
+                else:
+                    selected_cols = [i for i in range(num_columns)]
+            elif num_columns != len(elements):
+                break
+
+            if is_gps and elements[-1] == 'network':
+                continue
+
+            cur_row = []
+            for col_index in selected_cols:
+                value = elements[col_index]
+                if '.' in value:
+                    value = float(value)
+                elif utils.is_int(value):
+                    value = int(value)
+                cur_row.append(value)
+
+            result.append(cur_row)
+
+        return np.array(result)
+
+
+# the number of checks failed, see error
+num_errors = 0
+
+
+def error(message):
+    """
+    Report a check that failed, i.e. the results differ.
+    """
+    global num_errors
+    num_errors += 1
+    print("ERROR: " + message)
+
+
+def time_it(func, *args, **kwargs):
+    """
+    Call the function once and return its result and the elapsed seconds.
+    """
+    begin = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - begin
+
+
+def report(name, num_rows, seconds):
+    print("%-40s %8.3f s %14.0f rows/s" % (name, seconds, num_rows / seconds))
+
+
+def bench_read_csv_file(folder, num_rows):
+    """
+    Compare utils.read_csv_file with the cell by cell reader on a raw acc file.
+    """
+    acc_file = os.path.join(folder, 'raw_acc.txt')
+    write_raw_sensor_file(acc_file, num_rows)
+
+    expected, seconds = time_it(legacy_read_csv_file, acc_file, columns=[1, 3, 4, 5])
+    report("read_csv_file (cell by cell)", num_rows, seconds)
+
+    result, seconds = time_it(utils.read_csv_file, acc_file, columns=[1, 3, 4, 5])
+    report("read_csv_file (columnar)", num_rows, seconds)
+
+    if expected.dtype != result.dtype or not np.array_equal(expected, result):
+        error("read_csv_file results differ")
+
+
+def bench_sensor_cache(folder, num_rows):
+    """
+    Compare parsing a raw acc file with loading its binary copy.
+    """
+    acc_file = os.path.join(folder, 'raw_acc.txt')
+    if not os.path.isfile(acc_file):
+        write_raw_sensor_file(acc_file, num_rows)
+    sensor_cache.remove_cache(folder)
+
+    _, seconds = time_it(utils.read_csv_table, acc_file)
+    report("read_csv_table (parse and cache)", num_rows, seconds)
+
+    _, seconds = time_it(utils.read_csv_table, acc_file)
+    report("read_csv_table (cached)", num_rows, seconds)
+
+
+def bench_time_bounds(folder, num_rows):
+    """
+    Compare probing the time bounds of a raw acc file with reading the whole time column.
+    """
+    acc_file = os.path.join(folder, 'raw_acc.txt')
+    if not os.path.isfile(acc_file):
+        write_raw_sensor_file(acc_file, num_rows)
+
+    _, seconds = time_it(utils.read_csv_frame, acc_file, usecols=['sys_time'], dtype={'sys_time': np.int64})
+    report("time bounds (read_csv_frame)", num_rows, seconds)
+
+    _, seconds = time_it(utils.read_time_bounds, acc_file, 'sys_time')
+    report("time bounds (read_time_bounds)", num_rows, seconds)
+
+
+def legacy_get_speed_gps(gps_file, sys_time):
+    """
+    The way utils.get_speed_gps used to be, i.e. read and convert the whole file for each lookup.
+    """
+    time_speed = utils.read_csv_file(gps_file, columns=[1, 4])
+    time_speed = [(utils.timestamp_2_datetime(int(ts[0])), float(ts[1]) * 3.6) for ts in time_speed]
+    sys_time = utils.timestamp_2_datetime(sys_time) - datetime.timedelta(seconds=1)
+    return utils.average_speed(time_speed, sys_time, sys_time)
+
+
+def bench_speed_lookup(folder, num_rows, num_lookups=100):
+    """
+    Compare looking up speeds through the speed index of the trip with reading the gps file for each lookup.
+    """
+    gps_folder = os.path.join(folder, 'speed')
+    os.mkdir(gps_folder)
+    gps_file = os.path.join(gps_folder, 'gps.txt')
+    num_gps_rows = max(num_rows // 200, 10)  # 1 Hz instead of 200 Hz
+    write_gps_file(gps_file, num_gps_rows)
+    timestamps = np.linspace(1508813134944, 1508813134944 + num_gps_rows * 1000, num_lookups).astype(np.int64)
+
+    expected, seconds = time_it(lambda: [legacy_get_speed_gps(gps_file, t) for t in timestamps])
+    report("speed lookup (read file each time)", num_lookups, seconds)
+
+    result, seconds = time_it(lambda: [utils.get_speed_gps(gps_file, int(t)) for t in timestamps])
+    report("speed lookup (speed index)", num_lookups, seconds)
+
+    if not np.allclose(expected, result):
+        error("speed lookup results differ")
+
+    result, seconds = time_it(utils.get_average_speeds, gps_folder, np.column_stack((timestamps, timestamps)) - 1000)
+    report("speed lookup (batch)", num_lookups, seconds)
+
+    if not np.allclose(expected, result):
+        error("batch speed lookup results differ")
+
+
+def bench_timestamps_2_str(folder, num_rows):
+    """
+    Compare formatting time stamps through datetime objects one by one with formatting them as an array.
+    """
+    timestamps = 1508813124141 + np.arange(num_rows, dtype=np.int64) * 5
+
+    expected, seconds = time_it(lambda: [utils.timestamp_2_datetime(t).strftime("%Y-%m-%d-%H-%M-%S-%f")
+                                         for t in timestamps])
+    report("format time (datetime objects)", num_rows, seconds)
+
+    result, seconds = time_it(utils.timestamps_2_str, timestamps)
+    report("format time (int64 array)", num_rows, seconds)
+
+    if not np.array_equal(expected, result):
+        error("formatted times differ")
+
+
+def bench_resample(folder, num_rows):
+    """
+    Compare interpolating column by column from python lists with the shared resampling kernel.
+    """
+    rng = np.random.default_rng(0)
+    time_old = 1508813124141 + np.cumsum(rng.integers(1, 10, size=num_rows)).astype(np.float64)
+    raw_data = np.column_stack([time_old, time_old, time_old * 1000, rng.normal(size=(num_rows, 3))])
+    time_new = resample.time_grid(int(time_old[0]), int(time_old[-1]), 200)
+
+    def per_column():
+        resampled_data = np.zeros((len(time_new), raw_data.shape[1]))
+        old = raw_data[:, 1].tolist()
+        for col in range(raw_data.shape[1]):
+            resampled_data[:, col] = np.interp(time_new, old, raw_data[:, col].tolist())
+        return resampled_data
+
+    expected, seconds = time_it(per_column)
+    report("resample (column by column)", num_rows, seconds)
+
+    result, seconds = time_it(resample.resample_columns, raw_data[:, 1], raw_data, time_new)
+    report("resample (shared positions)", num_rows, seconds)
+
+    if not np.array_equal(expected, result):
+        error("resampled data differ")
+
+
+def legacy_moving_average_same_size(data, windows_size):
+    """
+    The way utils.moving_average_same_size used to be, i.e. one row at a time.
+    """
+    result = []
+    for i in range(windows_size):
+        result.append(np.average(data[: i + 1], axis=0))
+    pre_sum = np.sum(data[:windows_size, :], axis=0)
+    for i in range(windows_size, len(data)):
+        pre_sum -= data[i - windows_size, :]
+        pre_sum += data[i, :]
+        result.append(pre_sum / windows_size)
+    return np.array(result)
+
+
+def bench_smoothing(folder, num_rows, window_size=50):
+    """
+    Compare the row by row moving average with the cumulative sums, and time the other filters
+    on the same columns.
+    """
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(num_rows, 3))
+
+    expected, seconds = time_it(legacy_moving_average_same_size, data.copy(), window_size)
+    report("moving average (row by row)", num_rows, seconds)
+
+    result, seconds = time_it(utils.moving_average_same_size, data, window_size)
+    report("moving average (cumulative sums)", num_rows, seconds)
+
+    if not np.allclose(expected, result, rtol=0, atol=1e-9):
+        error("moving averages differ")
+
+    columns = [data[:, i] for i in range(data.shape[1])]
+    for filter_type in smoothing.FILTERS:
+        smoother = smoothing.make_filter(filter_type, window_size, [6] * len(columns), 200)
+        _, seconds = time_it(smoother.apply, columns)
+        report("smoothing (%s)" % filter_type, num_rows, seconds)
+
+
+def bench_writer(folder, num_rows):
+    """
+    Compare writing a resampled motion sensor table through Series.map and DataFrame.to_csv
+    with the vectorized CSV writer.
+    """
+    rng = np.random.default_rng(0)
+    time_new = np.linspace(1508813124141, 1508813124141 + num_rows * 5, num_rows)
+    data = [time_new, time_new, time_new * 1000] + list(rng.normal(0.0, 3.0, size=(3, num_rows)))
+    columns = ['timestamp', 'sys_time', 'abs_timestamp', 'raw_x_acc', 'raw_y_acc', 'raw_z_acc']
+    formats = [writer.INT] * 3 + [6] * 3
+
+    def to_csv(filename):
+        df = pd.DataFrame(dict(zip(columns, data)))
+        for i in range(0, 3):
+            df[df.columns[i]] = df[df.columns[i]].astype(int)
+        for i in range(3, 6):
+            df[df.columns[i]] = df[df.columns[i]].map('{:.6f}'.format)
+        df.to_csv(filename, index=False)
+
+    expected_file = os.path.join(folder, 'to_csv.txt')
+    _, seconds = time_it(to_csv, expected_file)
+    report("write csv (map and to_csv)", num_rows, seconds)
+
+    result_file, seconds = time_it(writer.write_table, folder, 'writer', columns, data, formats)
+    report("write csv (writer)", num_rows, seconds)
+
+    _, seconds = time_it(writer.write_table, folder, 'writer', columns, data, formats, 'npy')
+    report("write npy (writer)", num_rows, seconds)
+
+    with open(expected_file, 'rb') as expected, open(result_file, 'rb') as result:
+        if expected.read() != result.read():
+            error("written csv files differ")
+
+
+def bench_streaming(folder, num_rows):
+    """
+    Compare the peak memory of resampling and smoothing a motion sensor file in one chunk
+    with that of streaming it in chunks. The results should be exactly the same.
+    """
+    sensor_file = os.path.join(folder, 'raw_acc.txt')
+    write_raw_sensor_file(sensor_file, num_rows)
+    utils.read_csv_table(sensor_file)  # the binary copy is memory-mapped by both
+    start_time, end_time = utils.read_time_bounds(sensor_file, 'sys_time')
+    debug, file_process.debug = file_process.debug, False
+
+    def process(chunk_size):
+        resample.CHUNK_SIZE = chunk_size
+        tracemalloc.start()
+        try:
+            file_process.process_motion_sensor_data(sensor_file, folder, start_time, end_time, 200, 50, 'acc')
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    default_chunk_size = resample.CHUNK_SIZE
+    results = {}
+    try:
+        for name, chunk_size in [('one chunk', 10 ** 12), ('streaming', default_chunk_size)]:
+            peak, seconds = time_it(process, chunk_size)
+            report("resample+smooth (%s, %.1f MB)" % (name, peak / 1e6), num_rows, seconds)
+            with open(os.path.join(folder, 'smoothed_acc.txt'), 'rb') as fp:
+                results[name] = fp.read()
+    finally:
+        resample.CHUNK_SIZE = default_chunk_size
+        file_process.debug = debug
+
+    if results['one chunk'] != results['streaming']:
+        error("streamed files differ")
+
+
+def bench_views(folder, num_rows):
+    """
+    Compare resampling and smoothing a whole motion sensor file with computing a 10 seconds view
+    of it. The view should be the same rows of the smoothed file.
+    """
+    sensor_file = os.path.join(folder, 'raw_acc.txt')
+    write_raw_sensor_file(sensor_file, num_rows)
+    utils.read_csv_table(sensor_file)
+    # the time range of the trip, see file_process.get_time_bounds
+    start_time, end_time = utils.read_time_bounds(sensor_file, 'sys_time', skip_last=True)
+    debug, file_process.debug = file_process.debug, False
+    try:
+        resampled = file_process.resample_motion_sensor_data(sensor_file, start_time, end_time, 200)
+        smooth = file_process.sensor_smoother(resampled, 50, 200)
+        chunks, seconds = time_it(lambda: [smooth(data) for data in resampled.chunks])
+        report("resample+smooth (whole trip)", num_rows, seconds)
+
+        middle = (start_time + end_time) // 2
+        view, seconds = time_it(views.smoothed_view, folder, 'acc', middle, middle + 10000, 200, 50)
+        report("resample+smooth (10 s view)", num_rows, seconds)
+    finally:
+        file_process.debug = debug
+
+    # the time grid of the trip, see views.grid_rows
+    begin = resample.grid_searchsorted(start_time, end_time, resampled.num_rows, middle)
+    expected = writer.to_table(resampled.columns, [np.concatenate(cols)[begin: begin + len(view)]
+                                                   for cols in zip(*chunks)], resampled.formats)
+    if not np.array_equal(expected, view):
+        error("view differs")
+
+
+def legacy_unzip_file(fil, compress_type):
+    """
+    The way unzip.unzip_file used to decompress, i.e. all lines of the file at once.
+    """
+    data_lines = gzip.open(fil).readlines()
+    with open(fil[:-len(compress_type)], "wb") as fp:
+        fp.writelines(data_lines)
+
+
+def bench_unzip(folder, num_rows):
+    """
+    Compare the peak memory of decompressing a chunk as a list of lines with streaming it block by block.
+    The results should be exactly the same.
+    """
+    sensor_file = os.path.join(folder, 'raw_acc.txt')
+    write_raw_sensor_file(sensor_file, num_rows)
+    zip_file = sensor_file + '.zip'
+    with open(sensor_file, 'rb') as fp, gzip.open(zip_file, 'wb') as zp:
+        shutil.copyfileobj(fp, zp)
+
+    def peak(func, *args):
+        tracemalloc.start()
+        try:
+            func(*args)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    debug, unzip.debug = unzip.debug, False
+    results = {}
+    try:
+        for name, func, args in [('lines', legacy_unzip_file, (zip_file, '.zip')),
+                                 ('streaming', unzip.unzip_file, (zip_file, 'False', '.zip'))]:
+            memory, seconds = time_it(peak, func, *args)
+            report("unzip (%s, %.1f MB)" % (name, memory / 1e6), num_rows, seconds)
+            with open(sensor_file, 'rb') as fp:
+                results[name] = fp.read()
+    finally:
+        unzip.debug = debug
+
+    if results['lines'] != results['streaming']:
+        error("unzipped files differ")
+
+
+def write_chunks(folder, sensor_file, num_chunks):
+    """
+    Split the given data file into compressed chunks in the given folder, e.g. 'raw_acc1.txt.zip',
+    each with the header, as uploaded by the app.
+    """
+    with open(sensor_file, 'rb') as fp:
+        header = fp.readline()
+        lines = fp.readlines()
+    name = os.path.basename(sensor_file)[:-len('.txt')]
+    size = len(lines) // num_chunks + 1
+    for i in range(num_chunks):
+        with gzip.open(os.path.join(folder, '%s%d.txt.zip' % (name, i + 1)), 'wb') as zp:
+            zp.write(header)
+            zp.writelines(lines[i * size: (i + 1) * size])
+
+
+def bench_unzip_merge(folder, num_rows, num_chunks=50):
+    """
+    Compare decompressing chunks into their own files and merging them with decompressing them
+    directly into the merged file. The merged files should be the same.
+    """
+    sensor_file = os.path.join(folder, 'raw_acc.txt')
+    write_raw_sensor_file(sensor_file, num_rows)
+    trip = os.path.join(folder, 'chunks')
+    os.mkdir(trip)
+    write_chunks(trip, sensor_file, num_chunks)
+    compressed_files = [os.path.join(trip, f) for f in os.listdir(trip)]
+
+    def unzip_then_merge():
+        for fil in compressed_files:
+            unzip.unzip_file(fil, 'False', '.zip')
+        unzip.merge_single_directory(trip, 'True')
+
+    debug, unzip.debug = unzip.debug, False
+    results = {}
+    try:
+        for name, func, args in [('then merge', unzip_then_merge, ()),
+                                 ('fused', unzip.unzip_merge_directory, (trip, compressed_files, 'False', '.zip'))]:
+            _, seconds = time_it(func, *args)
+            report("unzip %d chunks (%s)" % (num_chunks, name), num_rows, seconds)
+            with open(os.path.join(trip, 'raw_acc.txt'), 'rb') as fp:
+                results[name] = fp.readlines()
+    finally:
+        unzip.debug = debug
+
+    if results['then merge'] != results['fused']:
+        error("merged files differ")
+
+
+def legacy_merge_files(files, merged_file):
+    """
+    The way unzip.merge_single_directory used to merge, i.e. all lines of the files concatenated in memory,
+    without its check of the order, which only compared the first bytes of the lines.
+    """
+    all_lines = []
+    for f in files:
+        with open(f, 'rb') as fp:
+            all_lines.extend(fp.readlines())
+    with open(merged_file, 'wb') as fp:
+        fp.writelines(all_lines)
+
+
+def bench_chunk_merge(folder, num_rows, num_chunks=50):
+    """
+    Compare concatenating the chunks of a sensor with merging them by time, when the chunks are
+    in order, and when every line is in a different chunk from the line before, i.e. the worst case.
+    The merged files should have the lines of the data file, ordered by time.
+    """
+    sensor_file = os.path.join(folder, 'raw_acc.txt')
+    write_raw_sensor_file(sensor_file, num_rows)
+    with open(sensor_file, 'rb') as fp:
+        header = fp.readline()
+        lines = fp.readlines()
+    if not lines[-1].endswith(b'\n'):
+        lines[-1] += b'\n'
+
+    size = len(lines) // num_chunks + 1
+    layouts = [('in order', [lines[i * size: (i + 1) * size] for i in range(num_chunks)]),
+               ('interleaved', [lines[i::num_chunks] for i in range(num_chunks)])]
+    merged_file = os.path.join(folder, 'merged.txt')
+    debug, unzip.debug = unzip.debug, False
+    try:
+        for name, chunks in layouts:
+            files = []
+            for i, chunk in enumerate(chunks):
+                files.append(os.path.join(folder, 'raw_acc%d.txt' % (i + 1)))
+                with open(files[-1], 'wb') as fp:
+                    fp.write(header)
+                    fp.writelines(chunk)
+
+            if name == 'in order':
+                _, seconds = time_it(legacy_merge_files, files, merged_file)
+                report("merge %d chunks (concatenated)" % num_chunks, num_rows, seconds)
+            merge_report, seconds = time_it(unzip.merge_files, files, merged_file, lambda fil: open(fil, 'rb'))
+            report("merge %d chunks (by time, %s, %d switches)" % (num_chunks, name, merge_report.switches),
+                   num_rows, seconds)
+            with open(merged_file, 'rb') as fp:
+                if fp.readlines() != [header] + lines:
+                    error("merged file differs")
+            for f in files:
+                os.remove(f)
+    finally:
+        unzip.debug = debug
+
+
+def random_chunks(rng, has_header):
+    """
+    Random chunks of a raw sensor file, whose times overlap and may repeat, including chunks
+    that are empty or have only the header, lines that go back in time within a chunk, lines
+    whose time cannot be parsed, empty lines, and an incomplete last line.
+
+    Returns
+    -------
+    chunks : list[bytes]
+        The content of each chunk
+    """
+    header = b'timestamp,sys_time,abs_timestamp,raw_x_acc\n'
+    chunks = []
+    for c in range(rng.randint(1, 6)):
+        kind = rng.random()
+        if kind < 0.1:
+            chunks.append(b'')
+            continue
+        if kind < 0.2:
+            chunks.append(header if has_header else b'')
+            continue
+
+        start = 1508813124000 + rng.randint(0, 200)
+        times = sorted(start + rng.randint(0, 300) for _ in range(rng.randint(1, 40)))
+        if rng.random() < 0.3:
+            # lines that go back in time
+            for _ in range(rng.randint(1, 3)):
+                i, j = rng.randrange(len(times)), rng.randrange(len(times))
+                times[i], times[j] = times[j], times[i]
+        lines = []
+        for i, t in enumerate(times):
+            # the chunk and the line, so that every line is unique
+            line = '"%d","%d","%d","%d.5"\n' % (c * 1000 + i, t, t * 1000, i)
+            if i and rng.random() < 0.05:
+                line = '"%d","n/a","","0.5"\n' % (c * 1000 + i)
+            elif rng.random() < 0.05:
+                line = line.replace('"', '')
+            lines.append(line.encode())
+            if i and rng.random() < 0.03:
+                lines.append(b'\n')
+        data = b''.join(lines)
+        if rng.random() < 0.2:
+            # cut within the last line, after its time
+            data = data[:len(data) - rng.randint(2, 8)]
+        chunks.append((header if has_header else b'') + data)
+    return chunks
+
+
+def reference_merge(chunks):
+    """
+    Merge the chunks line by line, always taking the line whose time is the earliest among the next
+    line of each chunk, and the first chunk of those of the same time, i.e. what chunk_merge.merge_chunks
+    does, without the heap and the blocks.
+
+    Returns
+    -------
+    (lines, num_inversions) : (list[bytes], int)
+        The lines merged, with the header, and the number of lines that go back in time within their chunk
+    """
+    header = None
+    queues = []
+    for chunk in chunks:
+        lines = io.BytesIO(chunk).readlines()
+        if lines and chunk_merge.parse_time(lines[0], 1) is None:
+            header = header or lines[0]
+            lines = lines[1:]
+        # lines whose time cannot be parsed go with the line before
+        time = -1
+        queue = []
+        for line in lines:
+            if line.strip():
+                parsed = chunk_merge.parse_time(line, 1)
+                time = parsed if parsed is not None else time
+                queue.append((time, line if line.endswith(b'\n') else line + b'\n'))
+        queues.append(queue)
+
+    merged = [header] if header else []
+    num_inversions = 0
+    last_times = [-1] * len(queues)
+    positions = [0] * len(queues)
+    while True:
+        heads = [(queue[positions[i]][0], i) for i, queue in enumerate(queues) if positions[i] < len(queue)]
+        if not heads:
+            break
+        time, i = min(heads)
+        merged.append(queues[i][positions[i]][1])
+        positions[i] += 1
+        if time < last_times[i]:
+            num_inversions += 1
+        last_times[i] = time
+    return merged, num_inversions
+
+
+def check_chunk_merge(folder, num_cases=200, seed=0):
+    """
+    Check chunk_merge.merge_chunks against reference_merge on random chunks (see random_chunks),
+    read in small blocks so that the lines cross the blocks, plain or compressed, and with a
+    compressed chunk that is cut short, whose lines after the cut are lost.
+    """
+    rng = random.Random(seed)
+    block_size = chunk_merge.BLOCK_SIZE
+    num_failed = 0
+    try:
+        for case in range(num_cases):
+            chunk_merge.BLOCK_SIZE = rng.choice([16, 64, 256, 4096])
+            chunks = random_chunks(rng, rng.random() < 0.8)
+            compressed = rng.random() < 0.5
+            files = []
+            for i, chunk in enumerate(chunks):
+                files.append(os.path.join(folder, 'raw_acc%d.txt' % (i + 1)))
+                with (gzip.open(files[-1], 'wb') if compressed else open(files[-1], 'wb')) as fp:
+                    fp.write(chunk)
+
+            # a compressed chunk cut short, which is merged up to the cut
+            cut = None
+            if compressed and rng.random() < 0.2:
+                cut = rng.randrange(len(files))
+                with open(files[cut], 'rb') as fp:
+                    data = fp.read()
+                with open(files[cut], 'wb') as fp:
+                    fp.write(data[:len(data) // 2])
+
+            fp = io.BytesIO()
+            with contextlib.redirect_stdout(io.StringIO()):
+                merge_report = chunk_merge.merge_chunks(
+                    files, fp, (lambda f: gzip.open(f, 'rb')) if compressed else (lambda f: open(f, 'rb')))
+            merged = fp.getvalue().splitlines(True)
+            expected, num_inversions = reference_merge(chunks)
+            num_lines = len(expected) - (1 if expected and chunk_merge.parse_time(expected[0], 1) is None else 0)
+
+            if cut is None:
+                passed = (merged == expected and merge_report.num_lines == num_lines
+                          and len(merge_report.inversions) == num_inversions and not merge_report.failed)
+            else:
+                # the other chunks are merged as if it was not there, and its lines up to the cut are kept in order
+                others, _ = reference_merge(chunks[:cut] + chunks[cut + 1:])
+                cut_lines = reference_merge([chunks[cut]])[0]
+                kept = [line for line in merged if line not in cut_lines or line in others]
+                lost = [line for line in merged if line in cut_lines and line not in others]
+                passed = (merge_report.failed == [files[cut]] and kept == others
+                          and lost == [line for line in cut_lines if line in lost])
+            if not passed:
+                num_failed += 1
+                if num_failed <= 3:
+                    print("merge of case %d (block size %d, %s) differs"
+                          % (case, chunk_merge.BLOCK_SIZE, 'compressed' if compressed else 'plain'))
+            for f in files:
+                os.remove(f)
+    finally:
+        chunk_merge.BLOCK_SIZE = block_size
+
+    print("%-40s %d cases, %d failed" % ("check chunk merge", num_cases, num_failed))
+    if num_failed:
+        error("merged chunks differ from the reference")
+
+
+def main(num_rows):
+    """
+    Run all the benchmarks.
+
+    Returns
+    -------
+    num_errors : int
+        The number of checks failed
+    """
+    folder = tempfile.mkdtemp(prefix='vehsense_benchmark_')
+    try:
+        check_chunk_merge(folder)
+        bench_read_csv_file(folder, num_rows)
+        bench_sensor_cache(folder, num_rows)
+        bench_time_bounds(folder, num_rows)
+        bench_speed_lookup(folder, num_rows)
+        bench_timestamps_2_str(folder, num_rows)
+        bench_resample(folder, num_rows)
+        bench_writer(folder, num_rows)
+        bench_smoothing(folder, num_rows)
+        bench_streaming(folder, num_rows)
+        bench_views(folder, num_rows)
+        bench_unzip(folder, num_rows)
+        bench_unzip_merge(folder, num_rows)
+        bench_chunk_merge(folder, num_rows)
+    finally:
+        shutil.rmtree(folder)
+    return num_errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_rows', type=int, default=1000000,
+                        help="The number of rows in the synthetic data files")
+    args = parser.parse_args()
+    sys.exit(1 if main(args.num_rows) else 0)
@@ -17,10 +17,16 @@ import bisect
 
 import utils
 import constants
+import sensor_cache
+from helper import valid_obd_copy
+from trip import get_trip
 
 debug = True  # If True, some useful information will be printed out.
 show_figure = False
 
+# vector j when there is no speed to find it from, see get_j
+DEFAULT_J = [1.0, 1.0, 1.0]
+
 
 def print_floats(*floats, precision=4, description=None, delimeter=','):
     """
@@ -48,7 +54,7 @@ def valid_obd_file(obd_file):
     True if the content of the file is value; False, otherwise.
     """
     if not os.path.isfile(obd_file):
-        return False
+        return valid_obd_copy(obd_file)
 
     with open(obd_file, 'r') as fp:
         _ = fp.readline()
@@ -79,11 +85,11 @@ def valid_gps_file(gps_file):
     ------
     True if the content of the file is value; False, otherwise.
     """
-    if not os.path.isfile(gps_file):
+    if not sensor_cache.exists(gps_file):
         return False
 
     try:
-        time_speed = utils.read_csv_file(gps_file, columns=[1, 4])  # time, speed
+        time_speed = get_trip(os.path.dirname(gps_file)).read(constants.GPS_FILE_NAME, columns=[1, 4])  # time, speed
         ave_time = (time_speed[-1][0] - time_speed[0][0]) / 1000.0 / len(time_speed)
         if ave_time > 5:  # TODO: might need to be adjusted
             print("average interval of GPS samples: %.2f seconds, which is too large." % ave_time)
@@ -116,45 +122,26 @@ def calculate_angle(v1, v2):
     return np.arccos(cos_a)
 
 
-def get_j(trip, acc, gravity_component, require_obd=False):
+def get_time_speed(trip, require_obd=False):
     """
-    Get vector j from accelerating/decelerating in straight line.
+    Get the speed of the given trip from the OBD file, or from the gps file if there is no valid OBD file.
 
     Parameters
     ----------
     trip : str
         The path of the folder
 
-    acc : 2D numpy array
-        [[time, x, y, z]]. After removing the gravity component.
-
-    gravity_component : array
-        The gravity components that are applied to the 3 axes.
-
     require_obd : boolean, default=False
         If True, then obd file is needed, which is mainly to retrieve speed.
 
     Returns
     -------
-    j : vector
-        1*3
+    time_speed : 2D numpy array
+        [[time, speed]]. None if there is no valid file to get speed from.
     """
-    if debug:
-        print("Getting j...")
-
-    j = [1.0] * 3
-
-    # The reason to use deceleration is that deceleration usually happens ahead of
-    # stop sign or traffic light, whereas acceleration could happen when turning
-    # after stop sign, which means the deceleration is more likely to happen in
-    # straight line.
-    # but we still use acceleration period for now.
-    # If we change to use deceleration later, we need to revert the sign
-    # because deceleration aligns with the negative direction of j.
-
     obd_file = os.path.join(trip, constants.OBD_FILE_NAME)
     if valid_obd_file(obd_file):
-        time_speed = utils.read_csv_file(obd_file, columns=[0, 2])
+        time_speed = get_trip(trip).read(constants.OBD_FILE_NAME, columns=[0, 2])
         for line in time_speed:
             if len(line) < 2:
                 continue
@@ -174,12 +161,12 @@ def get_j(trip, acc, gravity_component, require_obd=False):
         # which should be taken care of by the clean in preprocess
         if not valid_gps_file(gps_file):
             print("Error: valid GPS file %s is required to get calibration vector j." % gps_file)
-            return j
+            return None
 
         # use the system_time instead of timestamp,
         # because timestamp sometime is not strictly increasing.
         # the data with provider 'network' has been filtered out during reading
-        time_speed = utils.read_csv_file(gps_file, columns=[1, 4])  # time, speed
+        time_speed = get_trip(trip).read(constants.GPS_FILE_NAME, columns=[1, 4])  # time, speed
 
     # TODO: we don't need to use all data
 
@@ -195,6 +182,23 @@ def get_j(trip, acc, gravity_component, require_obd=False):
     new_time_speed = np.array(new_time_speed)
     time_speed = new_time_speed
 
+    return time_speed
+
+
+def get_accelerating_periods(time_speed):
+    """
+    Find all periods in which the speed keeps increasing.
+
+    Parameters
+    ----------
+    time_speed : 2D numpy array
+        [[time, speed]]
+
+    Returns
+    -------
+    accelerating_periods : list[[int, int]]
+        The row numbers in time_speed of the start and end of each period.
+    """
     if show_figure:
         speed = [float(s) for s in time_speed[:, 1]]
         plt.plot(speed, '-*')
@@ -228,6 +232,59 @@ def get_j(trip, acc, gravity_component, require_obd=False):
                 longest_acc_period = [peak, start]
         start += 1
 
+    return accelerating_periods
+
+
+def get_j(trip, acc, gravity_component, require_obd=False, time_speed=None, accelerating_periods=None):
+    """
+    Get vector j from accelerating/decelerating in straight line.
+
+    Parameters
+    ----------
+    trip : str
+        The path of the folder
+
+    acc : 2D numpy array
+        [[time, x, y, z]]. After removing the gravity component.
+
+    gravity_component : array
+        The gravity components that are applied to the 3 axes.
+
+    require_obd : boolean, default=False
+        If True, then obd file is needed, which is mainly to retrieve speed.
+
+    time_speed : 2D numpy array, default=None
+        [[time, speed]]. Read from the trip if not given. See get_time_speed().
+
+    accelerating_periods : list, default=None
+        Found from time_speed if not given. See get_accelerating_periods().
+
+    Returns
+    -------
+    j : vector
+        1*3
+    """
+    if debug:
+        print("Getting j...")
+
+    j = list(DEFAULT_J)
+
+    # The reason to use deceleration is that deceleration usually happens ahead of
+    # stop sign or traffic light, whereas acceleration could happen when turning
+    # after stop sign, which means the deceleration is more likely to happen in
+    # straight line.
+    # but we still use acceleration period for now.
+    # If we change to use deceleration later, we need to revert the sign
+    # because deceleration aligns with the negative direction of j.
+
+    if time_speed is None:
+        time_speed = get_time_speed(trip, require_obd)
+        if time_speed is None:
+            return j
+
+    if accelerating_periods is None:
+        accelerating_periods = get_accelerating_periods(time_speed)
+
     if not accelerating_periods:
         print("Error: cannot find accelerating period in calculating vector j, %s" % trip)
         sys.exit()
@@ -416,8 +473,7 @@ def get_gravity_component(trip):
     # in the end, saving the full calibration parameter should be enough
     gravity_component = [0.0] * 3
 
-    acc_file = os.path.join(trip, constants.ACC_FILE_NAME)
-    acc = utils.read_csv_file(acc_file, columns=[1, 3, 4, 5])
+    acc = get_trip(trip).read(constants.ACC_FILE_NAME, columns=[1, 3, 4, 5])
 
     gravity_component = get_gravity_from_acc(acc)
 
@@ -468,6 +524,61 @@ def norm_vector(vector):
     return normed
 
 
+def read_acc_in_periods(acc_file, time_speed, periods, head_size=1000):
+    """
+    Read the beginning of the acc file, and the acc data within the given periods,
+    block by block, so that the memory needed does not depend on the length of the trip.
+
+    Parameters
+    ----------
+    acc_file : str
+        The path of the acc file
+
+    time_speed : 2D numpy array
+        [[time, speed]]. None if there is no speed data.
+
+    periods : list[[int, int]]
+        The row numbers in time_speed of the start and end of each period.
+
+    head_size : int, default=1000
+        The number of rows to keep from the beginning of the file
+
+    Returns
+    -------
+    acc_head : 2D numpy array
+        [[time, x, y, z]]. The first head_size rows.
+
+    acc : 2D numpy array
+        [[time, x, y, z]]. The rows whose time is within (start, end] of any period.
+    """
+    if periods:
+        starts = np.array([time_speed[p[0]][0] for p in periods])
+        ends = np.array([time_speed[p[1]][0] for p in periods])
+        order = np.argsort(starts)
+        starts, ends = starts[order], ends[order]
+        # the end of all periods so far, since periods might overlap
+        ends = np.maximum.accumulate(ends)
+
+    acc_head = []
+    acc = []
+    head_count = 0
+    for sys_time, xyz in utils.iter_raw_sensor(acc_file):
+        block = np.column_stack([sys_time, xyz])
+        if head_count < head_size:
+            acc_head.append(block[:head_size - head_count])
+            head_count += len(acc_head[-1])
+
+        if periods:
+            # the last period that starts before each row
+            index = np.searchsorted(starts, sys_time, side='left') - 1
+            in_period = (index >= 0) & (sys_time <= ends[np.maximum(index, 0)])
+            acc.append(block[in_period])
+
+    acc_head = np.concatenate(acc_head) if acc_head else np.zeros((0, 4))
+    acc = np.concatenate(acc) if acc else np.zeros((0, 4))
+    return acc_head, acc
+
+
 def get_calibration_parameters(trip, require_obd, overwrite=False):
     """
     Get the calibration parameters for a single trip, and save them into a file
@@ -497,18 +608,25 @@ def get_calibration_parameters(trip, require_obd, overwrite=False):
         if os.path.isfile(calib_file):
             if debug:
                 print("%s already exists. And overwrite is set to be %s. Skip." % (calib_file, overwrite))
-            with open(calib_file, 'r') as fp:
-                line = fp.readline()
-            parameters = line.rstrip().split(',')
-            calibration_parameters = [float(p) for p in parameters]
-            return calibration_parameters
+            return get_trip(trip).calibration_parameters
 
     acc_file = os.path.join(trip, constants.ACC_FILE_NAME)
-    acc = utils.read_csv_file(acc_file, columns=[1, 3, 4, 5])  # get numpy array
 
-    gravity_component = get_gravity_from_acc(acc)
-    acc_wt_gravity = remove_gravity_component(acc, gravity_component)
-    j = get_j(trip, acc_wt_gravity, gravity_component, require_obd=require_obd)
+    # only the beginning of the acc data is needed for gravity component,
+    # and only the acc data within the accelerating periods is needed for j,
+    # so that the acc file is read block by block instead of as a whole
+    time_speed = get_time_speed(trip, require_obd)
+    accelerating_periods = get_accelerating_periods(time_speed) if time_speed is not None else []
+    acc_head, acc = read_acc_in_periods(acc_file, time_speed, accelerating_periods)
+
+    gravity_component = get_gravity_from_acc(acc_head)
+    if time_speed is None:
+        # get_j would read the speed again
+        j = list(DEFAULT_J)
+    else:
+        acc_wt_gravity = remove_gravity_component(acc, gravity_component)
+        j = get_j(trip, acc_wt_gravity, gravity_component, require_obd=require_obd,
+                  time_speed=time_speed, accelerating_periods=accelerating_periods)
 
     gravity_component_norm = norm_vector(gravity_component)
     j_norm = norm_vector(j)
@@ -524,6 +642,31 @@ def get_calibration_parameters(trip, require_obd, overwrite=False):
     return ans
 
 
+def find_calibration_trips(data_path):
+    """
+    Find the trip folders under the given path that can be calibrated, i.e. those with acc data.
+
+    Yields
+    ------
+    trip : str
+        The path of the trip folder
+    """
+    for _root, _, _files in os.walk(data_path):
+        if not _files or (len(_files) == 1 and '.DS_Store' in _files):
+            continue
+
+        if "TEMP_TEMP_TEMP" in _root:
+            continue
+
+        if not sensor_cache.exists(os.path.join(_root, constants.ACC_FILE_NAME)):
+            if debug:
+                print(_root, end=': ')
+                print('no acc')
+            continue
+
+        yield _root
+
+
 def calibration(data_path: str, require_obd: bool, overwrite=False) -> None:
     """
     Get calibration parameters for all folders and sub folders under given path.
@@ -540,19 +683,7 @@ def calibration(data_path: str, require_obd: bool, overwrite=False) -> None:
     overwrite : boolean, default=False
         If True, then overwrite the existing calibration parameter file.
     """
-    for _root, _, _files in os.walk(data_path):
-        if not _files or (len(_files) == 1 and '.DS_Store' in _files):
-            continue
-
-        if "TEMP_TEMP_TEMP" in _root:
-            continue
-
-        if constants.ACC_FILE_NAME not in _files:
-            if debug:
-                print(_root, end=': ')
-                print('no acc')
-            continue
-
+    for _root in find_calibration_trips(data_path):
         calibration_parameters = get_calibration_parameters(_root, require_obd, overwrite)
         if debug:
             print_floats(*calibration_parameters, description="Calibration parameters:")
@@ -601,10 +732,12 @@ def parse_arguments():
 
 def calibration_cmd(input_str, configs=None):
     if input_str == 'syntax':
-        msg = """calibration -d directory [-obd require_obd=False] [-o overwrite=False]
+        msg = """calibration -d directory [-obd require_obd=False] [-o overwrite=False] [--plan]
 
         -obd require_obd=False: If True, then obd file is needed for calibration
         -o overwrite=False: If True, then recalculate and overwrite existing calibration parameter file.
+        --plan: Do not calibrate, but list the trips to be calibrated, the size of their inputs,
+                and the projected runtime (see planner.py).
 
         E.g.
             >> calibration -d ./data -obd True
@@ -614,7 +747,8 @@ def calibration_cmd(input_str, configs=None):
         print(msg)
         return
 
-    from helper import convert_to_map
+    from helper import convert_to_map, pop_flag
+    plan, input_str = pop_flag(input_str, '--plan')
     options = convert_to_map(input_str)
     data_path = options.get('-d', None)
 
@@ -638,6 +772,11 @@ def calibration_cmd(input_str, configs=None):
     else:
         overwrite = False
 
+    if plan:
+        import planner
+        planner.plan_calibration(data_path, require_obd, overwrite)
+        return
+
     calibration(data_path, require_obd, overwrite)
 
 
@@ -0,0 +1,336 @@
+"""
+Merge of the chunk files of a sensor, e.g. 'raw_acc1.txt', 'raw_acc2.txt', ..., into one file
+ordered by time, see unzip.merge_single_directory and unzip.unzip_merge_files.
+
+The chunks are merged line by line as a k-way merge on the time column, i.e. 'sys_time' of the
+raw sensors, 'system_time' of gps, or 'timestamp' of obd (see time_column_index), so that chunks
+that overlap or are numbered out of order still give one ordered file. Only the chunks being
+merged are open at the same time, and the lines are streamed, so the memory does not grow with
+the size of the files.
+
+Each chunk is copied as long as its lines are not later than the next line of any other chunk,
+i.e. the head of the heap. The chunks are read block by block, and a block that is in order and
+not later than the head of the heap is copied as a whole, see ChunkReader. If the chunks do not
+overlap, which is the usual case, that is every block, i.e. linear time, and the heap only
+changes from one chunk to the next. Otherwise the lines of the blocks that overlap are merged
+one by one.
+
+The first line of each chunk is its header if its time cannot be parsed. The header of the first
+chunk is written once, and those of the other chunks are dropped. Lines that go back in time
+within a chunk cannot be put in order by the merge and are kept where they are; they are counted
+as inversions, see MergeReport.
+"""
+
+import heapq
+import io
+
+import numpy as np
+
+debug = False
+
+# the bytes of lines read at a time from each chunk, see ChunkReader
+BLOCK_SIZE = 1024 * 1024
+
+# the names of the time column, in order of preference
+TIME_COLUMNS = [b'sys_time', b'system_time', b'timestamp']
+
+# the inversions reported one by one, see MergeReport.print_report
+MAX_REPORTED = 10
+
+
+def time_column_index(header, default=1):
+    """
+    The index of the time column in the given header line, see TIME_COLUMNS, or default if there is none.
+    """
+    names = [name.strip(b'" \r\n') for name in header.split(b',')]
+    for name in TIME_COLUMNS:
+        if name in names:
+            return names.index(name)
+    return default
+
+
+def parse_time(line, column):
+    """
+    The time of a line, i.e. the integer (ms) in the given column, quoted or not. None if it cannot be parsed.
+    """
+    fields = line.split(b',', column + 1)
+    if len(fields) <= column:
+        return None
+    field = fields[column].strip(b'" \r\n')
+    try:
+        return int(field)
+    except ValueError:
+        try:
+            return int(float(field))
+        except ValueError:
+            return None
+
+
+class MergeReport(object):
+    """
+    What happened in merging the chunks of a file.
+
+    Attributes
+    ----------
+    num_lines : int
+        The lines written, without the header
+
+    switches : int
+        The times the merge went on with another chunk before the current one was finished,
+        i.e. 0 if the chunks are in order and do not overlap.
+
+    inversions : list[tuple]
+        (chunk name, line number, time, time of the line before) of each line that goes back
+        in time within its chunk
+
+    failed : list[str]
+        The chunks that could not be read till the end, whose lines up to the error are merged
+    """
+
+    def __init__(self, merged_file):
+        self.merged_file = merged_file
+        self.num_lines = 0
+        self.switches = 0
+        self.inversions = []
+        self.failed = []
+
+    def print_report(self):
+        """
+        Print the inversions and the overlapping chunks, if any.
+        """
+        if self.switches:
+            print("WARNING: merge file: %s: the chunks overlap or are out of order, merged by time"
+                  % self.merged_file)
+        for name, line_number, time, last_time in self.inversions[:MAX_REPORTED]:
+            print("error: merge file: %s, %s line # %d: time %d is before %d"
+                  % (self.merged_file, name, line_number, time, last_time))
+        if len(self.inversions) > MAX_REPORTED:
+            print("error: merge file: %s, %d more lines out of order"
+                  % (self.merged_file, len(self.inversions) - MAX_REPORTED))
+
+
+def fixed_width_times(fields):
+    """
+    The times of fields of the same width, quoted or not, e.g. '"1508813124141"', which is how the
+    time columns are written, converted at once. None if they are not such integers, e.g. of different
+    widths, and they have to be parsed one by one, see parse_time.
+
+    Parameters
+    ----------
+    fields : list[bytes]
+
+    Returns
+    -------
+    times : 1-D array of int64
+    """
+    width = len(fields[0])
+    quoted = fields[0][:1] == b'"'
+    num_digits = width - 2 if quoted else width
+    # int64 holds 18 digits
+    if not 0 < num_digits <= 18 or len(set(map(len, fields))) != 1:
+        return None
+    chars = np.frombuffer(b''.join(fields), dtype=np.uint8).reshape(len(fields), width)
+    if quoted:
+        if not (np.all(chars[:, 0] == ord('"')) and np.all(chars[:, -1] == ord('"'))):
+            return None
+        chars = chars[:, 1:-1]
+    digits = chars.astype(np.int64) - ord('0')
+    if not np.all((digits >= 0) & (digits <= 9)):
+        return None
+    return digits.dot(10 ** np.arange(num_digits - 1, -1, -1, dtype=np.int64))
+
+
+class ChunkReader(object):
+    """
+    The lines of a chunk and their times, read block by block.
+    """
+
+    def __init__(self, fp, column, line_number=1, first_line=None):
+        """
+        Parameters
+        ----------
+        fp : binary file object
+            The chunk, after its header
+
+        column : int
+            The index of the time column
+
+        line_number : int, default=1
+            The line number of the next line in the chunk
+
+        first_line : bytes, default=None
+            The first line of data, if it has been read from fp already
+        """
+        self.fp = fp
+        self.column = column
+        self.pending = [first_line] if first_line else []
+        self.lines = []
+        self.times = []  # None for empty lines
+        self.ordered = False  # if the times of the whole block are in order
+        self.pos = 0  # the next line of the block to be merged
+        self.line_number = line_number  # of the first line of the block
+        self.last_time = -1  # of the line merged last
+
+    def read_block(self):
+        """
+        Read the next block of lines, when those of the current block have all been merged.
+
+        Returns
+        -------
+        False if there are no more lines.
+        """
+        self.line_number += len(self.lines)
+        # read as bytes, and split into lines at once, which is much faster than line by line, e.g. for gzip
+        data = self.fp.read(BLOCK_SIZE)
+        if data and not data.endswith(b'\n'):
+            data += self.fp.readline()
+        self.lines = self.pending + io.BytesIO(data).readlines()
+        self.pending = []
+        self.pos = 0
+        if not self.lines:
+            return False
+        if not self.lines[-1].endswith(b'\n'):
+            self.lines[-1] += b'\n'
+
+        column = self.column
+        try:
+            times = fixed_width_times([line.split(b',', column + 1)[column] for line in self.lines])
+        except IndexError:
+            times = None
+        if times is not None:
+            self.ordered = times[0] >= self.last_time and bool(np.all(times[1:] >= times[:-1]))
+            self.times = times.tolist()
+        else:
+            # lines that cannot be parsed go with the line before
+            self.times = []
+            time = self.last_time
+            for line in self.lines:
+                if not line.strip():
+                    self.times.append(None)
+                    continue
+                parsed = parse_time(line, column)
+                time = parsed if parsed is not None else time
+                self.times.append(time)
+            self.ordered = False
+        return True
+
+
+def merge_chunks(chunks, fp, open_chunk, merged_file='', default_column=1):
+    """
+    Merge the lines of the chunks into a file, ordered by time, see the top of this file.
+
+    Parameters
+    ----------
+    chunks : list[str]
+        The chunk files, in the order that the lines of the same time are written in.
+
+    fp : binary file object
+        The merged file to write to
+
+    open_chunk : callable
+        open_chunk(chunk) opens a chunk for reading binary lines, e.g. gzip.open(chunk, 'rb').
+
+    merged_file : str, default=''
+        The name of the merged file in the report
+
+    default_column : int, default=1
+        The index of the time column if the chunks have no header
+
+    Returns
+    -------
+    report : MergeReport
+    """
+    report = MergeReport(merged_file)
+    header = None
+    column = default_column
+
+    # the first line of data of each chunk, to start the heap with
+    heap = []
+    for index, chunk in enumerate(chunks):
+        try:
+            with open_chunk(chunk) as chunk_fp:
+                first_line = chunk_fp.readline()
+                if header is None and first_line and first_line.strip():
+                    column = time_column_index(first_line, default_column)
+                time = parse_time(first_line, column)
+                if time is None:
+                    if header is None and first_line.strip():
+                        header = first_line
+                    elif first_line != header:
+                        print("WARNING: merge file: %s: the header of %s is different, dropped" % (merged_file, chunk))
+                    first_line = chunk_fp.readline()
+                    time = parse_time(first_line, column)
+        except Exception as e:
+            print("exception happens in merge %s: %s: %s" % (chunk, type(e).__name__, e))
+            report.failed.append(chunk)
+            continue
+        if first_line.strip():
+            # lines that cannot be parsed go with the line before, i.e. the first of all here
+            heap.append((time if time is not None else -1, index))
+    heapq.heapify(heap)
+
+    if header is not None:
+        fp.write(header if header.endswith(b'\n') else header + b'\n')
+
+    # the chunks that have been opened
+    readers = {}
+    while heap:
+        _, index = heapq.heappop(heap)
+        # the lines of this chunk are copied until one is later than the head of the heap
+        bound = heap[0] if heap else None
+        reader = readers.get(index)
+        chunk_fp = None
+        try:
+            if reader is None:
+                chunk_fp = open_chunk(chunks[index])
+                first_line = chunk_fp.readline()
+                if parse_time(first_line, column) is None:
+                    reader = ChunkReader(chunk_fp, column, 2)
+                else:
+                    reader = ChunkReader(chunk_fp, column, 1, first_line)
+                readers[index] = reader
+
+            while True:
+                if reader.pos == len(reader.lines) and not reader.read_block():
+                    reader.fp.close()
+                    del readers[index]
+                    break
+
+                lines, times = reader.lines, reader.times
+                if reader.pos == 0 and reader.ordered and (bound is None or (times[-1], index) <= bound):
+                    fp.writelines(lines)
+                    report.num_lines += len(lines)
+                    reader.last_time = times[-1]
+                    reader.pos = len(lines)
+                    continue
+
+                i = reader.pos
+                while i < len(lines):
+                    time = times[i]
+                    if time is not None:
+                        if bound is not None and (time, index) > bound:
+                            break
+                        if time < reader.last_time:
+                            report.inversions.append((chunks[index], reader.line_number + i, time, reader.last_time))
+                        fp.write(lines[i])
+                        report.num_lines += 1
+                        reader.last_time = time
+                    i += 1
+                reader.pos = i
+                if i < len(lines):
+                    # later than another chunk, which goes first
+                    heapq.heappush(heap, (times[i], index))
+                    report.switches += 1
+                    break
+        except Exception as e:
+            print("exception happens in merge %s: %s: %s" % (chunks[index], type(e).__name__, e))
+            report.failed.append(chunks[index])
+            if index in readers:
+                readers.pop(index).fp.close()
+            elif chunk_fp is not None:
+                chunk_fp.close()
+
+    if debug:
+        print("merge: %s, %d chunks, %d lines, %d switches, %d inversions"
+              % (merged_file, len(chunks), report.num_lines, report.switches, len(report.inversions)))
+    return report
@@ -3,7 +3,8 @@ import shutil
 
 from helper import convert_to_map, valid_obd_file, valid_gps_file
 import constants
-from utils import read_csv_file
+import sensor_cache
+from trip import get_trip, trips
 
 debug = True
 
@@ -151,7 +152,7 @@ def valid_acc(root):
     True if the file is valid; False, otherwise
     """
     acc_file = os.path.join(root, constants.ACC_FILE_NAME)
-    if not os.path.isfile(acc_file):
+    if not sensor_cache.exists(acc_file):
         if debug:
             print("Invalid acc file %s" % acc_file)
         return False
@@ -173,7 +174,7 @@ def valid_gyro(root):
     True if the file is valid; False, otherwise
     """
     gyro_file = os.path.join(root, constants.GYRO_FILE_NAME)
-    if not os.path.isfile(gyro_file):
+    if not sensor_cache.exists(gyro_file):
         if debug:
             print("Invalid gyro file %s" % gyro_file)
         return False
@@ -229,7 +230,7 @@ def valid_gps(root, gps_max_interval, min_duration):
             print("invalid gps file: %s" % root)
         return False
 
-    time_speed = read_csv_file(gps_file, columns=[1, 4])
+    time_speed = get_trip(root).read(constants.GPS_FILE_NAME, columns=[1, 4])
     trip_duration = (time_speed[-1][0] - time_speed[0][0]) / 1000.0  # seconds
     ave_time = trip_duration / len(time_speed)
     if ave_time > gps_max_interval:
@@ -265,6 +266,8 @@ def deal_bad_trip(root, force_delete, temp_folder):
     temp_folder : str
         The path of the temp folder to host the bad folder.
     """
+    trips.discard(root)
+
     if force_delete.lower() == 'true':
         shutil.rmtree(root)
         return
@@ -26,6 +26,16 @@ MAGNET_FILE_NAME = 'raw_mag.txt'
 
 TEMP_FOLDER = 'TEMP_TEMP_TEMP'
 
+# the records of preprocessed trips under the data path, see manifest.py
+PREPROCESS_MANIFEST_FILE = 'preprocessed_files.txt'
+
+# the table of all sensors of a trip on the same time grid, without the extension of its format,
+# see file_process.process_aligned
+ALIGNED_FILE_NAME = 'aligned_sensors'
+
+# the maximum memory used by the data of trips kept in memory, see trip.py
+TRIP_CACHE_SIZE = 2 * 1024 ** 3  # bytes
+
 FILTERED_ACC_FILE = 'filtered_acc.pickle'
 
 # the file that exists in each trip folder containing the pothole info along the trip
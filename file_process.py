@@ -6,16 +6,35 @@ import numpy as np
 import time
 import calendar
 import sys
+import multiprocessing
+import concurrent.futures
+import functools
+import itertools
+import traceback
 
 import constants
+import manifest
+import resample
+import sensor_cache
+import smoothing
+import utils
+import writer
 from helper import valid_obd_file, valid_gps_file
+from trip import get_trip
 
 
 debug = True
 
-def get_start_end_time(folder):
+# bump it whenever the content of the output files changes, so that incremental runs process all trips again
+OUTPUT_VERSION = 4
+
+def get_time_bounds(folder):
     """
-    Get the maximum start time and the minimum end time of all data under the given folder.
+    Get the start and end time of each data file under the given folder.
+
+    Only the first line and the last few lines of each file are read. The last line is
+    skipped, as when the whole files used to be read with pandas.read_csv(skipfooter=1), so that
+    the time grid of the resampled files stays the same, see utils.read_time_bounds.
 
     Parameters
     ----------
@@ -24,45 +43,57 @@ def get_start_end_time(folder):
 
     Returns
     -------
-    start_time : int
-        System timestamp. The maximum start time of all data files.
-
-    end_time : int
-        System timestamp. The minimum end time of all data files.
+    bounds : dict{file name: (start_time, end_time)}
+        System timestamps. Files that are missing, invalid or empty are not included.
     """
-    start = -1
-    end = sys.maxsize
-
-    sys_time = "sys_time"
+    bounds = {}
 
-    # TODO: replace file names with constants
     sensor_type = [constants.ACC_FILE_NAME, constants.GYRO_FILE_NAME, constants.MAGNET_FILE_NAME, constants.GRAVITY_FILE_NAME, constants.ROTATION_FILE_NAME]
-
-    files = os.listdir(folder)
     for f in sensor_type:
-        if f in files:
-            raw_acc = os.path.join(folder, constants.ACC_FILE_NAME)
-            df = pd.read_csv(raw_acc, error_bad_lines=False, engine='python', skipfooter=1)
-            start = max(int(df[sys_time].head(1)), start)
-            end = min(int(df[sys_time].tail(1)), end)
-
-    system_time = "system_time"
-    if constants.GPS_FILE_NAME in files:
+        # the file, or only its binary copy, see sensor_cache.save
+        if sensor_cache.exists(os.path.join(folder, f)):
+            bounds[f] = utils.read_time_bounds(os.path.join(folder, f), "sys_time", skip_last=True)
+
+    if sensor_cache.exists(os.path.join(folder, constants.GPS_FILE_NAME)):
         gps_file = os.path.join(folder, constants.GPS_FILE_NAME)
         # This should already have been done in 'clean'. Just in case here.
         if valid_gps_file(gps_file):
-            df = pd.read_csv(gps_file, error_bad_lines=False, engine='python', skipfooter=1)
-            start = max(int(df[system_time].head(1)), start)
-            end = min(int(df[system_time].tail(1)), end)
+            bounds[constants.GPS_FILE_NAME] = utils.read_time_bounds(gps_file, "system_time", skip_last=True)
 
-    timestamp = "timestamp"
-    if constants.OBD_FILE_NAME in files:
+    if sensor_cache.exists(os.path.join(folder, constants.OBD_FILE_NAME)):
         obd_file = os.path.join(folder, constants.OBD_FILE_NAME)
         # This should already have been done in 'clean'. Just in case here.
         if valid_obd_file(obd_file):
-            df = pd.read_csv(obd_file, error_bad_lines=False, engine='python', skipfooter=1)
-            start = max(int(df[timestamp].head(1)), start)
-            end = min(int(df[timestamp].tail(1)), end)
+            bounds[constants.OBD_FILE_NAME] = utils.read_time_bounds(obd_file, "timestamp", skip_last=True)
+
+    return {f: bound for f, bound in bounds.items() if bound}
+
+
+def get_start_end_time(folder):
+    """
+    Get the maximum start time and the minimum end time of all data under the given folder.
+
+    Parameters
+    ----------
+    folder : str
+        The path of the folder
+
+    Returns
+    -------
+    start_time : int
+        System timestamp. The maximum start time of all data files.
+
+    end_time : int
+        System timestamp. The minimum end time of all data files.
+    """
+    start = -1
+    end = sys.maxsize
+
+    for f, (file_start, file_end) in get_time_bounds(folder).items():
+        if debug:
+            print("%s: %d, %d" % (f, file_start, file_end))
+        start = max(file_start, start)
+        end = min(file_end, end)
 
     if debug:
         print("start and end time: %d, %d" % (start, end))
@@ -71,7 +102,8 @@ def get_start_end_time(folder):
     return start, end
 
 
-def process_data(path: str, sampling_rate: int, rolling_window_size: int):
+def process_data(path: str, sampling_rate: int, rolling_window_size: int, num_workers: int = 1, output_format: str = 'csv',
+                 aligned: bool = False, filter_type: str = 'mean'):
     """
     Process files under given path accordingly.
 
@@ -86,6 +118,20 @@ def process_data(path: str, sampling_rate: int, rolling_window_size: int):
     rolling_window_size : int
         Default is 50.
 
+    num_workers : int, default=1
+        The number of processes to process the sensor files of the trip in parallel.
+        1 to process them one by one in the current process.
+
+    output_format : str, default='csv'
+        The format of the output files, see writer.WRITERS
+
+    aligned : boolean, default=False
+        If True, write all sensors to one table on the same time grid (see process_aligned),
+        instead of a pair of files per sensor. The sensors are then processed in the current process.
+
+    filter_type : str, default='mean'
+        The filter to smooth the data, see smoothing.FILTERS
+
     Returns
     -------
     True if process succeeds; False, otherwise.
@@ -95,34 +141,163 @@ def process_data(path: str, sampling_rate: int, rolling_window_size: int):
 
     start_time, end_time = get_start_end_time(path)
 
-    sensor_type = ['acc', 'gyro', 'mag', 'rot', 'grav']
-    sensor_prefix = 'raw_'
-    for sensor in sensor_type:
-        sensor_file = os.path.join(path, sensor_prefix + sensor + '.txt')
-        if os.path.isfile(sensor_file):
-            if debug:
-                print("process: %s" % sensor_file)
-            process_motion_sensor_data(sensor_file, path, start_time, end_time, sampling_rate, rolling_window_size, sensor)
-
-    gps_file = os.path.join(path, constants.GPS_FILE_NAME)
-    if valid_gps_file(gps_file):
+    if aligned:
+        process_aligned(path, get_sensors(path), start_time, end_time, sampling_rate, rolling_window_size,
+                        output_format, filter_type)
+        return True
+
+    # the sensors are independent of each other once the time range is known
+    tasks = [(sensor, path, start_time, end_time, sampling_rate, rolling_window_size, output_format, filter_type)
+             for sensor in get_sensors(path)]
+    if num_workers > 1 and len(tasks) > 1:
+        with concurrent.futures.ProcessPoolExecutor(min(num_workers, len(tasks))) as executor:
+            # result() raises the error of the sensor, if any
+            for future in [executor.submit(process_sensor, *task) for task in tasks]:
+                future.result()
+    else:
+        for task in tasks:
+            process_sensor(*task)
+
+    return True
+
+
+def get_sensors(path):
+    """
+    Get the sensors of the trip to be processed, i.e. the motion sensors whose files exist,
+    'gps' and 'obd' if their files are valid.
+    """
+    sensors = []
+    for sensor in ['acc', 'gyro', 'mag', 'rot', 'grav']:
+        if sensor_cache.exists(os.path.join(path, 'raw_' + sensor + '.txt')):
+            sensors.append(sensor)
+
+    if valid_gps_file(os.path.join(path, constants.GPS_FILE_NAME)):
+        sensors.append('gps')
+
+    if valid_obd_file(os.path.join(path, constants.OBD_FILE_NAME)):
+        sensors.append('obd')
+
+    return sensors
+
+
+def process_sensor(sensor, path, start_time, end_time, sampling_rate, rolling_window_size, output_format='csv',
+                   filter_type='mean'):
+    """
+    Process the data file of a single sensor of the trip, see process_data.
+
+    Parameters
+    ----------
+    sensor : str
+        One of ['acc', 'gyro', 'mag', 'rot', 'grav', 'gps', 'obd']
+    """
+    resampled = resample_sensor(sensor, path, start_time, end_time, sampling_rate)
+    write_resampled_and_smoothed(path, sensor, resampled, rolling_window_size, sampling_rate, output_format,
+                                 filter_type)
+
+
+class ResampledSensor(object):
+    """
+    The resampled data of a sensor, which is produced chunk by chunk as it is read.
+    """
+
+    def __init__(self, columns, formats, num_time_columns, num_rows, chunks):
+        """
+        Parameters
+        ----------
+        columns : list[str]
+            The names of the columns
+
+        formats : list
+            The format of each column, i.e. writer.INT, writer.STR or the number of decimals of float.
+
+        num_time_columns : int
+            The number of time columns, which are the first ones.
+
+        num_rows : int
+            The total number of rows, i.e. of the time grid
+
+        chunks : iterator of list[1-D array]
+            The resampled columns, a few rows at a time
+        """
+        self.columns = columns
+        self.formats = formats
+        self.num_time_columns = num_time_columns
+        self.num_rows = num_rows
+        self.chunks = chunks
+        self.pending = None  # the rest of the chunk that has been taken partly
+
+    @property
+    def value_indexes(self):
+        """
+        The indexes of the numeric columns that are not time.
+        """
+        return [i for i in range(self.num_time_columns, len(self.columns)) if self.formats[i] != writer.STR]
+
+    def take(self, num_rows):
+        """
+        Take the next rows, no matter how the chunks are cut.
+
+        Returns
+        -------
+        data : list[1-D array]
+            The columns of the next num_rows rows, or of the rest if there are fewer.
+        """
+        pieces = []
+        count = 0
+        while count < num_rows:
+            piece = self.pending if self.pending is not None else next(self.chunks, None)
+            self.pending = None
+            if piece is None:
+                break
+            if len(piece[0]) > num_rows - count:
+                self.pending = [col[num_rows - count:] for col in piece]
+                piece = [col[:num_rows - count] for col in piece]
+            pieces.append(piece)
+            count += len(piece[0])
+        return [np.concatenate(cols) for cols in zip(*pieces)]
+
+
+def resample_sensor(sensor, path, start_time, end_time, sampling_rate, rows=None):
+    """
+    Resample the data file of a single sensor of the trip.
+
+    Parameters
+    ----------
+    sensor : str
+        One of ['acc', 'gyro', 'mag', 'rot', 'grav', 'gps', 'obd']
+
+    rows : tuple(int, int), default=None
+        (begin, end), to resample only those rows of the time grid, see resample.StreamResampler.
+        Only the raw data around them is read. Default is all rows.
+
+    Returns
+    -------
+    resampled : ResampledSensor
+    """
+    if sensor == 'gps':
         if debug:
-            print("process: %s" % gps_file)
+            print("process: %s" % os.path.join(path, constants.GPS_FILE_NAME))
         # read_csv('x.csv', parse_dates=[0], index_col=0, squeeze=True)
-        df = pd.read_csv(gps_file, error_bad_lines=False, engine='python', skipfooter=1)
-        process_gps(df, path, start_time, end_time, sampling_rate, rolling_window_size)
-
-    obd_file = os.path.join(path, constants.OBD_FILE_NAME)
-    if valid_obd_file(obd_file):
+        df = pd.DataFrame(get_trip(path).gps)
+        return resample_gps(df, start_time, end_time, sampling_rate, rows)
+    elif sensor == 'obd':
         if debug:
-            print("process: %s" % obd_file)
-        df = pd.read_csv(obd_file, error_bad_lines=False, engine='python', skipfooter=1)
-        process_obd(df, path, start_time, end_time, sampling_rate, rolling_window_size)
-
-    return True
+            print("process: %s" % os.path.join(path, constants.OBD_FILE_NAME))
+        df = pd.DataFrame(get_trip(path).obd)
+        # with all the columns in the header, including those that are empty in every line
+        header = utils.probe_lines(os.path.join(path, constants.OBD_FILE_NAME))[0]
+        names = header.decode().replace('"', '').strip().split(',')
+        df = df.reindex(columns=names + [column for column in df.columns if column not in names])
+        return resample_obd(df, start_time, end_time, sampling_rate, rows)
+    else:
+        sensor_file = os.path.join(path, 'raw_' + sensor + '.txt')
+        if debug:
+            print("process: %s" % sensor_file)
+        return resample_motion_sensor_data(sensor_file, start_time, end_time, sampling_rate, rows)
 
 
-def process_motion_sensor_data(sensor_file: str, path: str, start_time: int, end_time: int, sampling_rate: int, rolling_window_size: int, sensor: str):
+def process_motion_sensor_data(sensor_file: str, path: str, start_time: int, end_time: int, sampling_rate: int, rolling_window_size: int, sensor: str, output_format: str = 'csv',
+                               filter_type: str = 'mean'):
     """
     Process a single motion sensor data file, and create two new files, i.e.
         'resampled_[sensor_name].txt' and 'smoothed_[sensor_name].txt'
@@ -150,52 +325,77 @@ def process_motion_sensor_data(sensor_file: str, path: str, start_time: int, end
     sensor : str
         The name of the sensor to be dealt with, i.e. ['acc', 'gyro', 'rot', 'mag', 'grav'],
         that have been used in the filename and the column name.
-    """
-    df = pd.read_csv(sensor_file, error_bad_lines=False, engine='python', skipfooter=1)
-    resampled_file = os.path.join(path, "resampled_" + sensor + ".txt")
-    sys_time_header = 'sys_time'
-    df[sys_time_header] = df[sys_time_header].astype('int64')
-    df = df.loc[(df[sys_time_header] >= start_time)
-                        & (df[sys_time_header] <= end_time)]
 
-    num_of_resamples = (end_time - start_time) // 1000 * sampling_rate
-    time_new = np.linspace(start_time, end_time, num_of_resamples)
+    output_format : str, default='csv'
+        The format of the output files, see writer.WRITERS
 
-    num_of_rows, num_of_columns = df.values.shape
-    resampled_data = np.zeros((num_of_resamples, num_of_columns))
+    filter_type : str, default='mean'
+        The filter to smooth the data, see smoothing.FILTERS
+    """
+    resampled = resample_motion_sensor_data(sensor_file, start_time, end_time, sampling_rate)
+    write_resampled_and_smoothed(path, sensor, resampled, rolling_window_size, sampling_rate, output_format,
+                                 filter_type)
 
-    raw_data = df.values
-    time_old = raw_data[:, 1].tolist()
-    for col in range(num_of_columns):
-        col_old = raw_data[:, col].tolist()
-        resampled_data[:, col] = np.interp(time_new, time_old, col_old)
 
-    # TODO: use the time_new to replace the time column?
-
-    df = pd.DataFrame(resampled_data, columns=df.columns)
-    for i in range(0, 3):
-        df[df.columns[i]] = df[df.columns[i]].astype(int)
-    for i in range(3, 6):
-        df[df.columns[i]] = df[df.columns[i]].map('{:.6f}'.format)
+def resample_motion_sensor_data(sensor_file, start_time, end_time, sampling_rate, rows=None):
+    """
+    Resample a single motion sensor data file, see process_motion_sensor_data and resample_sensor.
 
-    df.to_csv(resampled_file, index=False)
+    Returns
+    -------
+    resampled : ResampledSensor
+    """
+    # TODO: use the time_new to replace the time column?
+    resampler = resample.StreamResampler(start_time, end_time, sampling_rate, rows=rows)
+    raw_start, raw_end = start_time, end_time
+    if rows is not None:
+        # located by binary search on the memory-mapped binary copy
+        times = utils.read_sensor_range(sensor_file, start_time, end_time)['sys_time']
+        if len(times):
+            raw_start, raw_end = resample.bracket_times(times, *resampler.bounds())
+
+    # only the rows within [raw_start, raw_end] are read, block by block, so that the memory
+    # does not grow with the length of the trip
+    blocks = utils.iter_sensor_range(sensor_file, raw_start, raw_end)
+    first = next(blocks, None)
+    if first is None:
+        raise ValueError("resample: no data to interpolate from")
+    columns = list(first.dtype.names)
+
+    chunks = resample_blocks(resampler, itertools.chain([first], blocks), time_index=1)
+    formats = [writer.INT] * 3 + [6] * 3
+    return ResampledSensor(columns, formats, 3, resampler.num_rows, chunks)
+
+
+def resample_blocks(resampler, blocks, time_index):
+    """
+    Resample blocks of rows one by one.
 
+    Parameters
+    ----------
+    resampler : resample.StreamResampler
 
-    ## smooth
-    smoothed_file = os.path.join(path, "smoothed_" + sensor + ".txt")
+    blocks : iterable of numpy structured array
+        Rows with numeric columns only, sorted by time.
 
-    # TODO: the time columns should not be changed by the rolling
-    df = df.rolling(rolling_window_size, min_periods=1).mean()
-    # df = df[['timestamp', sys_time_header, 'abs_timestamp', "raw_x_" + sensor, "raw_y_" + sensor, "raw_z_" + sensor]]
-    for i in range(0, 3):
-        df[df.columns[i]] = df[df.columns[i]].astype(int)
-    for i in range(3, 6):
-        df[df.columns[i]] = df[df.columns[i]].map('{:.6f}'.format)
+    time_index : int
+        The index of the time column
 
-    df.to_csv(smoothed_file, index=False)
+    Yields
+    ------
+    data : list[1-D array]
+        The resampled columns of the next rows
+    """
+    for block in blocks:
+        # all columns are interpolated at once, with the positions in the time column found only once
+        raw_data = np.column_stack([block[column].astype(np.float64) for column in block.dtype.names])
+        for resampled_data in resampler.feed(raw_data[:, time_index], raw_data):
+            yield list(resampled_data.T)
+    for resampled_data in resampler.finish():
+        yield list(resampled_data.T)
 
 
-def process_obd(df, path, start_time, end_time, sampling_rate, rolling_window_size):
+def process_obd(df, path, start_time, end_time, sampling_rate, rolling_window_size, output_format='csv', filter_type='mean'):
     """
     Processes the 'raw_obd.txt' file and create two new files, i.e.
         'obd_resampled.txt' and 'obd_smoothed.txt'
@@ -219,12 +419,37 @@ def process_obd(df, path, start_time, end_time, sampling_rate, rolling_window_si
 
     rolling_window_size : int
         The sliding window size in data smoothing
+
+    output_format : str, default='csv'
+        The format of the output files, see writer.WRITERS
+
+    filter_type : str, default='mean'
+        The filter to smooth the data, see smoothing.FILTERS
+    """
+    resampled = resample_obd(df, start_time, end_time, sampling_rate)
+    write_resampled_and_smoothed(path, 'obd', resampled, rolling_window_size, sampling_rate, output_format,
+                                 filter_type)
+
+
+def resample_obd(df, start_time, end_time, sampling_rate, rows=None):
+    """
+    Resample the content of the 'raw_obd.txt' file, see process_obd and resample_sensor.
+
+    Only 'timestamp', 'RPM' and 'Speed' are resampled. The other columns in the header,
+    e.g. 'Consumption_Rate', are empty in the file, and so in the resampled data.
+
+    Returns
+    -------
+    resampled : ResampledSensor
     """
-    resampled_file = os.path.join(path, "resampled_obd.txt")
     timestamp_header = 'timestamp'
     df[timestamp_header] = df[timestamp_header].astype('int64')
     df = df.loc[(df[timestamp_header] >= start_time)
                     & (df[timestamp_header] <= end_time)]
+    resampler = resample.StreamResampler(start_time, end_time, sampling_rate, rows=rows)
+    if rows is not None and len(df):
+        raw_start, raw_end = resample.bracket_times(df[timestamp_header].to_numpy(), *resampler.bounds())
+        df = df.loc[(df[timestamp_header] >= raw_start) & (df[timestamp_header] <= raw_end)]
 
     # df = df.dropna(thresh=1, axis='columns')
     df['RPM'] = df['RPM'].str.strip("RPM").astype('int64')
@@ -232,40 +457,21 @@ def process_obd(df, path, start_time, end_time, sampling_rate, rolling_window_si
 
     # resample and linear interpolate
     # https://stackoverflow.com/questions/44305794/pandas-resample-data-frame-with-fixed-number-of-rows
-    num_of_resamples = (end_time - start_time) // 1000 * sampling_rate
-    time_new = np.linspace(start_time, end_time, num_of_resamples)
-
-    num_of_rows, num_of_columns = df.values.shape
-    resampled_data = np.zeros((num_of_resamples, num_of_columns))
-
-    raw_data = df.values
-    time_old = raw_data[:, 0].tolist()
-    for col in range(num_of_columns):
-        col_old = raw_data[:, col].tolist()
-        resampled_data[:, col] = np.interp(time_new, time_old, col_old)
-
-    df = pd.DataFrame(resampled_data, columns=df.columns)
-    df[df.columns[0]] = df[df.columns[0]].astype(int)
-    df[df.columns[1]] = df[df.columns[1]].astype(int)
-    df[df.columns[2]] = df[df.columns[2]].map('{:.2f}'.format)
+    values = [timestamp_header, 'RPM', 'Speed']
+    empty = [column for column in df.columns if column not in values]
+    chunks = resample_blocks(resampler, [df[values].to_records(index=False)], time_index=0)
+    chunks = (data + [np.full(len(data[0]), '')] * len(empty) for data in chunks)
+
     # TODO: add these two if needed
     # df['RPM'] = df['RPM'].astype('str') + 'RPM'
     # df['Speed'] = df['Speed'].astype('str') + 'km/h'
-    df.to_csv(resampled_file, index=False)
-
-    smoothed_file = os.path.join(path, "smoothed_obd.txt")
-    # df = df.dropna()
-    df = df.rolling(rolling_window_size, min_periods=1).mean()
-
-    df[df.columns[0]] = df[df.columns[0]].astype(int)
-    df[df.columns[1]] = df[df.columns[1]].astype(int)
-    df[df.columns[2]] = df[df.columns[2]].map('{:.2f}'.format)
     # TODO: might need
     # df = df.drop_duplicates(subset=[timestamp_header], keep=False)
-    df.to_csv(smoothed_file, index=False)
+    formats = [writer.INT, writer.INT, 2] + [writer.STR] * len(empty)
+    return ResampledSensor(values + empty, formats, 1, resampler.num_rows, chunks)
 
 
-def process_gps(df, path, start_time, end_time, sampling_rate, rolling_window_size):
+def process_gps(df, path, start_time, end_time, sampling_rate, rolling_window_size, output_format='csv', filter_type='mean'):
     """
     Processes the 'gps.txt' file and create two new files, i.e.
         'gps_resampled.txt' and 'gps_smoothed.txt'
@@ -289,61 +495,159 @@ def process_gps(df, path, start_time, end_time, sampling_rate, rolling_window_si
 
     rolling_window_size : int
         The sliding window size in data smoothing
+
+    output_format : str, default='csv'
+        The format of the output files, see writer.WRITERS
+
+    filter_type : str, default='mean'
+        The filter to smooth the data, see smoothing.FILTERS
     """
-    resampled_file = os.path.join(path, "resampled_gps.txt")
+    resampled = resample_gps(df, start_time, end_time, sampling_rate)
+    write_resampled_and_smoothed(path, 'gps', resampled, rolling_window_size, sampling_rate, output_format,
+                                 filter_type)
 
+
+def resample_gps(df, start_time, end_time, sampling_rate, rows=None):
+    """
+    Resample the content of the 'gps.txt' file, see process_gps and resample_sensor.
+
+    Returns
+    -------
+    resampled : ResampledSensor
+    """
     system_time_header = "system_time"
     df = df.loc[df['provider'] == "gps"]
     df[system_time_header] = df[system_time_header].astype('int64')
     df = df.loc[(df[system_time_header] >= start_time)
                         & (df[system_time_header] <= end_time)]
+    resampler = resample.StreamResampler(start_time, end_time, sampling_rate, rows=rows)
+    if rows is not None and len(df):
+        raw_start, raw_end = resample.bracket_times(df[system_time_header].to_numpy(), *resampler.bounds())
+        df = df.loc[(df[system_time_header] >= raw_start) & (df[system_time_header] <= raw_end)]
 
     # https://stackoverflow.com/questions/44305794/pandas-resample-data-frame-with-fixed-number-of-rows
-    num_of_resamples = (end_time - start_time) // 1000 * sampling_rate
-    time_new = np.linspace(start_time, end_time, num_of_resamples)
+    # do not have 'provider' yet, i.e. the last column
+    chunks = resample_blocks(resampler, [df[df.columns[0: -1]].to_records(index=False)], time_index=1)
+
+    # df[system_time_header] = pd.to_datetime(df[system_time_header], unit='ms')
+    # df = df.resample(sampling_rate, on=system_time_header).mean()
+    # df = df.interpolate(method='linear')  # this cannot even guarantee that different data has the same number of rows of data
+    chunks = (data + [np.full(len(data[0]), 'gps')] for data in chunks)
+    formats = [writer.INT, writer.INT, 14, 14, 2, 2, writer.STR]
+    return ResampledSensor(list(df.columns), formats, 2, resampler.num_rows, chunks)
 
-    num_of_rows, num_of_columns = df.values.shape
 
-    # do not have 'provider' yet
-    resampled_data = np.zeros((num_of_resamples, num_of_columns - 1))
+def write_resampled_and_smoothed(path, sensor, resampled, rolling_window_size, sampling_rate, output_format='csv',
+                                 filter_type='mean'):
+    """
+    Write the resampled data of a sensor to 'resampled_[sensor]', and its smoothed data to 'smoothed_[sensor]',
+    chunk by chunk.
 
-    raw_data = df.values
-    time_old = raw_data[:, 1].tolist()
-    for col in range(num_of_columns - 1):  # The last column is 'provider'
-        col_old = raw_data[:, col].tolist()
-        resampled_data[:, col] = np.interp(time_new, time_old, col_old)
+    Parameters
+    ----------
+    path : str
+        The folder/dictionary of the data exists
 
-    df = pd.DataFrame(resampled_data, columns=df.columns[0: -1])
-    # example:
-    # df['cost'] = df['cost'].map('${:,.2f}'.format)
-    # df.style.format({'B': "{:0<4.0f}", 'D': '{:+.2f}'})
-    df[df.columns[0: 2]] = df[df.columns[0: 2]].astype(int)
-    df[df.columns[2]] = df[df.columns[2]].map('{:.14f}'.format)
-    df[df.columns[3]] = df[df.columns[3]].map('{:.14f}'.format)
-    df[df.columns[4]] = df[df.columns[4]].map('{:.2f}'.format)
-    df[df.columns[5]] = df[df.columns[5]].map('{:.2f}'.format)
+    sensor : str
+        The name of the sensor, e.g. 'acc', 'gps', 'obd'
 
-    df['provider'] = 'gps'
-    df.to_csv(resampled_file, index=False)
+    resampled : ResampledSensor
+        The resampled data of the sensor
 
-    # df[system_time_header] = pd.to_datetime(df[system_time_header], unit='ms')
-    # df = df.resample(sampling_rate, on=system_time_header).mean()
-    # df = df.interpolate(method='linear')  # this cannot even guarantee that different data has the same number of rows of data
-    # df['provider'] = 'gps'
-    # df.to_csv(resampled_file, index=False)
+    rolling_window_size : int
+        The sliding window size in data smoothing
+
+    sampling_rate : int
+        The resampling rate, Hz
+
+    output_format : str, default='csv'
+        The format of the output files, see writer.WRITERS
+
+    filter_type : str, default='mean'
+        The filter to smooth the data, see smoothing.FILTERS
+    """
+    columns = resampled.columns
+    formats = resampled.formats
+    smooth = sensor_smoother(resampled, rolling_window_size, sampling_rate, filter_type)
+
+    with writer.open_table(path, "resampled_" + sensor, columns, formats, output_format, resampled.num_rows) as resampled_table, \
+            writer.open_table(path, "smoothed_" + sensor, columns, formats, output_format, resampled.num_rows) as smoothed_table:
+        for data in resampled.chunks:
+            resampled_table.write(data)
+            smoothed_table.write(smooth(data))
+
+
+def sensor_smoother(resampled, rolling_window_size, sampling_rate, filter_type='mean'):
+    """
+    Create a function that smooths the chunks of the given resampled sensor one after another.
+
+    The values are smoothed as they are written, i.e. with ints truncated and floats rounded,
+    while the time and str columns are kept as they are.
+
+    Returns
+    -------
+    smooth : callable
+        smooth(data) returns the smoothed columns of the next chunk, see ResampledSensor.
+    """
+    values = resampled.value_indexes
+    smoother = smoothing.make_filter(filter_type, rolling_window_size, [resampled.formats[i] for i in values],
+                                     sampling_rate)
+
+    def smooth(data):
+        smoothed = dict(zip(values, smoother.apply([data[i] for i in values])))
+        return [smoothed[i] if i in smoothed else data[i] for i in range(len(data))]
 
-    smoothed_file = os.path.join(path, "smoothed_gps.txt")
-    # df = df.dropna()
+    return smooth
 
-    df = df[df.columns[0: -1]].rolling(rolling_window_size, min_periods=1).mean()
-    df[df.columns[0: 2]] = df[df.columns[0: 2]].astype(int)
-    df[df.columns[2]] = df[df.columns[2]].map('{:.14f}'.format)
-    df[df.columns[3]] = df[df.columns[3]].map('{:.14f}'.format)
-    df[df.columns[4]] = df[df.columns[4]].map('{:.2f}'.format)
-    df[df.columns[5]] = df[df.columns[5]].map('{:.2f}'.format)
 
-    df['provider'] = 'gps'
-    df.to_csv(smoothed_file, index=False)
+def aligned_column(sensor, column):
+    """
+    The name of a column of the given sensor in the aligned table, which tells the sensor,
+    e.g. 'raw_x_acc', 'gps_lat' or 'obd_Speed'.
+    """
+    return column if sensor in column else sensor + '_' + column
+
+
+def process_aligned(path, sensors, start_time, end_time, sampling_rate, rolling_window_size, output_format='csv',
+                    filter_type='mean'):
+    """
+    Resample all sensors of the trip onto the same time grid, and write them to one table,
+    i.e. constants.ALIGNED_FILE_NAME, e.g. 'aligned_sensors.txt'.
+
+    The table has the time grid in 'sys_time', followed by the resampled columns of all sensors,
+    and then the smoothed data of those columns, i.e. 'smoothed_raw_x_acc', 'smoothed_gps_lat', etc.
+    The time columns of each sensor are replaced by the shared 'sys_time', and str columns are dropped.
+
+    Parameters
+    ----------
+    path : str
+        The folder/dictionary of the data exists
+
+    sensors : list[str]
+        The sensors to be included, see get_sensors.
+
+    start_time, end_time, sampling_rate, rolling_window_size, output_format, filter_type :
+        See process_data.
+    """
+    streams = [resample_sensor(sensor, path, start_time, end_time, sampling_rate) for sensor in sensors]
+    columns = []
+    formats = []
+    for sensor, stream in zip(sensors, streams):
+        columns += [aligned_column(sensor, stream.columns[i]) for i in stream.value_indexes]
+        formats += [stream.formats[i] for i in stream.value_indexes]
+
+    num_rows = resample.num_resamples(start_time, end_time, sampling_rate)
+    smoother = smoothing.make_filter(filter_type, rolling_window_size, formats, sampling_rate)
+    with writer.open_table(path, constants.ALIGNED_FILE_NAME, ['sys_time'] + columns + ['smoothed_' + c for c in columns],
+                           [writer.INT] + formats + formats, output_format, num_rows) as table:
+        for begin in range(0, num_rows, resample.CHUNK_SIZE):
+            end = min(begin + resample.CHUNK_SIZE, num_rows)
+            values = []
+            for stream in streams:
+                data = stream.take(end - begin)
+                values += [data[i] for i in stream.value_indexes]
+            time_new = resample.time_grid_range(start_time, end_time, num_rows, begin, end)
+            table.write([time_new] + values + smoother.apply(values))
 
 
 def sub_dir_path(d):
@@ -362,25 +666,21 @@ def sub_dir_path(d):
     return filter(os.path.isdir, [os.path.join(d, f) for f in os.listdir(d)])
 
 
-def process_data_main(data_path, frequency, rolling_window_size=100):
+def find_trips(data_path):
     """
-    Parses the directory in the provided path and processes the individual sub-directories.
+    Find the trip folders to be processed under the given path, i.e. those with gps data.
 
     Parameters
     -----------
     data_path : str
         path of data folder to process
 
-    frequency : int/float
-        resampling frequency
+    Returns
+    -------
+    trips : list[str]
+        The paths of the trip folders
     """
-    # 100.0 // 5 = 20.0, instead of 20
-    # sampling_rate = str(int(1000 // frequency))
-    # https://stackoverflow.com/questions/17001389/pandas-resample-documentation
-    # http://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html
-    # 'L' or 'ms', stands for milliseconds
-    # sampling_rate = sampling_rate + 'L'
-
+    trips = []
     for root, folders, files in os.walk(data_path):
         if root == data_path:
             continue
@@ -397,9 +697,180 @@ def process_data_main(data_path, frequency, rolling_window_size=100):
         if not good:
             continue
 
-        # TODO: check if the folder has been preprocessed before or not
+        trips.append(root)
+    return trips
+
+
+def process_trip(args, hashed=True):
+    """
+    Call process_data on a single trip, and catch any error, so that one bad trip does not stop the others.
+
+    Parameters
+    -----------
+    args : tuple
+        (path, sampling_rate, rolling_window_size, num_workers, output_format, aligned, filter_type),
+        see process_data.
+        Packed in one tuple so that it can be mapped by a process pool.
+
+    hashed : boolean, default=True
+        If False, the content of the input files is not hashed, see manifest.input_fingerprints.
+
+    Returns
+    -------
+    result : tuple
+        (path, succeeded, elapsed seconds, error message or None, inputs, outputs),
+        where inputs are the fingerprints of the input files before they were processed,
+        and outputs are the names of the files written, see manifest.py.
+    """
+    path = args[0]
+    begin = time.time()
+    inputs = manifest.input_fingerprints(path, hashed)
+    outputs = []
+    try:
+        succeeded = process_data(*args)
+        error = None
+        outputs = manifest.output_files(path, writer.WRITERS[args[4]][0])
+    except Exception as e:
+        succeeded = False
+        error = "%s: %s" % (type(e).__name__, e)
+        if debug:
+            traceback.print_exc()
+    return path, succeeded, time.time() - begin, error, inputs, outputs
+
+
+def print_summary(results, seconds, num_skipped=0):
+    """
+    Print how many trips have been processed, and the errors of those that failed.
+
+    Parameters
+    -----------
+    results : list[tuple]
+        The results of process_trip
+
+    seconds : float
+        The total elapsed time
+
+    num_skipped : int, default=0
+        The number of trips skipped since they are unchanged
+    """
+    failed = [r for r in results if not r[1]]
+    print("preprocess: %d trips, %d succeeded, %d failed, %d unchanged, %.1f seconds" %
+          (len(results), len(results) - len(failed), len(failed), num_skipped, seconds))
+    if debug:
+        for result in sorted(results):
+            print("  %.1f s  %s" % (result[2], result[0]))
+    for result in failed:
+        print("  FAILED %s: %s" % (result[0], result[3] or "process_data returned False"))
+
+
+def preprocess_params(frequency, rolling_window_size, output_format='csv', aligned=False, filter_type='mean'):
+    """
+    The parameters that the output files of a trip depend on, as recorded in the manifest, see process_data_main.
+    """
+    return {'frequency': int(frequency), 'rolling_window_size': rolling_window_size, 'output_format': output_format,
+            'aligned': aligned, 'filter': filter_type, 'version': OUTPUT_VERSION}
+
+
+def process_data_main(data_path, frequency, rolling_window_size=100, num_workers=1, sensor_workers=1,
+                      output_format='csv', incremental=False, aligned=False, filter_type='mean'):
+    """
+    Parses the directory in the provided path and processes the individual sub-directories.
+
+    Parameters
+    -----------
+    data_path : str
+        path of data folder to process
+
+    frequency : int/float
+        resampling frequency
+
+    rolling_window_size : int, default=100
+        The sliding window size in data smoothing
 
-        process_data(root, int(frequency), rolling_window_size)
+    num_workers : int, default=1
+        The number of processes to process trips in parallel. 1 to process them one by one
+        in the current process, and 0 to use all CPUs.
+
+    sensor_workers : int, default=1
+        The number of processes to process the sensors of each trip in parallel, see process_data.
+        It is only used when trips are processed one by one, i.e. num_workers is 1.
+
+    output_format : str, default='csv'
+        The format of the output files, see writer.WRITERS
+
+    incremental : boolean, default=False
+        If True, skip the trips whose inputs and parameters are the same as when they were
+        preprocessed last time, see manifest.py. The inputs are only hashed if True.
+
+    aligned : boolean, default=False
+        If True, write one table with all sensors per trip, see process_aligned.
+
+    filter_type : str, default='mean'
+        The filter to smooth the data, see smoothing.FILTERS
+
+    Returns
+    -------
+    results : list[tuple]
+        The results of the trips processed, see process_trip
+    """
+    # 100.0 // 5 = 20.0, instead of 20
+    # sampling_rate = str(int(1000 // frequency))
+    # https://stackoverflow.com/questions/17001389/pandas-resample-documentation
+    # http://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html
+    # 'L' or 'ms', stands for milliseconds
+    # sampling_rate = sampling_rate + 'L'
+
+    begin = time.time()
+    if num_workers == 0:
+        num_workers = os.cpu_count() or 1
+    if sensor_workers == 0:
+        sensor_workers = os.cpu_count() or 1
+
+    trips = find_trips(data_path)
+    params = preprocess_params(frequency, rolling_window_size, output_format, aligned, filter_type)
+    records = manifest.Manifest(data_path)
+    num_skipped = 0
+    if incremental:
+        changed = [root for root in trips if not records.is_unchanged(root, params)]
+        num_skipped = len(trips) - len(changed)
+        trips = changed
+        if debug:
+            print("skip %d unchanged trips" % num_skipped)
+
+    # no more processes than trips, so that e.g. a single trip can still use sensor_workers
+    num_workers = min(num_workers, len(trips))
+    if num_workers > 1:
+        # processes of a pool cannot start processes of their own
+        sensor_workers = 1
+
+    tasks = [(root, int(frequency), rolling_window_size, sensor_workers, output_format, aligned, filter_type)
+             for root in trips]
+
+    results = []
+    if num_workers > 1:
+        if debug:
+            print("process %d trips with %d processes" % (len(tasks), num_workers))
+        pool = multiprocessing.Pool(num_workers)
+        # one trip at a time per process, since the trips differ a lot in size
+        trip_results = pool.imap_unordered(functools.partial(process_trip, hashed=incremental), tasks, chunksize=1)
+    else:
+        pool = None
+        trip_results = (process_trip(task, incremental) for task in tasks)
+
+    try:
+        for result in trip_results:
+            results.append(result)
+            path, succeeded, _, _, inputs, outputs = result
+            if succeeded:
+                # recorded as soon as each trip is done, so that an interrupted run is not wasted
+                records.update(path, params, inputs, outputs)
+    finally:
+        if pool:
+            pool.terminate()
+    records.save()
+
+    print_summary(results, time.time() - begin, num_skipped)
+    return results
 
 
 if __name__ == "__main__":
@@ -1,6 +1,7 @@
 import os
 
-import utils
+import sensor_cache
+from trip import get_trip
 
 
 def convert_to_map(list_str):
@@ -28,6 +29,23 @@ def convert_to_map(list_str):
     return key_value
 
 
+def pop_flag(list_str, flag):
+    """
+    Take a flag without value, e.g. '--plan', out of a list of strings of options,
+    so that the rest can be converted by convert_to_map.
+
+    Returns
+    -------
+    found : boolean
+        True if the flag is in the list
+
+    rest : list
+        The other strings, in the same order
+    """
+    rest = [s for s in list_str if s != flag]
+    return len(rest) != len(list_str), rest
+
+
 def valid_obd_file(obd_file):
     """
     Check if the content of the given OBD file is valid, i.e. header,
@@ -43,7 +61,7 @@ def valid_obd_file(obd_file):
     True if the content of the file is value; False, otherwise.
     """
     if not os.path.isfile(obd_file):
-        return False
+        return valid_obd_copy(obd_file)
 
     with open(obd_file, 'r') as fp:
         _ = fp.readline()
@@ -61,6 +79,25 @@ def valid_obd_file(obd_file):
     return True
 
 
+def valid_obd_copy(obd_file):
+    """
+    The same as valid_obd_file, but for the binary copy of the OBD file saved without the file,
+    see sensor_cache.save.
+    """
+    if not sensor_cache.exists(obd_file):
+        return False
+
+    try:
+        folder, filename = os.path.split(obd_file)
+        table = get_trip(folder).table(filename)
+        # assume that the first column is time or others that can be cast to float
+        _ = float(table[table.dtype.names[0]][0])
+    except:
+        return False
+
+    return True
+
+
 def valid_gps_file(gps_file, max_interval=None):
     """
     Check if the content of the given gps file is valid.
@@ -77,11 +114,12 @@ def valid_gps_file(gps_file, max_interval=None):
     ------
     True if the content of the file is value; False, otherwise.
     """
-    if not os.path.isfile(gps_file):
+    if not sensor_cache.exists(gps_file):
         return False
 
     try:
-        time_speed = utils.read_csv_file(gps_file, columns=[1, 4])  # time, speed
+        folder, filename = os.path.split(gps_file)
+        time_speed = get_trip(folder).read(filename, columns=[1, 4])  # time, speed
         if len(time_speed) == 0:
             return False
 
@@ -0,0 +1,178 @@
+"""
+The manifest of preprocessed trips, so that preprocess only processes the trips that are new
+or have been changed since they were preprocessed last time.
+
+The manifest is 'preprocessed_files.txt' under the data path, with one JSON record per line:
+    {"trip": path of the trip relative to the data path,
+     "params": the preprocess parameters, e.g. {"frequency": 200, "rolling_window_size": 50, ...},
+     "inputs": {file name: [size, mtime_ns, sha1 or null]},
+     "outputs": [file names]}
+
+Records are appended as trips are processed, and a later record of the same trip replaces
+the earlier one. A trip is unchanged if its parameters and the names, sizes and contents of
+its inputs are the same as recorded, and its outputs still exist. The content is only hashed
+again if the modification time has changed. The inputs are only hashed by incremental runs, and
+without the hash, a file whose modification time has changed is taken as changed.
+"""
+
+import hashlib
+import json
+import os
+
+import constants
+import sensor_cache
+
+debug = False
+
+INPUT_FILES = [constants.ACC_FILE_NAME, constants.GYRO_FILE_NAME, constants.MAGNET_FILE_NAME,
+               constants.ROTATION_FILE_NAME, constants.GRAVITY_FILE_NAME,
+               constants.GPS_FILE_NAME, constants.OBD_FILE_NAME]
+
+HASH_BLOCK_SIZE = 1024 * 1024  # bytes
+
+
+def file_hash(filename):
+    """
+    The sha1 of the content of the given file.
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(HASH_BLOCK_SIZE), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def input_fingerprints(path, hashed=True):
+    """
+    Get the fingerprints of the input files of the given trip, or of their binary copies if
+    there are only the copies, see sensor_cache.save.
+
+    Parameters
+    ----------
+    path : str
+        The folder of the trip
+
+    hashed : boolean, default=True
+        If False, the content is not hashed, and the sha1 is None.
+
+    Returns
+    -------
+    inputs : dict{file name: [size, mtime_ns, sha1]}
+    """
+    inputs = {}
+    for name in INPUT_FILES:
+        filename = sensor_cache.data_file(os.path.join(path, name))
+        if filename:
+            stat = os.stat(filename)
+            inputs[name] = [stat.st_size, stat.st_mtime_ns, file_hash(filename) if hashed else None]
+    return inputs
+
+
+def output_files(path, extension):
+    """
+    The resampled and smoothed files of the given trip, or its aligned table, with the given extension, e.g. '.txt'.
+    """
+    return sorted(f for f in os.listdir(path)
+                  if f.startswith(('resampled_', 'smoothed_', constants.ALIGNED_FILE_NAME)) and f.endswith(extension))
+
+
+class Manifest(object):
+    """
+    The records of the trips that have been preprocessed under a data path.
+    """
+
+    def __init__(self, data_path):
+        self.data_path = data_path
+        self.filename = os.path.join(data_path, constants.PREPROCESS_MANIFEST_FILE)
+        self.records = {}  # trip: record
+        self.load()
+
+    def trip_name(self, path):
+        return os.path.relpath(path, self.data_path)
+
+    def load(self):
+        """
+        Load the records. Lines that are not records, e.g. of older versions, are ignored.
+        """
+        self.records = {}
+        if not os.path.isfile(self.filename):
+            return
+        with open(self.filename, 'r') as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                    self.records[record['trip']] = record
+                except (ValueError, KeyError, TypeError):
+                    continue
+
+    def is_unchanged(self, path, params):
+        """
+        Check if the given trip has been preprocessed with the same parameters and inputs.
+
+        Parameters
+        ----------
+        path : str
+            The folder of the trip
+
+        params : dict
+            The preprocess parameters
+
+        Returns
+        -------
+        True if the trip does not need to be preprocessed again.
+        """
+        record = self.records.get(self.trip_name(path))
+        if not record or record.get('params') != params:
+            return False
+
+        filenames = {name: sensor_cache.data_file(os.path.join(path, name)) for name in INPUT_FILES}
+        names = [name for name in INPUT_FILES if filenames[name]]
+        if sorted(names) != sorted(record['inputs']):
+            return False
+
+        for name in names:
+            filename = filenames[name]
+            stat = os.stat(filename)
+            size, mtime_ns, sha1 = record['inputs'][name]
+            if stat.st_size != size:
+                return False
+            if stat.st_mtime_ns != mtime_ns:
+                # e.g. copied or touched
+                if sha1 is None or file_hash(filename) != sha1:
+                    return False
+                record['inputs'][name][1] = stat.st_mtime_ns
+
+        return all(os.path.isfile(os.path.join(path, f)) for f in record['outputs'])
+
+    def update(self, path, params, inputs, outputs):
+        """
+        Record that the given trip has been preprocessed, and append the record to the manifest.
+
+        Parameters
+        ----------
+        path : str
+            The folder of the trip
+
+        params : dict
+            The preprocess parameters
+
+        inputs : dict
+            The fingerprints of the inputs before they were preprocessed, see input_fingerprints.
+
+        outputs : list[str]
+            The names of the output files
+        """
+        record = {'trip': self.trip_name(path), 'params': params, 'inputs': inputs, 'outputs': outputs}
+        self.records[record['trip']] = record
+        with open(self.filename, 'a') as fp:
+            fp.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def save(self):
+        """
+        Rewrite the manifest with only the latest record of each trip.
+        """
+        temp_file = self.filename + '.%d.tmp' % os.getpid()
+        with open(temp_file, 'w') as fp:
+            for trip in sorted(self.records):
+                fp.write(json.dumps(self.records[trip], sort_keys=True) + '\n')
+        os.replace(temp_file, self.filename)
@@ -0,0 +1,303 @@
+"""
+Dry runs of preprocess and calibration, i.e. 'preprocess --plan' and 'calibration --plan'.
+
+They list the trips that would be processed with the same options, and the size of their input
+files, and estimate the outputs and the runtime without processing the trips:
+    - the output rows are the time range of each trip (see views.trip_time_range) times the
+      frequency, and their bytes are estimated by resampling and formatting the first
+      SAMPLE_SECONDS of each sensor. 'feather' and 'parquet' are estimated as uncompressed,
+      i.e. the same as 'npy'.
+    - the runtime is projected from the throughput measured by processing a copy of one of the
+      trips in a temporary folder, i.e. output rows per second for preprocess, whose time goes
+      mostly to resampling, smoothing and writing, and input bytes per second for calibration.
+
+Nothing is written to the trips, i.e. the files are parsed without saving their binary copies
+(see sensor_cache.writable), except in the temporary folder.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+import calibration
+import constants
+import file_process
+import manifest
+import resample
+import sensor_cache
+import views
+import writer
+from trip import trips as trip_cache
+
+debug = False
+
+# the data of each sensor resampled and formatted to estimate the bytes per row
+SAMPLE_SECONDS = 10
+
+# the largest trip copied to measure the throughput
+MEASURE_BYTES = 64 * 1024 * 1024
+
+MB = 1024.0 * 1024
+
+
+def input_bytes(path, files):
+    """
+    The total size of the given files of the trip that exist, or of their binary copies if there are
+    only the copies, see sensor_cache.save.
+    """
+    data_files = [sensor_cache.data_file(os.path.join(path, f)) for f in files]
+    return sum(os.path.getsize(f) for f in data_files if f)
+
+
+def column_bytes(values, fmt, output_format='csv'):
+    """
+    The average bytes per row of a column in the given output format, including the separator.
+    """
+    if output_format == 'csv':
+        return len(writer.format_lines([values], [fmt])) / float(len(values))
+    return writer.to_table(['column'], [values], [fmt]).itemsize
+
+
+def sample_sensor(sensor, path, start_time, end_time, frequency):
+    """
+    Resample the first SAMPLE_SECONDS of a sensor of the trip, or less if the trip is shorter.
+
+    Returns
+    -------
+    resampled : file_process.ResampledSensor
+
+    data : list[1-D array]
+        The resampled columns, None if there is no data.
+    """
+    if sensor in ('gps', 'obd'):
+        # they are read as a whole anyway, and might have no data at the beginning
+        resampled = file_process.resample_sensor(sensor, path, start_time, end_time, frequency,
+                                                 rows=(0, SAMPLE_SECONDS * frequency))
+    else:
+        # only the beginning of the file is parsed
+        resampled = file_process.resample_sensor(sensor, path, start_time,
+                                                 min(end_time, start_time + SAMPLE_SECONDS * 1000), frequency)
+    data = resampled.take(resampled.num_rows)
+    return resampled, (data if data and len(data[0]) else None)
+
+
+def plan_preprocess_trip(path, frequency, output_format='csv', aligned=False):
+    """
+    Estimate the outputs of preprocessing a single trip.
+
+    Returns
+    -------
+    plan : tuple
+        (path, input bytes, output rows, output bytes), where the output rows are those of
+        all output files.
+    """
+    size = input_bytes(path, manifest.INPUT_FILES)
+    start_time, end_time = views.trip_time_range(path)
+    num_rows = resample.num_resamples(start_time, end_time, frequency)
+    if num_rows == 0:
+        return path, size, 0, 0
+
+    # the time grid, i.e. 'sys_time' of the aligned table
+    row_bytes = column_bytes(resample.time_grid_range(start_time, end_time, num_rows, 0, min(num_rows, 1000)),
+                             writer.INT, output_format) if aligned else 0
+    num_files = 0
+    for sensor in file_process.get_sensors(path):
+        resampled, data = sample_sensor(sensor, path, start_time, end_time, frequency)
+        if data is None:
+            continue
+        if aligned:
+            # the resampled and smoothed value columns
+            row_bytes += 2 * sum(column_bytes(data[i], resampled.formats[i], output_format)
+                                 for i in resampled.value_indexes)
+        else:
+            # the resampled and smoothed files have the same columns
+            row_bytes += 2 * sum(column_bytes(col, fmt, output_format) for col, fmt in zip(data, resampled.formats))
+            num_files += 2
+
+    # the bytes of a row of each output file are added up
+    return path, size, num_rows * (1 if aligned else num_files), int(row_bytes * num_rows)
+
+
+def measure_seconds(plans, files, run):
+    """
+    Measure the time of processing a copy of one of the planned trips, i.e. the largest one
+    of at most MEASURE_BYTES, or the smallest one.
+
+    Parameters
+    ----------
+    plans : list[tuple]
+        (path, input bytes, output rows, output bytes) of each trip
+
+    files : list[str]
+        The names of the input files to be copied
+
+    run : callable
+        run(folder) processes the trip in the given folder.
+
+    Returns
+    -------
+    seconds : float, None if the trip fails.
+
+    plan : tuple
+        The plan of the trip measured
+    """
+    plans = sorted(plans, key=lambda plan: plan[1])
+    fits = [plan for plan in plans if plan[1] <= MEASURE_BYTES]
+    plan = fits[-1] if fits else plans[0]
+
+    folder = tempfile.mkdtemp(prefix='vehsense_plan_')
+    debug_flags = file_process.debug, calibration.debug
+    file_process.debug = calibration.debug = False
+    try:
+        for f in files:
+            filename = os.path.join(plan[0], f)
+            if os.path.isfile(filename):
+                shutil.copy2(filename, folder)
+            elif sensor_cache.exists(filename):
+                # only the binary copy, which stays valid when it is copied, see sensor_cache.is_standalone
+                shutil.copy2(sensor_cache.cache_path(filename), folder)
+                shutil.copy2(sensor_cache.key_path(filename), folder)
+        begin = time.time()
+        run(folder)
+        seconds = time.time() - begin
+    except Exception as e:
+        print("WARNING: failed to measure the throughput on %s: %s: %s" % (plan[0], type(e).__name__, e))
+        return None, plan
+    finally:
+        file_process.debug, calibration.debug = debug_flags
+        trip_cache.discard(folder)
+        shutil.rmtree(folder)
+    return max(seconds, 1e-3), plan
+
+
+def print_plan(name, data_path, plans, num_skipped, seconds=None, throughput='', num_workers=1):
+    """
+    Print the trips of a plan, the totals and the projected runtime.
+
+    Parameters
+    ----------
+    name : str
+        The command, e.g. 'preprocess'
+
+    plans : list[tuple]
+        (path, input bytes, output rows, output bytes) of each trip
+
+    num_skipped : int
+        The number of trips that would be skipped
+
+    seconds : float, default=None
+        The projected runtime of all trips in a single process, None if unknown.
+
+    throughput : str, default=''
+        The throughput that the runtime is projected from
+
+    num_workers : int, default=1
+        The number of processes
+    """
+    for path, size, num_rows, num_bytes in plans:
+        print("  %10.1f MB in  %12d rows  %10.1f MB out  %s" % (size / MB, num_rows, num_bytes / MB, path))
+
+    total_out = sum(plan[3] for plan in plans)
+    print("%s plan: %d trips, %d skipped, %.1f MB in, %d rows and %.1f MB out" %
+          (name, len(plans), num_skipped, sum(plan[1] for plan in plans) / MB, sum(plan[2] for plan in plans),
+           total_out / MB))
+
+    if seconds is not None:
+        # the trips are not split among processes, and processes do not run faster than the CPUs
+        num_workers = max(min(num_workers, len(plans), os.cpu_count() or 1), 1)
+        seconds /= num_workers
+        print("projected runtime: %.1f hours (%.0f s) with %d processes, %s" %
+              (seconds / 3600, seconds, num_workers, throughput))
+    else:
+        print("projected runtime: unknown")
+
+    free = shutil.disk_usage(data_path).free
+    print("free space: %.1f MB" % (free / MB))
+    if total_out > free:
+        print("WARNING: the outputs do not fit in the free space of %s" % data_path)
+
+
+def plan_preprocess(data_path, frequency, rolling_window_size=100, num_workers=1, output_format='csv',
+                    incremental=False, aligned=False, filter_type='mean'):
+    """
+    Dry run of file_process.process_data_main with the same parameters, see the top of this file.
+
+    Returns
+    -------
+    plans : list[tuple]
+        (path, input bytes, output rows, output bytes) of each trip to be processed
+    """
+    trips = file_process.find_trips(data_path)
+    records = manifest.Manifest(data_path)
+    params = file_process.preprocess_params(frequency, rolling_window_size, output_format, aligned, filter_type)
+    num_skipped = 0
+    if incremental:
+        changed = [root for root in trips if not records.is_unchanged(root, params)]
+        num_skipped = len(trips) - len(changed)
+        trips = changed
+
+    debug_flag, file_process.debug = file_process.debug, False
+    # a dry run, which does not write to the trips
+    writable_flag, sensor_cache.writable = sensor_cache.writable, False
+    plans = []
+    try:
+        for path in trips:
+            try:
+                plans.append(plan_preprocess_trip(path, int(frequency), output_format, aligned))
+            except Exception as e:
+                print("WARNING: %s would fail: %s: %s" % (path, type(e).__name__, e))
+    finally:
+        file_process.debug = debug_flag
+        sensor_cache.writable = writable_flag
+
+    seconds = None
+    throughput = ''
+    if plans:
+        measured, plan = measure_seconds(
+            plans, manifest.INPUT_FILES,
+            lambda folder: file_process.process_data(folder, int(frequency), rolling_window_size, 1,
+                                                     output_format, aligned, filter_type))
+        if measured is not None and plan[2] > 0:
+            rows_per_second = plan[2] / measured
+            seconds = sum(p[2] for p in plans) / rows_per_second
+            throughput = "at %d rows/s, measured on a copy of %s" % (rows_per_second, plan[0])
+
+    if num_workers == 0:
+        num_workers = os.cpu_count() or 1
+    print_plan('preprocess', data_path, plans, num_skipped, seconds, throughput, num_workers)
+    return plans
+
+
+def plan_calibration(data_path, require_obd, overwrite=False):
+    """
+    Dry run of calibration.calibration with the same parameters, see the top of this file.
+
+    Returns
+    -------
+    plans : list[tuple]
+        (path, input bytes, output rows, output bytes) of each trip to be calibrated, where the
+        output is one line of calibration parameters.
+    """
+    files = [constants.ACC_FILE_NAME, constants.GPS_FILE_NAME, constants.OBD_FILE_NAME]
+    plans = []
+    num_skipped = 0
+    for path in calibration.find_calibration_trips(data_path):
+        if not overwrite and os.path.isfile(os.path.join(path, constants.CALIBRATION_FILE_NAME)):
+            num_skipped += 1
+            continue
+        # 9 floats
+        plans.append((path, input_bytes(path, files), 1, 9 * 20))
+
+    seconds = None
+    throughput = ''
+    if plans:
+        measured, plan = measure_seconds(
+            plans, files, lambda folder: calibration.get_calibration_parameters(folder, require_obd, overwrite=True))
+        if measured is not None and plan[1] > 0:
+            bytes_per_second = plan[1] / measured
+            seconds = sum(p[1] for p in plans) / bytes_per_second
+            throughput = "at %.1f MB/s, measured on a copy of %s" % (bytes_per_second / MB, plan[0])
+
+    print_plan('calibration', data_path, plans, num_skipped, seconds, throughput)
+    return plans
@@ -1,8 +1,11 @@
 import os
 
-from helper import convert_to_map
+from helper import convert_to_map, pop_flag
 from clean import clean_file
 import file_process
+import planner
+import smoothing
+import writer
 
 
 debug = True
@@ -17,18 +20,44 @@ def preprocess(input_string, configs=None):
     input_string (str array): options for preprocess command which are directory and frequency.
     """
     if input_string == "syntax":
-        msg = """preprocess [-d directory] [-f frequency=200] [-c clean=False]
+        msg = """preprocess [-d directory] [-f frequency=200] [-w window=50] [-c clean=False] [-j jobs=1] [-s sensor_jobs=1]
+           [-fmt format=csv] [-i incremental=True] [-a aligned=False] [-ft filter=mean] [--plan]
 
     -d : The data path.
     -f : The interpolation rate. Default is 200 Hz.
+    -w : The sliding window size in data smoothing, see '-ft'. Default is 50.
     -c : True then call 'clean()' function first. Default is 'False'.
+    -j : The number of processes to preprocess trips in parallel. 0 to use all CPUs. Default is 1.
+    -s : The number of processes to preprocess the sensors of each trip in parallel, e.g. for
+         a single long trip. 0 to use all CPUs. Only used without '-j'. Default is 1.
+    -fmt : The format of the resampled and smoothed files, i.e. 'csv' (.txt), 'npy',
+           'feather' or 'parquet'. The last two require pyarrow. Default is 'csv'.
+    -i : True to skip the trips whose input files and the options above are unchanged since
+         they were preprocessed last time, as recorded in 'preprocessed_files.txt' under the
+         data path. False to preprocess all trips. Default is 'True'.
+    -a : True to write one table per trip, 'aligned_sensors', with the resampled and smoothed
+         columns of all sensors on the same time grid, instead of a pair of files per sensor.
+         Default is 'False'.
+    -ft : The filter to smooth the data, i.e. 'mean' (moving average of '-w' samples), 'ema'
+          (exponential moving average with span '-w'), or 'lowpass' (Butterworth low-pass
+          filter with cutoff frequency '-f' / '-w'). Time columns are not smoothed. Default is 'mean'.
+    --plan : Do not preprocess, but list the trips to be preprocessed with the options above, the
+             size of their inputs, the estimated rows and size of their outputs, and the projected
+             runtime (see planner.py). '-c' is ignored.
         """
         print(msg)
     else:
-        input_map = convert_to_map(input_string)
+        plan, options = pop_flag(input_string, '--plan')
+        input_map = convert_to_map(options)
         frequency = float(input_map.get('-f', 200))
         data_path = input_map.get('-d', None)
-        rolling_window_size = input_map.get('-w', 50)
+        rolling_window_size = int(input_map.get('-w', 50))
+        num_workers = int(input_map.get('-j', 1))
+        sensor_workers = int(input_map.get('-s', 1))
+        output_format = input_map.get('-fmt', 'csv').lower()
+        incremental = input_map.get('-i', 'true').lower() == 'true'
+        aligned = input_map.get('-a', 'false').lower() == 'true'
+        filter_type = input_map.get('-ft', 'mean').lower()
 
         if not data_path and configs:
             data_path = configs['data_path']
@@ -37,19 +66,46 @@ def preprocess(input_string, configs=None):
             print("ERROR: preprocess(): data path is not set")
             return
 
+        if not writer.is_available(output_format):
+            print("ERROR: preprocess(): output format '%s' is unknown, or the module it requires is not installed"
+                  % output_format)
+            return
+
+        if filter_type not in smoothing.FILTERS:
+            print("ERROR: preprocess(): filter '%s' is unknown, which should be one of %s"
+                  % (filter_type, smoothing.FILTERS))
+            return
+
+        if rolling_window_size < 1 or (filter_type == 'lowpass' and rolling_window_size < 3):
+            print("ERROR: preprocess(): window size %d is too small for filter '%s'"
+                  % (rolling_window_size, filter_type))
+            return
+
         clean_flag = input_map.get('-c', "false")
 
         if debug:
             print("interpolation rate %f Hz" % frequency)
             print("data path: %s" % data_path)
             print("clean: %s" % clean_flag)
+            print("processes: %d trips, %d sensors" % (num_workers, sensor_workers))
+            print("output format: %s" % output_format)
+            print("incremental: %s" % incremental)
+            print("aligned: %s" % aligned)
+            print("filter: %s, window size %d" % (filter_type, rolling_window_size))
+            print("plan only: %s" % plan)
+
+        if plan:
+            planner.plan_preprocess(data_path, frequency, rolling_window_size, num_workers, output_format,
+                                    incremental, aligned, filter_type)
+            return
 
         # TODO: accept more flags for clean
         if clean_flag.lower() == 'true':
             clean_options = ["-d", data_path]
             clean_file(clean_options)
 
-        file_process.process_data_main(data_path, frequency, rolling_window_size)
+        file_process.process_data_main(data_path, frequency, rolling_window_size, num_workers, sensor_workers,
+                                       output_format, incremental, aligned, filter_type)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,298 @@
+"""
+Linear interpolation of sensor data onto a new time grid.
+
+All columns of a sensor are interpolated together: the position of each new time point
+among the old ones is found once, and then used for every column. The results are
+exactly the same as calling numpy.interp on each column.
+
+Data that does not fit in memory, e.g. of a long trip, can be resampled block by block with
+StreamResampler, which gives exactly the same results. It can also resample only part of the
+time grid, from the old time points around that part, see bracket_times.
+"""
+
+import bisect
+
+import numpy as np
+
+# new time points resampled at a time by StreamResampler, which bounds its memory
+CHUNK_SIZE = 65536
+
+
+class InterpolationPositions(object):
+    """
+    Where each new time point falls among the old ones, to be reused for all columns.
+    """
+
+    def __init__(self, time_old, time_new):
+        """
+        Parameters
+        ----------
+        time_old : 1-D array
+            The sorted time points of the data, at least one.
+
+        time_new : 1-D array
+            The time points to interpolate at
+        """
+        time_old = np.asarray(time_old, dtype=np.float64)
+        time_new = np.asarray(time_new, dtype=np.float64)
+        if len(time_old) == 0:
+            raise ValueError("resample: no data to interpolate from")
+
+        self.num_old = len(time_old)
+        last = self.num_old - 1
+
+        # index of the last old point that is not later than each new point
+        index = np.searchsorted(time_old, time_new, side='right') - 1
+        self.before = index < 0
+        self.after = index >= last  # including exactly at the last old point
+        self.index = np.clip(index, 0, max(last - 1, 0))
+
+        if self.num_old > 1:
+            left = time_old[self.index]
+            self.exact = left == time_new
+            self.span = time_old[self.index + 1] - left
+            self.offset = time_new - left
+            self.offset_right = time_new - time_old[self.index + 1]
+
+    def apply(self, data):
+        """
+        Interpolate the given data at the new time points.
+
+        Parameters
+        ----------
+        data : 2-D array, shape=(number of old time points, number of columns)
+            Numeric columns
+
+        Returns
+        -------
+        resampled : 2-D array of float64, shape=(number of new time points, number of columns)
+        """
+        data = np.ascontiguousarray(data, dtype=np.float64)
+        if self.num_old == 1:
+            return np.repeat(data, len(self.index), axis=0)
+
+        y0 = data[self.index]
+        y1 = data[self.index + 1]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            slope = (y1 - y0) / self.span[:, np.newaxis]
+            resampled = slope * self.offset[:, np.newaxis] + y0
+
+            # the same special cases as numpy.interp
+            nan = np.isnan(resampled)
+            if nan.any():
+                # try from the other side
+                other = slope * self.offset_right[:, np.newaxis] + y1
+                resampled[nan] = other[nan]
+                nan = np.isnan(resampled) & (y0 == y1)
+                resampled[nan] = y0[nan]
+
+        resampled[self.exact] = y0[self.exact]
+        resampled[self.before] = data[0]
+        resampled[self.after] = data[-1]
+        return resampled
+
+
+def num_resamples(start_time, end_time, sampling_rate):
+    """
+    The number of new time points between start_time and end_time (ms), at the given rate (Hz).
+    """
+    return (end_time - start_time) // 1000 * sampling_rate
+
+
+def time_grid(start_time, end_time, sampling_rate):
+    """
+    The new time points between start_time and end_time (ms), at the given rate (Hz).
+    """
+    return np.linspace(start_time, end_time, num_resamples(start_time, end_time, sampling_rate))
+
+
+def time_grid_range(start_time, end_time, num, begin, end):
+    """
+    The new time points from begin to end (not included) of np.linspace(start_time, end_time, num),
+    computed in the same way as numpy does, without the others.
+    """
+    start = float(start_time)
+    stop = float(end_time)
+    delta = stop - start
+    time_new = np.arange(begin, end, dtype=np.float64)
+    if num > 1:
+        step = delta / (num - 1)
+        if step == 0:
+            time_new /= num - 1
+            time_new *= delta
+        else:
+            time_new *= step
+    else:
+        time_new *= delta
+    time_new += start
+    if num > 1 and end == num and end > begin:
+        time_new[-1] = stop
+    return time_new
+
+
+def grid_searchsorted(start_time, end_time, num, value, side='left'):
+    """
+    The same as np.searchsorted(np.linspace(start_time, end_time, num), value, side),
+    but only the time points around the value are computed.
+    """
+    if num <= 2:
+        return int(np.searchsorted(time_grid_range(start_time, end_time, num, 0, num), value, side))
+
+    step = (float(end_time) - float(start_time)) / (num - 1)
+    guess = int(np.clip(np.floor((value - start_time) / step), 0, num))
+    # the time points differ from start_time + i * step by rounding errors at most
+    begin = max(guess - 2, 0)
+    end = min(guess + 3, num)
+    return begin + int(np.searchsorted(time_grid_range(start_time, end_time, num, begin, end), value, side))
+
+
+def bracket_times(time_old, first_time, last_time):
+    """
+    The time range of the old data that the new time points within [first_time, last_time] are
+    interpolated from, i.e. from the last old time point not later than first_time, to the first
+    one not earlier than last_time. Interpolating the old data within that range gives exactly the
+    same results at those new time points as interpolating all of it.
+
+    Parameters
+    ----------
+    time_old : 1-D array
+        The sorted time points of the data, at least one.
+
+    first_time, last_time : float
+        The first and last new time points
+
+    Returns
+    -------
+    lo, hi : the time range, inclusive
+    """
+    # bisect only touches log(n) points, while np.searchsorted would copy a memory-mapped column
+    first = bisect.bisect_right(time_old, first_time) - 1
+    last = bisect.bisect_left(time_old, last_time)
+    return time_old[max(first, 0)], time_old[min(last, len(time_old) - 1)]
+
+
+def resample_columns(time_old, data, time_new):
+    """
+    Interpolate all columns of the given data at the new time points, in one pass.
+
+    Parameters
+    ----------
+    time_old : 1-D array
+        The sorted time points of the data
+
+    data : 2-D array, shape=(len(time_old), number of columns)
+        Numeric columns
+
+    time_new : 1-D array
+        The time points to interpolate at
+
+    Returns
+    -------
+    resampled : 2-D array of float64, shape=(len(time_new), number of columns)
+    """
+    return InterpolationPositions(time_old, time_new).apply(data)
+
+
+class StreamResampler(object):
+    """
+    Resample data that comes block by block, e.g. read from a long file, onto the time grid
+    between start_time and end_time, see time_grid.
+
+    A new time point is resampled as soon as a block reaches an old time point later than it.
+    Only the last old time point of each block is carried over to the next block, since the
+    new time points after it are interpolated from it and the points that follow. The results
+    are exactly the same as resample_columns on all data at once.
+    """
+
+    def __init__(self, start_time, end_time, sampling_rate, chunk_size=None, rows=None):
+        """
+        Parameters
+        ----------
+        start_time, end_time : int
+            The time range (ms)
+
+        sampling_rate : int
+            The new rate (Hz)
+
+        chunk_size : int, default=None
+            The most new time points resampled at a time. Default is CHUNK_SIZE.
+
+        rows : tuple(int, int), default=None
+            (begin, end), to resample only the new time points from begin to end (not included).
+            Default is all of them.
+        """
+        self.start_time = start_time
+        self.end_time = end_time
+        self.num = num_resamples(start_time, end_time, sampling_rate)
+        self.chunk_size = chunk_size or CHUNK_SIZE
+        begin, end = rows if rows is not None else (0, self.num)
+        self.next = max(begin, 0)  # the index of the next new time point
+        self.stop = min(end, self.num)
+        self.num_rows = max(self.stop - self.next, 0)  # the number of new time points to be resampled
+        self.last_time = None  # the last old time point so far, and its data
+        self.last_data = None
+
+    def bounds(self):
+        """
+        The first and last new time points to be resampled, see bracket_times.
+        """
+        if self.num_rows == 0:
+            raise ValueError("resample: no time point to resample")
+        first = time_grid_range(self.start_time, self.end_time, self.num, self.next, self.next + 1)[0]
+        last = time_grid_range(self.start_time, self.end_time, self.num, self.stop - 1, self.stop)[0]
+        return first, last
+
+    def feed(self, time_old, data):
+        """
+        Add the next block of data, and resample the new time points before its last time point.
+
+        Parameters
+        ----------
+        time_old : 1-D array
+            The sorted time points of the block, later than or the same as those of the previous blocks.
+
+        data : 2-D array, shape=(len(time_old), number of columns)
+            Numeric columns
+
+        Yields
+        ------
+        resampled : 2-D array of float64, shape=(at most chunk_size, number of columns)
+        """
+        if len(time_old) == 0:
+            return
+        time_old = np.asarray(time_old, dtype=np.float64)
+        data = np.asarray(data, dtype=np.float64)
+        if self.last_time is not None:
+            time_old = np.concatenate([self.last_time, time_old])
+            data = np.concatenate([self.last_data, data])
+        self.last_time = time_old[-1:]
+        self.last_data = data[-1:]
+        for resampled in self.resample(time_old, data, time_old[-1]):
+            yield resampled
+
+    def finish(self):
+        """
+        Resample the rest of the new time points, i.e. those not before the last old time point.
+
+        Yields
+        ------
+        resampled : 2-D array of float64, see feed.
+        """
+        if self.last_time is None:
+            raise ValueError("resample: no data to interpolate from")
+        for resampled in self.resample(self.last_time, self.last_data):
+            yield resampled
+
+    def resample(self, time_old, data, before=None):
+        """
+        Resample the next new time points, up to those before the given time if any.
+        """
+        while self.next < self.stop:
+            end = min(self.next + self.chunk_size, self.stop)
+            time_new = time_grid_range(self.start_time, self.end_time, self.num, self.next, end)
+            if before is not None:
+                time_new = time_new[:np.searchsorted(time_new, before, side='left')]
+                if len(time_new) == 0:
+                    return
+            yield InterpolationPositions(time_old, time_new).apply(data)
+            self.next += len(time_new)
@@ -0,0 +1,448 @@
+"""
+Binary cache of the data files within each trip folder.
+
+The first time a data file, e.g. 'raw_acc.txt', is parsed, a typed binary copy of it
+is saved next to it as a hidden sidecar, i.e. '.raw_acc.txt.npy', together with
+'.raw_acc.txt.key' which records the size and modification time of the source file, and
+which columns of the copy are in order, see is_sorted. Later reads load the binary copy directly,
+unless the source file has changed since.
+
+The copy is a numpy structured array, one field per column named after the header,
+so that it can be turned into a DataFrame or sliced by column name directly.
+
+The copy can also be saved without the data file, e.g. straight from the compressed chunks by
+'unzip --ingest' (see unzip.unzip_ingest_files), in which case it is the only copy of the data.
+Its key then only marks it as such and records its size, see is_standalone, so that it stays
+valid when the trip is copied or touched, and whether the cache is enabled or not.
+"""
+
+import os
+
+import numpy as np
+
+debug = False
+
+# set to False to always parse the text files
+enabled = True
+
+# set to False to use the binary copies that are up to date, but not to save new ones, e.g. for dry runs
+writable = True
+
+# bump it whenever the layout of the cached data changes, so that old copies are rebuilt
+CACHE_VERSION = 2
+
+CACHE_EXTENSION = '.npy'
+KEY_EXTENSION = '.key'
+
+
+def cache_path(filename):
+    """
+    The path of the binary copy of the given data file.
+    """
+    folder, name = os.path.split(filename)
+    return os.path.join(folder, '.' + name + CACHE_EXTENSION)
+
+
+def key_path(filename):
+    """
+    The path of the file that records which version of the data file has been cached.
+    """
+    folder, name = os.path.split(filename)
+    return os.path.join(folder, '.' + name + KEY_EXTENSION)
+
+
+def source_key(filename):
+    """
+    Get the key of the current version of the given file, i.e. cache version, size and mtime.
+    If the file does not exist, the key of its binary copy, which stands on its own then.
+    Raises OSError if neither exists.
+    """
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        stat = os.stat(cache_path(filename))
+        return '%d,%d,%d,copy' % (CACHE_VERSION, stat.st_size, stat.st_mtime_ns)
+    return '%d,%d,%d' % (CACHE_VERSION, stat.st_size, stat.st_mtime_ns)
+
+
+def standalone_key(npy_file):
+    """
+    The key of a binary copy saved without its data file, i.e. cache version, 'copy' and the size of the copy.
+    """
+    return '%d,copy,%d' % (CACHE_VERSION, os.path.getsize(npy_file))
+
+
+def is_standalone(filename):
+    """
+    Check if the binary copy of the given file has been saved without it, see save, and is the
+    only copy of the data then.
+
+    Only the mark in its key and its size are checked, not its mtime, so that the copy is still
+    valid after it has been copied, e.g. by backup.py, or touched. Nor is the cache version,
+    since such a copy cannot be rebuilt.
+    """
+    if os.path.isfile(filename):
+        return False
+    try:
+        with open(key_path(filename), 'r') as fp:
+            fields = fp.readline().strip().split(',')
+        return len(fields) == 3 and fields[1] == 'copy' and int(fields[2]) == os.path.getsize(cache_path(filename))
+    except (OSError, ValueError):
+        return False
+
+
+def is_fresh(filename):
+    """
+    Check if the binary copy of the given file exists and is up to date, or has been saved without
+    the file, see is_standalone.
+    """
+    if not os.path.isfile(filename):
+        return is_standalone(filename)
+    try:
+        with open(key_path(filename), 'r') as fp:
+            key = fp.readline().strip()
+        return key == source_key(filename) and os.path.isfile(cache_path(filename))
+    except OSError:
+        return False
+
+
+def is_sorted(filename, column):
+    """
+    Check if the given column of the binary copy of the given file is known to be non-decreasing,
+    as recorded when the copy was saved, e.g. so that rows can be found by binary search on it.
+    False if it is not, or it is not known.
+    """
+    try:
+        with open(key_path(filename), 'r') as fp:
+            lines = fp.read().splitlines()
+    except OSError:
+        return False
+    for line in lines[1:]:
+        if line.startswith('sorted='):
+            return column in line[len('sorted='):].split(',')
+    return False
+
+
+def sorted_columns(table):
+    """
+    The names of the numeric columns of the given structured array that are non-decreasing.
+    """
+    names = []
+    for name in table.dtype.names or ():
+        col = table[name]
+        if col.dtype.kind in 'iuf' and (len(col) < 2 or bool(np.all(col[1:] >= col[:-1]))):
+            names.append(name)
+    return names
+
+
+def exists(filename):
+    """
+    Check if the data of the given file exists, i.e. the file or a binary copy saved without it,
+    even if the cache is not enabled.
+    """
+    return os.path.isfile(filename) or is_standalone(filename)
+
+
+def use_copy(filename):
+    """
+    Check if the binary copy of the given file is to be read instead of the file, i.e. the cache is
+    enabled and the copy is up to date, or the copy is the only copy of the data, see is_standalone.
+    """
+    return is_standalone(filename) or (enabled and is_fresh(filename))
+
+
+def data_file(filename):
+    """
+    The file that holds the data of the given file, i.e. the file itself, or its binary copy if
+    it has been saved without it. None if neither exists.
+    """
+    if os.path.isfile(filename):
+        return filename
+    if exists(filename):
+        return cache_path(filename)
+    return None
+
+
+def load(filename, parser, mmap_mode=None):
+    """
+    Load the given data file from its binary copy, or parse it and save the copy.
+
+    Parameters
+    ----------
+    filename : str
+        The path of the data file
+
+    parser : callable
+        parser(filename) returns the content of the file as a structured array.
+        It is only called if there is no up-to-date binary copy.
+
+    mmap_mode : str, default=None
+        If given, e.g. 'r', the binary copy is memory-mapped instead of being read into memory.
+
+    Returns
+    -------
+    table : numpy structured array
+    """
+    if is_standalone(filename):
+        # nothing to parse again
+        return np.load(cache_path(filename), mmap_mode=mmap_mode)
+    if enabled and is_fresh(filename):
+        try:
+            return np.load(cache_path(filename), mmap_mode=mmap_mode)
+        except (OSError, ValueError):
+            pass  # broken copy, e.g. disk was full. Parse again below.
+
+    # the key of the version being parsed, since the file may change while it is parsed,
+    # e.g. an upload in progress, in which case the copy is stale and is rebuilt next time
+    try:
+        key = source_key(filename)
+    except OSError:
+        key = None
+    table = parser(filename)
+    if enabled and writable and save(filename, table, key) and mmap_mode:
+        return np.load(cache_path(filename), mmap_mode=mmap_mode)
+    return table
+
+
+def save(filename, table, key=None):
+    """
+    Save the binary copy of the given data file.
+
+    The copy is written to a temp file first and then renamed, so that readers never
+    see a half written copy. If the data file does not exist, the copy is keyed by itself, see is_standalone.
+
+    Parameters
+    ----------
+    filename : str
+        The path of the data file
+
+    table : numpy structured array
+        The content of the data file
+
+    key : str, default=None
+        The key of the version of the data file that table was read from, see source_key.
+        It should be taken before the file is read. Default is the key of the current version.
+
+    Returns
+    -------
+    True if the copy is saved; False, otherwise, e.g. the folder is read only.
+    """
+    standalone = not os.path.isfile(filename)
+    if key is None and not standalone:
+        key = source_key(filename)
+    npy_file = cache_path(filename)
+    temp_file = npy_file + '.%d.tmp' % os.getpid()
+    try:
+        with open(temp_file, 'wb') as fp:
+            np.save(fp, table, allow_pickle=False)
+        os.replace(temp_file, npy_file)
+        if standalone:
+            key = standalone_key(npy_file)
+        write_key(filename, key, sorted_columns(table))
+    except (OSError, ValueError) as e:
+        if debug:
+            print("cannot cache %s: %s" % (filename, e))
+        if os.path.isfile(temp_file):
+            os.remove(temp_file)
+        return False
+
+    return True
+
+
+def write_key(filename, key, sorted_names):
+    """
+    Write the key of the binary copy of the given data file, and the names of its columns that are
+    non-decreasing, see is_sorted.
+    """
+    with open(key_path(filename), 'w') as fp:
+        fp.write(key + '\n')
+        fp.write('sorted=' + ','.join(sorted_names) + '\n')
+
+
+class CopyWriter(object):
+    """
+    Save the binary copy of a data file block by block, e.g. as it is parsed from the compressed
+    chunks (see unzip.unzip_ingest_files), so that the whole copy is never in memory.
+
+    The blocks are written one after another into a temporary file first, since the number of rows
+    and the types of the columns, e.g. int in one block and float in another, are only known at last.
+    They are then copied one by one into the copy, which is memory-mapped.
+    """
+
+    def __init__(self, filename):
+        """
+        Parameters
+        ----------
+        filename : str
+            The path of the data file, which does not need to exist
+        """
+        self.filename = filename
+        self.blocks_file = cache_path(filename) + '.%d.blocks.tmp' % os.getpid()
+        self.fp = None
+        self.dtypes = []  # of each block
+        self.num_rows = 0
+        self.sorted = None  # the names of the columns in order so far
+        self.last_row = None
+
+    @property
+    def num_blocks(self):
+        return len(self.dtypes)
+
+    def append(self, table):
+        """
+        Add the next block of rows, a structured array with the same column names as the others.
+        """
+        if self.fp is None:
+            self.fp = open(self.blocks_file, 'wb')
+        np.save(self.fp, table, allow_pickle=False)
+        self.dtypes.append(table.dtype)
+        self.num_rows += len(table)
+
+        in_order = set(sorted_columns(table))
+        if self.sorted is not None:
+            in_order &= self.sorted
+            if self.last_row is not None and len(table):
+                in_order = set(name for name in in_order if self.last_row[name] <= table[name][0])
+        self.sorted = in_order
+        if len(table):
+            self.last_row = {name: table[name][-1] for name in in_order}
+
+    def read_blocks(self):
+        """
+        The blocks added, one at a time.
+        """
+        with open(self.blocks_file, 'rb') as fp:
+            for _ in self.dtypes:
+                yield np.load(fp, allow_pickle=False)
+
+    def merged_dtype(self):
+        """
+        The types of the columns of the copy, i.e. of the whole data file, given those of the blocks:
+        int and float are merged into float, and str with anything into str, as pandas.read_csv does.
+        """
+        names = self.dtypes[0].names
+        types = {name: [dtype[name] for dtype in self.dtypes] for name in names}
+        fields = {}
+        lengths = {}
+        for name in names:
+            if all(t == types[name][0] for t in types[name]):
+                fields[name] = types[name][0]
+            elif any(t.kind == 'U' for t in types[name]):
+                lengths[name] = 1
+            else:
+                fields[name] = np.result_type(*types[name])
+
+        if lengths:
+            # the longest value as str, see to_table
+            for dtype, block in zip(self.dtypes, self.read_blocks()):
+                for name in lengths:
+                    if dtype[name].kind == 'U':
+                        lengths[name] = max(lengths[name], dtype[name].itemsize // 4)
+                    elif len(block):
+                        lengths[name] = max(lengths[name], int(np.char.str_len(block[name].astype(str)).max()))
+            for name, length in lengths.items():
+                fields[name] = np.dtype('U%d' % length)
+        return np.dtype([(name, fields[name]) for name in names])
+
+    def close(self, key=None):
+        """
+        Save the copy from the blocks added, see save.
+
+        Parameters
+        ----------
+        key : str, default=None
+            The key of the version of the data file that the blocks were read from, see source_key.
+            Default is None, i.e. the copy is saved without the data file, see is_standalone.
+
+        Returns
+        -------
+        True if the copy is saved; False, otherwise, e.g. there is no block, or the folder is read only.
+        """
+        npy_file = cache_path(self.filename)
+        temp_file = npy_file + '.%d.tmp' % os.getpid()
+        try:
+            if self.fp is None:
+                return False
+            self.fp.close()
+            dtype = self.merged_dtype()
+            if self.num_rows == 0:
+                with open(temp_file, 'wb') as fp:
+                    np.save(fp, np.empty(0, dtype=dtype), allow_pickle=False)
+            else:
+                table = np.lib.format.open_memmap(temp_file, mode='w+', dtype=dtype, shape=(self.num_rows,))
+                begin = 0
+                for block in self.read_blocks():
+                    for name in dtype.names:
+                        table[name][begin: begin + len(block)] = block[name]
+                    begin += len(block)
+                table.flush()
+                del table
+            os.replace(temp_file, npy_file)
+            write_key(self.filename, key or standalone_key(npy_file),
+                      [name for name in dtype.names if name in self.sorted])
+        except (OSError, ValueError) as e:
+            if debug:
+                print("cannot cache %s: %s" % (self.filename, e))
+            if os.path.isfile(temp_file):
+                os.remove(temp_file)
+            return False
+        finally:
+            self.abort()
+        return True
+
+    def abort(self):
+        """
+        Remove the blocks added, without saving the copy.
+        """
+        if self.fp is not None:
+            self.fp.close()
+        if os.path.isfile(self.blocks_file):
+            os.remove(self.blocks_file)
+
+
+def to_table(names, cols):
+    """
+    Build a structured array from columns.
+
+    Parameters
+    ----------
+    names : list[str]
+        The names in the header. It can be longer or shorter than the number of columns,
+        and missing, empty or repeated names are replaced by 'f' + column index.
+
+    cols : list[numpy array]
+        1-D arrays of the same length. Columns that are not numeric are stored as str.
+
+    Returns
+    -------
+    table : numpy structured array
+    """
+    fields = []
+    typed_cols = []
+    for i, col in enumerate(cols):
+        name = names[i].strip() if i < len(names) else ''
+        if not name or name in [f[0] for f in fields]:
+            name = 'f%d' % i
+        if col.dtype.kind not in 'iuf':
+            col = col.astype(str)
+        fields.append((name, col.dtype))
+        typed_cols.append(col)
+
+    table = np.empty(len(cols[0]) if cols else 0, dtype=fields)
+    for (name, _), col in zip(fields, typed_cols):
+        table[name] = col
+    return table
+
+
+def remove_cache(root):
+    """
+    Remove all binary copies under the given directory and all its sub folders, except those
+    saved without their data files, which are the only copies of the data.
+    """
+    for _root, _, files in os.walk(root):
+        for f in files:
+            for extension in (CACHE_EXTENSION, KEY_EXTENSION):
+                if f.startswith('.') and f.endswith(extension):
+                    if os.path.isfile(os.path.join(_root, f[1:-len(extension)])):
+                        os.remove(os.path.join(_root, f))
+                    break
@@ -0,0 +1,277 @@
+"""
+Smoothing of the resampled data, block by block.
+
+The filters, see make_filter:
+    mean    : moving average of the last window_size values, see MovingAverage
+    ema     : exponential moving average with span window_size, see ExponentialMovingAverage
+    lowpass : Butterworth low-pass filter, cut off at sampling_rate / window_size, see LowPassFilter
+
+All of them take O(n) time, and carry their state from one block to the next, so that smoothing
+a trip block by block gives exactly the same results as smoothing it at once. They smooth the
+values as they are written to the files, i.e. ints, or floats with a fixed number of decimals
+(see writer.round_column).
+
+The moving average adds up those values exactly as integers in units of the last decimal, and
+divides each sum once, so each average only depends on the values within its window. The other
+filters depend on all the values before, which fade away exponentially, see warmup_size.
+"""
+
+import numpy as np
+import scipy.signal
+
+import writer
+
+debug = False
+
+FILTERS = ['mean', 'ema', 'lowpass']
+
+# the order of the Butterworth low-pass filter
+LOWPASS_ORDER = 4
+
+# the values before a row that 'ema' and 'lowpass' take into account, in windows, see warmup_size
+WARMUP_WINDOWS = 20
+
+
+def make_filter(filter_type, window_size, formats, sampling_rate):
+    """
+    Create a filter to smooth columns block by block.
+
+    Parameters
+    ----------
+    filter_type : str
+        One of FILTERS
+
+    window_size : int
+        The size of the moving window. The span of 'ema', and sampling_rate / window_size is
+        the cutoff frequency of 'lowpass'.
+
+    formats : list
+        The format of each column to be smoothed, i.e. writer.INT or the number of decimals of float.
+
+    sampling_rate : int
+        The rate of the data, Hz
+
+    Returns
+    -------
+    smoother : object with apply(data), see MovingAverage.apply
+    """
+    if filter_type == 'mean':
+        return MovingAverage(window_size, formats)
+    if filter_type == 'ema':
+        return ExponentialMovingAverage(window_size, formats)
+    if filter_type == 'lowpass':
+        return LowPassFilter(sampling_rate / float(window_size), sampling_rate, formats)
+    raise ValueError("unknown filter: %s" % filter_type)
+
+
+def warmup_size(filter_type, window_size):
+    """
+    The number of rows before the first one to be smoothed that the filter needs to go through,
+    e.g. to smooth only part of a trip.
+
+    With them, the moving average is exactly the same as that of the whole trip. The influence of
+    the earlier values on 'ema' is (1 - 2 / (window_size + 1)) ** (WARMUP_WINDOWS * window_size),
+    i.e. about 4e-18, and that on 'lowpass' is less than 3e-9 (window_size of 3) or 3e-14 (4 or more).
+    """
+    if filter_type == 'mean':
+        return window_size - 1
+    return WARMUP_WINDOWS * window_size
+
+
+class MovingAverage(object):
+    """
+    The average of each value and the (window_size - 1) values before it, or of all the values
+    before it at the beginning, i.e. the same windows as DataFrame.rolling(window_size, min_periods=1).
+
+    Each window is added up exactly, as the difference of two running sums of the integers,
+    and the last (window_size - 1) rows of each block are carried over to the next block.
+    The sums are Python ints where they could pass int64.
+    """
+
+    def __init__(self, window_size, formats):
+        """
+        Parameters
+        ----------
+        window_size : int
+
+        formats : list
+            The format of each column, i.e. writer.INT or the number of decimals of float.
+        """
+        self.window_size = window_size
+        self.formats = formats
+        # the integers of the last (window_size - 1) rows, and whether they are valid
+        self.units = np.zeros((0, len(formats)), dtype=np.int64)
+        self.valid = np.zeros((0, len(formats)), dtype=bool)
+
+    def apply(self, data):
+        """
+        Smooth the next rows.
+
+        Parameters
+        ----------
+        data : list[1-D array]
+            The next rows of each column, which are rounded by their formats first.
+
+        Returns
+        -------
+        smoothed : list[1-D array]
+            The averages of each column. Ints are truncated as astype(int) does, i.e. int64,
+            and floats are the nearest float64 to the exact averages, NaN where the window
+            has no valid value.
+        """
+        units = np.empty((len(data[0]), len(self.formats)), dtype=np.int64)
+        valid = np.ones(units.shape, dtype=bool)
+        for i, (col, fmt) in enumerate(zip(data, self.formats)):
+            if fmt == writer.INT:
+                units[:, i] = np.asarray(col).astype(np.int64)
+            else:
+                units[:, i], valid[:, i] = writer.fixed_units(col, fmt)
+
+        carried = len(self.units)
+        units = np.concatenate([self.units, units])
+        valid = np.concatenate([self.valid, valid])
+        kept = len(units) - min(len(units), self.window_size - 1)
+        self.units = units[kept:]
+        self.valid = valid[kept:]
+
+        if np.abs(units.astype(np.float64)).max(initial=0) * len(units) >= 2.0 ** 62:
+            units = units.astype(object)
+        sums = window_sums(units, self.window_size)[carried:]
+        counts = window_sums(valid.astype(np.int64), self.window_size)[carried:]
+        return [average(sums[:, i], counts[:, i], fmt) for i, fmt in enumerate(self.formats)]
+
+
+def window_sums(values, window_size):
+    """
+    The sums of each row and the (window_size - 1) rows before it, see moving_average.
+    """
+    sums = np.cumsum(values, axis=0)
+    sums[window_size:] = sums[window_size:] - sums[:-window_size]
+    return sums
+
+
+def average(sums, counts, fmt):
+    """
+    The averages of integer sums, in the given format, see MovingAverage.apply.
+
+    Each one is a single division, which is rounded to the nearest float64 like the other
+    divisions of floats, e.g. those of DataFrame.rolling().mean(), i.e. an average of 10.995
+    (2 decimals) is the float 10.995, which is a bit less than that, and written as 10.99.
+    """
+    empty = counts == 0
+    scale = 1 if fmt == writer.INT else 10 ** fmt
+    counts = np.where(empty, 1, counts)
+    if sums.dtype == object or np.abs(sums).max(initial=0) > writer.MAX_EXACT_INT \
+            or counts.max(initial=0) * scale > writer.MAX_EXACT_INT:
+        # the true division of Python ints is rounded once
+        averages = (sums.astype(object) / (counts.astype(object) * scale)).astype(np.float64)
+    else:
+        averages = sums / (counts * float(scale))
+    if fmt == writer.INT:
+        return averages.astype(np.int64)
+    averages[empty] = np.nan
+    return averages
+
+
+class LinearFilter(object):
+    """
+    A filter of second-order sections applied to each column, see scipy.signal.sosfilt,
+    whose state is carried over from one block to the next.
+
+    The state starts as if the first value had been there forever, so that the output does
+    not ramp up from 0.
+    """
+
+    def __init__(self, sos, formats):
+        """
+        Parameters
+        ----------
+        sos : 2-D array, shape=(number of sections, 6)
+            The second-order sections of the filter
+
+        formats : list
+            The format of each column, i.e. writer.INT or the number of decimals of float.
+        """
+        self.sos = sos
+        self.formats = formats
+        self.states = None  # per column, shape=(number of sections, 2)
+
+    def apply(self, data):
+        """
+        Smooth the next rows.
+
+        Parameters
+        ----------
+        data : list[1-D array]
+            The next rows of each column, which are rounded by their formats first.
+
+        Returns
+        -------
+        smoothed : list[1-D array of float64]
+        """
+        values = [writer.round_column(col, fmt).astype(np.float64) for col, fmt in zip(data, self.formats)]
+        if self.states is None:
+            if len(values[0]) == 0:
+                return values
+            steady = scipy.signal.sosfilt_zi(self.sos)
+            self.states = [steady * col[0] for col in values]
+
+        smoothed = []
+        for i, col in enumerate(values):
+            col, self.states[i] = scipy.signal.sosfilt(self.sos, col, zi=self.states[i])
+            smoothed.append(col)
+        return smoothed
+
+
+class ExponentialMovingAverage(LinearFilter):
+    """
+    y[i] = y[i - 1] + alpha * (x[i] - y[i - 1]), where alpha = 2 / (span + 1), and y[0] = x[0],
+    i.e. DataFrame.ewm(span=span, adjust=False).mean().
+    """
+
+    def __init__(self, span, formats):
+        alpha = 2.0 / (span + 1)
+        # b = [alpha, 0, 0], a = [1, alpha - 1, 0]
+        sos = np.array([[alpha, 0.0, 0.0, 1.0, alpha - 1.0, 0.0]])
+        super(ExponentialMovingAverage, self).__init__(sos, formats)
+
+
+class LowPassFilter(LinearFilter):
+    """
+    Butterworth low-pass filter of order LOWPASS_ORDER.
+    """
+
+    def __init__(self, cutoff, sampling_rate, formats):
+        """
+        Parameters
+        ----------
+        cutoff : float
+            The cutoff frequency, Hz, less than half of the sampling rate.
+
+        sampling_rate : int
+            The rate of the data, Hz
+        """
+        sos = scipy.signal.butter(LOWPASS_ORDER, cutoff, btype='lowpass', output='sos', fs=sampling_rate)
+        super(LowPassFilter, self).__init__(sos, formats)
+
+
+def moving_average(data, window_size):
+    """
+    The average of each row and the (window_size - 1) rows before it, or of all the rows
+    before it at the beginning, from the cumulative sums of the rows.
+
+    Parameters
+    ----------
+    data : 2-D array
+
+    window_size : int
+
+    Returns
+    -------
+    averages : 2-D array of float64, the same shape as data
+    """
+    data = np.asarray(data, dtype=np.float64)
+    sums = np.cumsum(data, axis=0)
+    sums[window_size:] = sums[window_size:] - sums[:-window_size]
+    counts = np.minimum(np.arange(1, len(data) + 1), window_size)
+    return sums / counts.reshape((-1,) + (1,) * (data.ndim - 1))
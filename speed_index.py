@@ -0,0 +1,266 @@
+"""
+Speed of a trip over time, for looking up the speed at given time points or within given periods.
+
+The speeds are read from the OBD file of the trip, or from the gps file if the OBD file
+has no speed. They are kept as sorted int64 timestamps (ms) and float speeds (km/h),
+together with the cumulative sums of the speeds, so that each lookup is a binary search
+and the average within a period does not need to add up the speeds in it.
+Lookups are done for arrays of times or periods at once, e.g. for all events of a trip.
+"""
+
+import numpy as np
+import pandas as pd
+
+import constants
+
+debug = False
+
+# gps speed is looked up this much earlier than the given time, as utils.get_speed_gps has done
+GPS_DELAY = 1000  # ms
+
+
+class SpeedSeries(object):
+    """
+    Speeds (km/h) of a single source, sorted by time.
+    """
+
+    def __init__(self, times, speeds):
+        """
+        Parameters
+        ----------
+        times : array-like, type=int
+            Timestamps in ms. They do not need to be sorted.
+
+        speeds : array-like, type=float
+            Speeds in km/h, at the same length as times
+        """
+        times = np.asarray(times, dtype=np.int64)
+        speeds = np.asarray(speeds, dtype=np.float64)
+        order = np.argsort(times, kind='stable')
+        self.times = times[order]
+        self.speeds = speeds[order]
+        self.cumsum = np.concatenate(([0.0], np.cumsum(self.speeds)))
+
+    def __len__(self):
+        return len(self.times)
+
+    def positions(self, timestamps):
+        """
+        The positions of the first samples later than the given times, -1 for those that
+        have no such sample. The same as utils.look_for_time_position on each of them.
+
+        Parameters
+        ----------
+        timestamps : array-like, type=int
+            Times in ms, in any order
+
+        Returns
+        -------
+        positions : numpy array, type=int64
+        """
+        pos = np.searchsorted(self.times, np.asarray(timestamps, dtype=np.int64), side='right')
+        pos[pos >= len(self.times)] = -1
+        return pos
+
+    def position(self, timestamp):
+        """
+        The position of the first sample later than the given time, or -1 if there is no such sample.
+        """
+        return int(self.positions([timestamp])[0])
+
+    def speeds_at(self, timestamps):
+        """
+        The speeds of the first samples later than the given times, -1.0 for those that have no such sample.
+
+        Returns
+        -------
+        speeds : numpy array, type=float64
+        """
+        pos = self.positions(timestamps)
+        if len(self.speeds) == 0:
+            return np.full(len(pos), -1.0)
+        return np.where(pos == -1, -1.0, self.speeds[pos])
+
+    def speed_at(self, timestamp):
+        """
+        The speed of the first sample later than the given time, or -1.0 if there is no such sample.
+        """
+        return float(self.speeds_at([timestamp])[0])
+
+    def average_speeds(self, starts, ends):
+        """
+        The average speeds within the given periods, see average_speed.
+
+        Parameters
+        ----------
+        starts : array-like, type=int
+            The start times in ms
+
+        ends : array-like, type=int
+            The end times in ms, at the same length as starts
+
+        Returns
+        -------
+        speeds : numpy array, type=float64
+        """
+        start_pos = self.positions(starts)
+        end_pos = self.positions(ends)
+        out_of_range = (start_pos == -1) | (end_pos == -1)
+        count = end_pos - start_pos + 1
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # nan for periods without samples, the same as the mean of an empty slice
+            speeds = np.where(count > 0, (self.cumsum[end_pos + 1] - self.cumsum[start_pos]) / count, np.nan)
+        speeds[out_of_range] = -1.0
+        return speeds
+
+    def average_speed(self, start, end):
+        """
+        The average speed from the first sample later than start to the first sample later than end,
+        both included, in the same way as utils.average_speed.
+
+        Returns
+        -------
+        Return -1.0 if either of them is out of the time range.
+        """
+        return float(self.average_speeds([start], [end])[0])
+
+
+class SpeedIndex(object):
+    """
+    The speed of a trip, from the OBD file, or from the gps file if OBD has no speed.
+    """
+
+    def __init__(self, obd=None, gps=None):
+        """
+        Parameters
+        ----------
+        obd : SpeedSeries, default=None
+            Speed from the OBD file, None if the file has no valid speed.
+
+        gps : SpeedSeries, default=None
+            Speed from the gps file, None if there is no gps file.
+        """
+        self.obd = obd
+        self.gps = gps
+
+    @classmethod
+    def from_trip(cls, trip):
+        """
+        Build the index from the OBD and gps files of the given trip (see trip.Trip).
+        """
+        obd = None
+        if trip.has_file(constants.OBD_FILE_NAME):
+            obd = obd_speed_series(trip.obd)
+        gps = None
+        if trip.has_file(constants.GPS_FILE_NAME):
+            gps = gps_speed_series(trip.gps)
+        if debug:
+            print("speed index of %s: %d obd, %d gps samples" %
+                  (trip.path, len(obd) if obd else 0, len(gps) if gps else 0))
+        return cls(obd, gps)
+
+    def speeds_at(self, timestamps):
+        """
+        Get the speeds (km/h) at the given times.
+
+        The speed of the first OBD sample later than each given time is used. As utils.get_speed
+        has done, if it is not available, or it is 0, the speed of the first gps sample later
+        than one second before the given time is used instead.
+
+        Parameters
+        ----------
+        timestamps : array-like, type=int
+            The times in ms
+
+        Returns
+        -------
+        speeds : numpy array, type=float64, unit km/h
+            -1.0 for the times whose speed can not be retrieved.
+        """
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        speeds = np.full(len(timestamps), -1.0)
+        if self.obd:
+            speeds = self.obd.speeds_at(timestamps)
+
+        missing = (speeds == -1.0) | (speeds == 0)
+        if self.gps and missing.any():
+            speeds[missing] = self.gps.speeds_at(timestamps[missing] - GPS_DELAY)
+        speeds[speeds == 0] = -1.0
+        return speeds
+
+    def speed_at(self, timestamp):
+        """
+        Get the speed (km/h) at the given time (ms), see speeds_at.
+
+        Returns
+        -------
+        speed : float, unit km/h
+            Return -1.0 if no speed can be retrieved.
+        """
+        return float(self.speeds_at([timestamp])[0])
+
+    def average_speeds(self, starts, ends):
+        """
+        Get the average speeds (km/h) between the given start and end times (ms), from OBD,
+        or from gps for the periods that OBD does not cover. See SpeedSeries.average_speed.
+
+        Returns
+        -------
+        speeds : numpy array, type=float64
+            -1.0 for the periods whose speed can not be retrieved.
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        speeds = np.full(len(starts), -1.0)
+        if self.obd:
+            speeds = self.obd.average_speeds(starts, ends)
+
+        missing = speeds == -1.0
+        if self.gps and missing.any():
+            speeds[missing] = self.gps.average_speeds(starts[missing], ends[missing])
+        return speeds
+
+    def average_speed(self, start, end):
+        """
+        Get the average speed (km/h) between the given times (ms), see average_speeds.
+
+        Returns
+        -------
+        Return -1.0 if no speed can be retrieved.
+        """
+        return float(self.average_speeds([start], [end])[0])
+
+
+def obd_speed_series(table):
+    """
+    Build the speed series from the content of an OBD file (see utils.read_csv_table), whose
+    'Speed' column is like '12km/h'. Samples with missing speed are skipped.
+
+    Returns
+    -------
+    None if the speed column is missing or its first value is empty, see utils.obd_file_with_valid_speed.
+    """
+    lower_names = [name.lower() for name in table.dtype.names or []]
+    if len(table) == 0 or 'timestamp' not in lower_names or 'speed' not in lower_names:
+        return None
+
+    times = table[table.dtype.names[lower_names.index('timestamp')]]
+    speeds = table[table.dtype.names[lower_names.index('speed')]].astype(str)
+    if not speeds[0].strip():
+        return None
+
+    speeds = pd.to_numeric(pd.Series(speeds).str.split('km/h').str[0], errors='coerce').to_numpy()
+    valid = ~np.isnan(speeds)
+    return SpeedSeries(times[valid], speeds[valid])
+
+
+def gps_speed_series(table):
+    """
+    Build the speed series from the content of a gps file (see utils.read_csv_table),
+    i.e. the 'system_time' and speed (m/s) columns.
+    """
+    names = table.dtype.names
+    if len(table) == 0 or len(names) < 5:
+        return None
+
+    return SpeedSeries(table[names[1]], table[names[4]].astype(np.float64) * 3.6)
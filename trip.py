@@ -0,0 +1,242 @@
+"""
+A single trip, i.e. the data folder containing 'raw_acc.txt', 'gps.txt', etc.
+
+The data of a trip is loaded lazily, i.e. each file is read the first time it is needed,
+and kept in memory afterward. Trips are shared through a process wide LRU cache, so that
+running several commands over the same trips in one session reads each file only once.
+"""
+
+import os
+from collections import OrderedDict
+
+import constants
+import sensor_cache
+import utils
+from speed_index import SpeedIndex
+
+debug = False
+
+
+class Trip(object):
+    """
+    The data of a single trip.
+
+    Each file is read at most once, unless it has been changed since it was read.
+    """
+
+    def __init__(self, path, cache=None):
+        """
+        Parameters
+        ----------
+        path : str
+            The folder of the trip
+
+        cache : TripCache, default=None
+            The cache that holds this trip, which is told whenever more data is loaded.
+        """
+        self.path = path
+        self.cache = cache
+        self._loaded = {}  # name: (key of the source file, data)
+        self._speed_index = None  # (keys of the obd and gps files, SpeedIndex)
+
+    def __repr__(self):
+        return "Trip(%s)" % self.path
+
+    def file(self, filename):
+        """
+        The full path of the given file within this trip.
+        """
+        return os.path.join(self.path, filename)
+
+    def has_file(self, filename):
+        """
+        Check if the given file exists within this trip, or only its binary copy, see sensor_cache.save.
+        """
+        return sensor_cache.exists(self.file(filename))
+
+    def source_key(self, filename):
+        """
+        The key of the current version of the given file (see sensor_cache.source_key), None if it does not exist.
+        """
+        try:
+            return sensor_cache.source_key(self.file(filename))
+        except OSError:
+            return None
+
+    def load(self, filename, loader):
+        """
+        Load the given file with the given loader, or return what has been loaded before
+        if the file has not been changed since.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the file within this trip, e.g. constants.GPS_FILE_NAME
+
+        loader : callable
+            loader(full_path) returns the data of the file.
+        """
+        full_path = self.file(filename)
+        key = sensor_cache.source_key(full_path)
+        loaded = self._loaded.get(filename)
+        if loaded and loaded[0] == key:
+            return loaded[1]
+
+        if debug:
+            print("load %s" % full_path)
+        data = loader(full_path)
+        self._loaded[filename] = (key, data)
+        if self.cache:
+            self.cache.shrink(keep=self)
+        return data
+
+    def table(self, filename):
+        """
+        The content of the given data file as a structured array, see utils.read_csv_table.
+        """
+        return self.load(filename, utils.read_csv_table)
+
+    def read(self, filename, columns=None):
+        """
+        The same as utils.read_csv_file, but from the data kept in memory.
+        """
+        return utils.select_columns(self.table(filename), columns)
+
+    @property
+    def acc(self):
+        return self.table(constants.ACC_FILE_NAME)
+
+    @property
+    def gyro(self):
+        return self.table(constants.GYRO_FILE_NAME)
+
+    @property
+    def mag(self):
+        return self.table(constants.MAGNET_FILE_NAME)
+
+    @property
+    def rot(self):
+        return self.table(constants.ROTATION_FILE_NAME)
+
+    @property
+    def grav(self):
+        return self.table(constants.GRAVITY_FILE_NAME)
+
+    @property
+    def gps(self):
+        return self.table(constants.GPS_FILE_NAME)
+
+    @property
+    def obd(self):
+        return self.table(constants.OBD_FILE_NAME)
+
+    @property
+    def speed_index(self):
+        """
+        The speed of this trip over time (see speed_index.SpeedIndex), rebuilt if the obd or gps file has changed.
+        """
+        keys = (self.source_key(constants.OBD_FILE_NAME), self.source_key(constants.GPS_FILE_NAME))
+        if self._speed_index is None or self._speed_index[0] != keys:
+            self._speed_index = (keys, SpeedIndex.from_trip(self))
+        return self._speed_index[1]
+
+    @property
+    def calibration_parameters(self):
+        """
+        [Ix, Iy, Iz, Jx, Jy, Jz, Kx, Ky, Kz], or None if the trip has not been calibrated.
+        """
+        if not self.has_file(constants.CALIBRATION_FILE_NAME):
+            return None
+        return self.load(constants.CALIBRATION_FILE_NAME, read_calibration_parameters)
+
+    @property
+    def nbytes(self):
+        """
+        The memory used by the loaded data. Memory-mapped data is not counted.
+        """
+        return sum(getattr(data, 'nbytes', 0) for _, data in self._loaded.values()
+                   if not hasattr(data, 'filename'))
+
+    def clear(self):
+        """
+        Drop all loaded data.
+        """
+        self._loaded.clear()
+        self._speed_index = None
+
+
+def read_calibration_parameters(filename):
+    """
+    Read the calibration parameters, i.e. one line of 9 comma separated floats, which might be quoted.
+    """
+    with open(filename, 'r') as fp:
+        line = fp.readline()
+    return [float(p) for p in line.replace('"', '').rstrip().split(',')]
+
+
+class TripCache(object):
+    """
+    Least recently used trips, whose total memory is kept under the given size.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.trips = OrderedDict()  # path: Trip, from the least recently used one
+
+    def get(self, path):
+        """
+        Get the trip of the given folder, which becomes the most recently used one.
+        """
+        path = os.path.abspath(path)
+        trip = self.trips.get(path)
+        if trip is None:
+            trip = Trip(path, cache=self)
+            self.trips[path] = trip
+        else:
+            self.trips.move_to_end(path)
+        return trip
+
+    def discard(self, path):
+        """
+        Drop the trip of the given folder, e.g. after the folder has been moved or deleted.
+        """
+        self.trips.pop(os.path.abspath(path), None)
+
+    def clear(self):
+        self.trips.clear()
+
+    @property
+    def nbytes(self):
+        return sum(trip.nbytes for trip in self.trips.values())
+
+    def shrink(self, keep=None):
+        """
+        Drop the least recently used trips till the total memory is under the limit.
+
+        Parameters
+        ----------
+        keep : Trip, default=None
+            The trip that should not be dropped, e.g. the one being used.
+        """
+        total = self.nbytes
+        for path in list(self.trips):
+            if total <= self.max_bytes:
+                break
+            trip = self.trips[path]
+            if trip is keep:
+                continue
+            if debug:
+                print("drop %s from memory" % trip)
+            total -= trip.nbytes
+            del self.trips[path]
+
+
+# shared by all commands within the same process
+trips = TripCache(constants.TRIP_CACHE_SIZE)
+
+
+def get_trip(path):
+    """
+    Get the trip of the given folder from the process wide cache.
+    """
+    return trips.get(path)
@@ -7,18 +7,27 @@ Tested in Python 3.6
 """
 
 import gzip
+import io
+import multiprocessing
 import sys
 import traceback
 import os
 import pickle
+import shutil
 from collections import defaultdict
-import time
+from contextlib import redirect_stdout
 # import textwrap
 
+import chunk_merge
+import sensor_cache
+import utils
 from helper import convert_to_map
 
 debug = True
 
+# bytes decompressed and written at a time, so that the memory does not grow with the size of the file
+BLOCK_SIZE = 1024 * 1024
+
 def decompress_file(input_string, configs=None):
     """
     Decompress a given file. Generate a new file within the same address,
@@ -26,11 +35,21 @@ def decompress_file(input_string, configs=None):
     """
     # TODO: handle exception FileNotFoundError properly
     if input_string == "syntax":
-        info = """unzip [-f filename] [-d directory] [--compress-type='.zip'] [--delete=False] [--merge=True] [--delete-unzip=True].
+        info = """unzip [-f filename] [-d directory] [--compress-type='.zip'] [--delete=False] [--merge=True] [--delete-unzip=True]
+          [--fused=False] [--ingest=False] [--keep-text=True] [-j jobs=1].
           filename has to include the full path.
           If --delete is set to be True, then the original compressed file(s) will be deleted after decompression.
-          If --merge is "rue, then files with the same prefix will be merged after decompression.
-          if --delete-unzip is True, then uncompressed files will be deleted after merge."""
+          If --merge is "True", then files with the same prefix will be merged after decompression, ordered by time.
+          if --delete-unzip is True, then uncompressed files will be deleted after merge.
+          If --fused is True, then files with the same prefix are decompressed directly into the merged file,
+          without uncompressed file of each, and the repeated headers are dropped. --merge and --delete-unzip
+          are not used then.
+          If --ingest is True, then files with the same prefix are decompressed, merged and parsed into the binary
+          copy of the merged file (see sensor_cache.py) at once, so that the merged file does not need to be parsed
+          by other commands. If --keep-text is False, then the merged file is not written, and the binary copy is
+          the only copy of the data. --merge, --delete-unzip and --fused are not used then.
+          -j is the number of processes to unzip folders in parallel, 0 to use all CPUs. The output of each
+          folder is printed as it is done, followed by a report of all folders."""
         # wrapper = textwrap.TextWrapper(width=70)
         # print(wrapper.fill(info))
         print(info)
@@ -57,15 +76,21 @@ def decompress_file(input_string, configs=None):
     delete_after_decompress = options.get('--delete', "False")
     delete_unzip = options.get('--delete-unzip', "True")
     merge = options.get('--merge', "True")
+    fused = options.get('--fused', "False")
+    ingest = options.get('--ingest', "False")
+    keep_text = options.get('--keep-text', "True")
+    num_workers = int(options.get('-j', 1))
 
     if debug:
-        print('--delete=%s, --merge=%s, --delete-unzip=%s' % (delete_after_decompress, merge, delete_unzip))
+        print('--delete=%s, --merge=%s, --delete-unzip=%s, --fused=%s, --ingest=%s, --keep-text=%s, -j=%d'
+              % (delete_after_decompress, merge, delete_unzip, fused, ingest, keep_text, num_workers))
 
     if filename:
         unzip_file(filename, delete_after_decompress, compress_type)
         return
     mypath = dirname
-    process_directory(mypath, delete_after_decompress, compress_type, merge, delete_unzip)
+    process_directory(mypath, delete_after_decompress, compress_type, merge, delete_unzip, fused, num_workers,
+                      ingest, keep_text)
     # Merge files
     # if merge == "True":
     #     merge_directories(mypath, delete_unzip)
@@ -89,7 +114,8 @@ def merge_directories(mypath, delete_unzip):
             merge_single_directory(root, delete_unzip)
 
 
-def process_directory(mypath, delete_after_decompress, compress_type, merge, delete_unzip):
+def process_directory(mypath, delete_after_decompress, compress_type, merge, delete_unzip, fused="False",
+                      num_workers=1, ingest="False", keep_text="True"):
     """
     unzip all files under given directionry and all its sub directories
 
@@ -103,63 +129,198 @@ def process_directory(mypath, delete_after_decompress, compress_type, merge, del
 
     compress_type : str
         The extension for the compressed files.
+
+    fused : str, "True" or "False", default="False"
+        If "True", then decompress the files directly into the merged files, see unzip_merge_directory.
+
+    num_workers : int, default=1
+        The number of processes to unzip folders in parallel. 1 to unzip them one by one in the
+        current process, and 0 to use all CPUs.
+
+    ingest : str, "True" or "False", default="False"
+        If "True", then decompress the files directly into the binary copies of the merged files,
+        see unzip_ingest_files.
+
+    keep_text : str, "True" or "False", default="True"
+        If "False", then do not write the merged files when ingest is "True".
+
+    Returns
+    -------
+    results : list[tuple]
+        The results of the folders, see process_single_directory
     """
-    data_type = ['acc', 'obd', 'gps', 'gyro', 'mag']
-    for root, _, files in os.walk(mypath):
-        if not files:
-            continue
+    tasks = [(root, files, delete_after_decompress, compress_type, merge, delete_unzip, fused, ingest, keep_text)
+             for root, _, files in os.walk(mypath) if files]
 
-        counter = defaultdict(int)
+    if num_workers == 0:
+        num_workers = os.cpu_count() or 1
+    num_workers = min(num_workers, len(tasks))
+
+    results = []
+    if num_workers > 1:
         if debug:
-            print("unzip: deal with %s" % root)
-
-        # ignore folders that have all files uncompressed
-        uncompressed_before = True
-        for d_type in data_type:
-            got_one = False
-            for _file in files:
-                if d_type + ".txt" in _file:
-                    got_one = True
-                    break
-            if not got_one:
-                uncompressed_before = False
+            print("unzip %d folders with %d processes" % (len(tasks), num_workers))
+        pool = multiprocessing.Pool(num_workers)
+        # one folder at a time per process, since the folders differ a lot in size
+        folder_results = pool.imap_unordered(unzip_directory_task, tasks, chunksize=1)
+    else:
+        pool = None
+        folder_results = (process_single_directory(*task) for task in tasks)
+
+    try:
+        for result in folder_results:
+            # the output of a process is printed as a whole, so that the folders are not mixed up
+            if pool:
+                print(result[4], end='')
+            results.append(result)
+    finally:
+        if pool:
+            pool.terminate()
+
+    print_report(results)
+    return results
+
+
+def unzip_directory_task(args):
+    """
+    Call process_single_directory in a process of a pool, with its output captured instead of printed.
+
+    Parameters
+    ----------
+    args : tuple
+        The parameters of process_single_directory.
+        Packed in one tuple so that it can be mapped by a process pool.
+
+    Returns
+    -------
+    result : tuple
+        See process_single_directory, with the output, including the error if any, as the last one.
+    """
+    output = io.StringIO()
+    with redirect_stdout(output):
+        try:
+            result = process_single_directory(*args)
+        except Exception as e:
+            # so that one bad folder does not stop the others
+            print("ERROR: unzip %s: %s: %s" % (args[0], type(e).__name__, e))
+            if debug:
+                traceback.print_exc(file=sys.stdout)
+            result = (args[0], {}, [], False)
+    return result[:4] + (output.getvalue(),)
+
+
+def process_single_directory(root, files, delete_after_decompress, compress_type, merge, delete_unzip,
+                             fused="False", ingest="False", keep_text="True"):
+    """
+    unzip all files in a single folder, without its sub folders, see process_directory.
+
+    Parameters
+    ----------
+    root : str
+        The folder (full path) to be dealt with
+
+    files : list[str]
+        The names of the files in the folder
+
+    Returns
+    -------
+    result : tuple
+        (root, counter, missing, unzipped before, output), where counter is the number of compressed
+        files of each data type, missing are the messages of the missing files (see report_missing_files),
+        and output is always '' here, see unzip_directory_task.
+    """
+    data_type = ['acc', 'obd', 'gps', 'gyro', 'mag']
+    counter = defaultdict(int)
+    missing = []
+    # decompressed directly into the merged files, or their binary copies
+    fused = "True" if ingest.lower() == "true" else fused
+    if debug:
+        print("unzip: deal with %s" % root)
+
+    # ignore folders that have all files uncompressed
+    uncompressed_before = True
+    for d_type in data_type:
+        got_one = False
+        for _file in files:
+            if d_type + ".txt" in _file:
+                got_one = True
                 break
+        if not got_one:
+            uncompressed_before = False
+            break
+
+    if uncompressed_before:
+        print("\tUnzipped before. Pass")
+        return root, dict(counter), missing, True, ''
+
+    compressed_files = []
+    for fil in files:
+        # important: delete (possible) old txt files so that they won't get merge again
+        if fil.endswith('.txt'):
+            for prefix in data_type:
+                if prefix in fil:
+                    fullname = os.path.join(root, fil)
+                    os.remove(fullname)
+                    break
 
-        if uncompressed_before:
-            print("\tUnzipped before. Pass")
+        elif fil.endswith(compress_type):
+            # TODO: only deal with certain type of data that we are interested
+            for prefix in data_type:
+                if prefix in fil:
+                    counter[prefix] += 1
+                    break
+            fil = os.path.join(root, fil)
+            if fused.lower() == "true":
+                compressed_files.append(fil)
+            else:
+                unzip_file(fil, delete_after_decompress, compress_type)
+        elif fil.startswith('.') and fil.endswith((sensor_cache.CACHE_EXTENSION, sensor_cache.KEY_EXTENSION)):
+            # binary copies, see sensor_cache.py
             continue
+        else:
+            # some unexpected files exist
+            print("unexpected file: %s" %  fil)
 
-        for fil in files:
-            # important: delete (possible) old txt files so that they won't get merge again
-            if fil.endswith('.txt'):
-                for prefix in data_type:
-                    if prefix in fil:
-                        fullname = os.path.join(root, fil)
-                        os.remove(fullname)
-                        break
-
-            elif fil.endswith(compress_type):
-                # TODO: only deal with certain type of data that we are interested
-                for prefix in data_type:
-                    if prefix in fil:
-                        counter[prefix] += 1
-                        break
-                fil = os.path.join(root, fil)
-                unzip_file(fil, delete_after_decompress, compress_type)
-            else:
-                # some unexpected files exist
-                print("unexpected file: %s" %  fil)
+    if fused.lower() == "true":
+        missing = unzip_merge_directory(root, compressed_files, delete_after_decompress, compress_type, ingest,
+                                        keep_text)
 
-        print('\t', counter, end=", total: ")
-        print(sum(counter.values()))
-        if merge.lower() == "true":
-            merge_single_directory(root, delete_unzip)
+    print('\t', counter, end=", total: ")
+    print(sum(counter.values()))
+    if merge.lower() == "true" and fused.lower() != "true":
+        missing = merge_single_directory(root, delete_unzip)
+    return root, dict(counter), missing, False, ''
+
+
+def print_report(results):
+    """
+    Print the number of compressed files of each data type in all folders, and the missing files of each folder.
+
+    Parameters
+    ----------
+    results : list[tuple]
+        The results of the folders, see process_single_directory
+    """
+    total = defaultdict(int)
+    for _, counter, _, _, _ in results:
+        for prefix, count in counter.items():
+            total[prefix] += count
+    print("unzip: %d folders, %d unzipped before, %s, total: %d"
+          % (len(results), sum(1 for r in results if r[3]), dict(total), sum(total.values())))
+    for root, _, missing, _, _ in sorted(results):
+        for msg in missing:
+            print("  %s: %s" % (root, msg))
 
 
 def unzip_file(fil, delete_after_decompress, compress_type):
     """
     unzip a single file.
 
+    The file is decompressed block by block into a temporary file next to it, which is renamed
+    to the uncompressed file once it is complete. If the original compressed file is to be deleted,
+    the uncompressed file is synced to disk first, so that the data is not lost if the machine
+    goes down in between.
+
     Parameters
     ----------
     fil : str
@@ -170,40 +331,367 @@ def unzip_file(fil, delete_after_decompress, compress_type):
 
     compress_type : str
         The extension of the compressed file
+
+    Returns
+    -------
+    True if the file has been uncompressed; False, otherwise.
     """
     if not os.path.isfile(fil):
         print("unzip_file: ERROR: file %s does NOT exist" % fil)
-        return
+        return False
+
+    delete = delete_after_decompress.lower() == "true"
+    uncompressed_filename = fil[:-len(compress_type)]
+    temp_filename = uncompressed_filename + '.part'
     try:
-        zip_file = gzip.open(fil)
-        data_lines = zip_file.readlines()
-        uncompressed_filename = fil[:-len(compress_type)]
-        fp = open(uncompressed_filename, "wb")
-        fp.writelines(data_lines)
-        # with open(uncompressed_filename, "wb") as fp:
-        #     fp.writelines(data_lines)
-        fp.close()
-
-        # to wait for slow disk writing
-        # otherwise, some files won't get unzipped and saved properly
-        # the length of the sleep can be adjusted though.
-        while not fp.closed:
-            time.sleep(0.5)
-            continue
+        with gzip.open(fil, 'rb') as zip_file, open(temp_filename, 'wb') as fp:
+            shutil.copyfileobj(zip_file, fp, BLOCK_SIZE)
+            if delete:
+                fp.flush()
+                os.fsync(fp.fileno())
+        os.replace(temp_filename, uncompressed_filename)
+        if delete:
+            sync_directory(os.path.dirname(uncompressed_filename))
+    except Exception as e:
+        print("exception happens in unzip %s: %s: %s" % (fil, type(e).__name__, e))
+        if os.path.isfile(temp_filename):
+            os.remove(temp_filename)
+        return False
+
+    if delete:
+        if debug:
+            print("deleting ", fil)
+        os.remove(fil)
+    return True
+
+
+def unzip_merge_directory(file_path, compressed_files, delete_after_decompress, compress_type, ingest="False",
+                          keep_text="True"):
+    """
+    Decompress the files with the same prefix under the given path directly into the merged file,
+    in the same order as merge_single_directory, without the uncompressed file of each.
+
+    Parameters
+    ----------
+    file_path : str
+        Folder to deal with
+
+    compressed_files : list[str]
+        The full paths of the compressed files
+
+    delete_after_decompress : str, "True" or "False"
+        If "True", then delete the original compressed files after they are merged
+
+    compress_type : str
+        The extension of the compressed files
+
+    ingest : str, "True" or "False", default="False"
+        If "True", then also save the binary copy of the merged file, see unzip_ingest_files.
+
+    keep_text : str, "True" or "False", default="True"
+        If "False", then only save the binary copy when ingest is "True".
+
+    Returns
+    -------
+    missing : list[str]
+        The messages of the missing files, see report_missing_files
+    """
+    data_type = ['acc', 'obd', 'gps', 'gyro', 'mag']
+
+    compressed_files_dict = defaultdict(list)
+    for fil in compressed_files:
+        file_name = os.path.basename(fil)
+        for prefix in data_type:
+            if prefix in file_name:
+                compressed_files_dict[prefix].append(fil)
+                break
+
+    missing = []
+    for prefix, files in compressed_files_dict.items():
+        files = sorted(files, key=lambda x: get_int_from_str(os.path.basename(x)))
+        missing.extend(report_missing_files(prefix, files))
+        if ingest.lower() == "true":
+            unzip_ingest_files(files, merged_file_name(file_path, prefix), delete_after_decompress, keep_text)
+        else:
+            unzip_merge_files(files, merged_file_name(file_path, prefix), delete_after_decompress)
+    return missing
+
 
-        if delete_after_decompress.lower() == "true":
+def unzip_merge_files(files, merged_file, delete_after_decompress):
+    """
+    Decompress the given files into the merged file line by line, ordered by time, see merge_files.
+
+    A file that cannot be decompressed till the end is merged up to the error, and kept even if
+    delete_after_decompress is "True". The merged file is synced to disk before the compressed files
+    are deleted, see unzip_file.
+
+    Parameters
+    ----------
+    files : list[str]
+        The full paths of the compressed files, sorted by get_int_from_str
+
+    merged_file : str
+        The full path of the merged file
+
+    delete_after_decompress : str, "True" or "False"
+        If "True", then delete the compressed files after they are merged
+
+    Returns
+    -------
+    merged : list[str]
+        The files that have been merged
+    """
+    delete = delete_after_decompress.lower() == "true"
+    report = merge_files(files, merged_file, lambda fil: gzip.open(fil, 'rb'), delete)
+    merged = [fil for fil in files if fil not in report.failed]
+
+    if delete:
+        for fil in merged:
             if debug:
                 print("deleting ", fil)
             os.remove(fil)
+    return merged
 
-    except:
-        print("exception happens in unzip %s" % fil)
+
+class IngestStream(object):
+    """
+    The merged file as it is written by chunk_merge.merge_chunks, see unzip_ingest_files. The lines are
+    written to the merged file, if any, and parsed block by block into the binary copy at the same time.
+    """
+
+    def __init__(self, fp, parser, copy):
+        """
+        Parameters
+        ----------
+        fp : binary file object
+            The merged file, None if it is not written
+
+        parser : utils.CsvBlockParser
+
+        copy : sensor_cache.CopyWriter
+        """
+        self.fp = fp
+        self.parser = parser
+        self.copy = copy
+
+    def write(self, data):
+        if self.fp is not None:
+            self.fp.write(data)
+        for table in self.parser.feed(data):
+            self.copy.append(table)
+
+    def writelines(self, lines):
+        self.write(b''.join(lines))
+
+    def close(self):
+        """
+        Parse the rest of the lines.
+        """
+        for table in self.parser.close():
+            self.copy.append(table)
+
+
+def unzip_ingest_files(files, merged_file, delete_after_decompress, keep_text="True"):
+    """
+    Decompress and merge the given files (see chunk_merge.py), and parse the merged lines block by block
+    into the binary copy of the merged file (see sensor_cache.CopyWriter) in the same pass, in the same
+    way as when the merged file is read the first time (see utils.CsvBlockParser), so that it never needs
+    to be parsed. Only a block of the merged lines is in memory at a time.
+
+    If keep_text is "False", then the merged file is not written, and the binary copy is the only copy
+    of the data. The compressed files are kept if the copy cannot be saved then, or there is no data.
+    A merged file left by an earlier run is removed then, since the copy replaces it.
+    Either way, the merged file and the copy are synced to disk before the compressed files are deleted.
+
+    Parameters
+    ----------
+    files : list[str]
+        The full paths of the compressed files, sorted by get_int_from_str
+
+    merged_file : str
+        The full path of the merged file, e.g. 'raw_acc.txt'
+
+    delete_after_decompress : str, "True" or "False"
+        If "True", then delete the compressed files after they are merged
+
+    keep_text : str, "True" or "False", default="True"
+        If "True", then also write the merged file.
+
+    Returns
+    -------
+    merged : list[str]
+        The files that have been merged
+    """
+    delete = delete_after_decompress.lower() == "true"
+    keep = keep_text.lower() == "true"
+    temp_filename = merged_file + '.part'
+    copy = sensor_cache.CopyWriter(merged_file)
+    parser = utils.CsvBlockParser(is_gps=os.path.basename(merged_file).startswith('gps'))
+    fp = open(temp_filename, 'wb') if keep else None
+    try:
+        stream = IngestStream(fp, parser, copy)
+        report = chunk_merge.merge_chunks(files, stream, lambda fil: gzip.open(fil, 'rb'), merged_file,
+                                          default_time_column(merged_file))
+        stream.close()
+        if fp is not None and delete:
+            fp.flush()
+            os.fsync(fp.fileno())
+    except Exception:
+        copy.abort()
+        if fp is not None:
+            fp.close()
+            os.remove(temp_filename)
+        raise
+    finally:
+        if fp is not None:
+            fp.close()
+    report.print_report()
+    merged = [fil for fil in files if fil not in report.failed]
+
+    if keep:
+        os.replace(temp_filename, merged_file)
+
+    if copy.num_blocks == 0:
+        copy.abort()
+        print("WARNING: no data in %s" % merged_file)
+        if not keep:
+            return []
+    elif not copy.close(sensor_cache.source_key(merged_file) if keep else None):
+        print("ERROR: cannot save the binary copy of %s" % merged_file)
+        if not keep:
+            return []
+    elif not keep:
+        if os.path.isfile(merged_file):
+            os.remove(merged_file)
+        if delete:
+            for filename in (sensor_cache.cache_path(merged_file), sensor_cache.key_path(merged_file)):
+                sync_file(filename)
+
+    if delete:
+        sync_directory(os.path.dirname(merged_file))
+        for fil in merged:
+            if debug:
+                print("deleting ", fil)
+            os.remove(fil)
+    return merged
+
+
+def default_time_column(merged_file):
+    """
+    The index of the time column of the merged file if its chunks have no header, see chunk_merge.merge_chunks.
+    """
+    # obd has no 'sys_time', and its 'timestamp' is the system time
+    return 0 if os.path.basename(merged_file) == "raw_obd.txt" else 1
+
+
+def merge_files(files, merged_file, open_file, sync=False):
+    """
+    Merge the given files into the merged file, line by line and ordered by time, see chunk_merge.py,
+    and print the lines out of order, if any.
+
+    The merged file is written to a temporary file first, which is renamed to the merged file once
+    it is complete.
+
+    Parameters
+    ----------
+    files : list[str]
+        The full paths of the files, sorted by get_int_from_str, which is the order of lines of the same time.
+
+    merged_file : str
+        The full path of the merged file
+
+    open_file : callable
+        open_file(fil) opens a file for reading binary lines, e.g. open(fil, 'rb').
+
+    sync : boolean, default=False
+        If True, then sync the merged file to disk, e.g. before the files are deleted.
+
+    Returns
+    -------
+    report : chunk_merge.MergeReport
+    """
+    temp_filename = merged_file + '.part'
+    with open(temp_filename, 'wb') as fp:
+        report = chunk_merge.merge_chunks(files, fp, open_file, merged_file, default_time_column(merged_file))
+        if sync:
+            fp.flush()
+            os.fsync(fp.fileno())
+    os.replace(temp_filename, merged_file)
+    if sync:
+        sync_directory(os.path.dirname(merged_file))
+    report.print_report()
+    return report
+
+
+def merged_file_name(file_path, prefix):
+    """
+    The full path of the merged file of the given prefix, e.g. 'raw_acc.txt' or 'gps.txt'.
+    """
+    if prefix == 'gps':
+        return os.path.join(file_path, prefix + ".txt")
+    return os.path.join(file_path, "raw_" + prefix + ".txt")
+
+
+def report_missing_files(prefix, files):
+    """
+    Print the numbers of the files that are missing, i.e. the gaps between the numbers of the given files.
+
+    Parameters
+    ----------
+    prefix : str
+        e.g. 'acc'
+
+    files : list[str]
+        The files of the prefix, sorted by get_int_from_str
+
+    Returns
+    -------
+    missing : list[str]
+        The messages printed
+    """
+    missing = []
+    last_number = None
+    for f in files:
+        cur_number = get_int_from_str(os.path.basename(f))
+        if last_number and last_number + 1 != cur_number:
+            msg = "missing file: " + prefix + "_" + str(last_number + 1) + "--" + str(cur_number - 1) + '.txt'
+            print(msg)
+            missing.append(msg)
+        last_number = cur_number
+    return missing
+
+
+def sync_file(path):
+    """
+    Sync the content of the given file to disk, e.g. one that has been written by another module.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_directory(path):
+    """
+    Sync the entries of the given folder to disk, e.g. a file that has just been renamed.
+    Not supported on some systems, e.g. Windows, where it does nothing.
+    """
+    try:
+        fd = os.open(path or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
         pass
+    finally:
+        os.close(fd)
 
 
 def merge_single_directory(file_path, delete_unzip):
     """
-    Merge files with same prefix under the given path.
+    Merge files with same prefix under the given path, ordered by time, see merge_files.
     Assuming there is NO sub folder within this path.
 
     Parameters
@@ -213,12 +701,18 @@ def merge_single_directory(file_path, delete_unzip):
 
     delete_unzip : str, 'True' or 'False'
         If 'True', uncompressed files will be deleted after merge.
+
+    Returns
+    -------
+    missing : list[str]
+        The messages of the missing files, see report_missing_files
     """
     subfiles = os.listdir(file_path)
 
     data_type = ['acc', 'obd', 'gps', 'gyro', 'mag']
     file_extension = '.txt'
 
+    missing = []
     uncompressed_files_dict = defaultdict(list)
     for fil in subfiles:
         file_name = os.path.basename(fil)  # TODO: this is not necessary since subfiles are just file names
@@ -231,33 +725,14 @@ def merge_single_directory(file_path, delete_unzip):
 
     for prefix, files in uncompressed_files_dict.items():
         files = sorted(files, key=lambda x: get_int_from_str(x))  # sort directly is not right here, since 'raw_acc8' will be larger than 'raw_acc70'.
-        all_lines = []
-        last_number = None
-        for f in files:
-            cur_number = get_int_from_str(f)
-            if last_number and last_number + 1 != cur_number:
-                msg = "missing file: " + prefix + "_" + str(last_number + 1) + "--" + str(cur_number - 1) + '.txt'
-                print(msg)
-            last_number = cur_number
-
-            file_name = os.path.join(file_path, f)
-            with open(file_name, 'rb') as fp:
-                all_lines.extend(fp.readlines())
-            if delete_unzip == "True":
+        missing.extend(report_missing_files(prefix, files))
+        files = [os.path.join(file_path, f) for f in files]
+        # ordered by time, and the lines out of order are reported
+        merge_files(files, merged_file_name(file_path, prefix), lambda fil: open(fil, 'rb'))
+        if delete_unzip == "True":
+            for file_name in files:
                 os.remove(file_name)
-        if prefix == 'gps':
-            merged_file = os.path.join(file_path, prefix + ".txt")
-        else:
-            merged_file = os.path.join(file_path, "raw_" + prefix + ".txt")
-
-        # check if the merged file is in right order, i.e. time should be non decreasing
-        if prefix != 'obd':  # TODO: better way to handle obd file
-            for i in range(2, len(all_lines)):  # assuming there is a header
-                if int(all_lines[i][0]) < (all_lines[i - 1][0]):  # assuming time is the first column; convert to int, in case of '35' > '241'
-                    print("error: merge file: %s, line # %d" % (merged_file, i))
-
-        with open(merged_file, 'wb') as fp:
-            fp.writelines(all_lines)
+    return missing
 
 
 def get_int_from_str(string):
@@ -3,7 +3,9 @@ Utils
 """
 
 import os
+import io
 import datetime as dt
+import time
 import csv
 import bisect
 
@@ -14,8 +16,20 @@ import pandas as pd
 import matplotlib.pyplot as plt
 
 import constants
+import sensor_cache
+import smoothing
 from constants import DATA_ATTRIBUTES
 
+# types of the columns read from raw files, i.e. sys_time, x, y, z of motion sensors
+MOTION_SENSOR_DTYPES = {1: np.int64, 3: np.float64, 4: np.float64, 5: np.float64}
+OBD_DTYPES = {'timestamp': np.int64, 'RPM': str, 'Speed': str}
+
+# the bytes of lines parsed at a time by CsvBlockParser
+PARSE_BLOCK_SIZE = 4 * 1024 * 1024
+
+# the time zones change their offsets from UTC at multiples of it, see local_time_offsets
+OFFSET_BUCKET_SECONDS = 15 * 60
+
 
 def is_float(target):
     try:
@@ -54,74 +68,682 @@ def read_csv_file(filename, columns=None, with_header=True):
     with_header : boolean
         Indicate if the file has header or not. Default is 'True'.
     """
-    data_type = filename.split(os.sep)[-1]
-    is_gps = False
-    if data_type.startswith('gps'):
-        is_gps = True
+    if not with_header:
+        _, cols = parse_csv_columns(filename, columns=columns, with_header=False)
+        return stack_columns(cols)
 
-    with open(filename, 'r') as f:
-        if with_header:
-            header = f.readline()
-            header = header.replace('"', '').strip()
-            col_names = header.split(',')
-            col_names = [name.lower() for name in col_names]
+    # files with header are data files, which go through the binary cache
+    return select_columns(read_csv_table(filename), columns)
+
+
+def select_columns(table, columns=None):
+    """
+    Select columns from a structured array (see read_csv_table) as a 2-D array,
+    in the same way as read_csv_file does.
+
+    Parameters:
+    -----------
+    table : numpy structured array
 
-            # print(col_names)
+    columns : list, type of element should be 'int' or 'str'. Column name is case insensitive.
+        The indices of columns or names of columns to be returned.
+        Default is None, which means to return all columns
+    """
+    if len(table) == 0:
+        return np.array([])
 
-        # TODO: check if it is empty file
+    names = table.dtype.names
+    if columns:
+        if type(columns[0]) is int:
+            selected_cols = columns
+        else:
+            lower_names = [name.lower() for name in names]
+            selected_cols = [lower_names.index(col.lower()) for col in columns]
+    else:
+        selected_cols = range(len(names))
+    return stack_columns([table[names[i]] for i in selected_cols])
 
-        result = []
 
-        num_columns = None  # the number of columns in the file
-        selected_cols = []  # the index of 'needed' columns
-        for line in f:
-            line = line.replace('"', '').strip()
-            elements = line.split(',')
+def stack_columns(cols):
+    """
+    Stack 1-D columns into a 2-D array.
+    """
+    if not cols or len(cols[0]) == 0:
+        return np.array([])
 
-            if not num_columns:
-                num_columns = len(elements)
+    # keep the same types as building the array row by row, i.e. ints and floats are merged
+    # into float, and everything becomes str if any of the selected columns is not numeric
+    if any(col.dtype.kind not in 'iuf' for col in cols):
+        cols = [col.astype(str) for col in cols]
+    return np.column_stack(cols)  # to keep consistant with pandas.read_csv
 
-                if columns:
-                    if type(columns[0]) is int:
-                        selected_cols = columns
-                    elif type(columns[0]) is str:
-                        selected_cols = [col_names.index(col.lower()) for col in columns]
-                else:
-                    # return all columns if parameter 'columns' is not given
-                    # use num_columns instead of len(col_names), since the length of headers might be larger, e.g. raw_obd
-                    selected_cols = [i for i in range(num_columns)]
 
-            elif num_columns != len(elements):  # means the last line is incomplete
-                break
+def read_csv_table(filename, mmap_mode=None):
+    """
+    Read a data file with header, e.g. 'raw_acc.txt', as a numpy structured array
+    with one field per column, through the binary cache (see sensor_cache).
+
+    Parameters:
+    -----------
+    filename : str
+        The path of the file to be read
+
+    mmap_mode : str, default=None
+        If given, e.g. 'r', the binary copy is memory-mapped instead of being loaded.
+
+    Returns:
+    --------
+    table : numpy structured array
+    """
+    return sensor_cache.load(filename, parse_csv_table, mmap_mode=mmap_mode)
+
+
+def read_sensor_range(filename, start_time=None, end_time=None, time_column='sys_time'):
+    """
+    Read the rows of a data file within the given time range, [start_time, end_time].
+
+    The binary copy of the file is memory-mapped, and the range is located by binary search
+    on the time column, so only the pages within the range are read from disk, no matter how
+    long the trip is. If the time column is not in order (see sensor_cache.is_sorted), e.g. files
+    merged from chunks that overlap, the rows within the range are selected by a mask instead,
+    the same as when the text file is read block by block, see iter_sensor_range.
+
+    Parameters:
+    -----------
+    filename : str
+        The path of the file to be read, e.g. 'raw_acc.txt'
+
+    start_time : int, default=None
+        Rows before it are skipped. Default is from the first row.
 
-            # ignore 'network' obtained gps
-            if is_gps and elements[-1] == 'network':
-                continue
+    end_time : int, default=None
+        Rows after it are skipped. Default is till the last row.
 
-            cur_row = []
-            for col_index in selected_cols:
-                value = elements[col_index]
+    time_column : str, default='sys_time'
+        The name of the time column
+
+    Returns:
+    --------
+    rows : numpy structured array
+        Read only when memory-mapped. Make a copy before modifying it.
+    """
+    table = read_csv_table(filename, mmap_mode='r')
+    if len(table) == 0:
+        return table
+
+    times = table[time_column]
+    if not sensor_cache.is_sorted(filename, time_column):
+        mask = np.ones(len(times), dtype=bool)
+        if start_time is not None:
+            mask &= times >= start_time
+        if end_time is not None:
+            mask &= times <= end_time
+        return table[mask]
+
+    # bisect only touches log(n) rows, while np.searchsorted would copy the whole strided column
+    lo = 0 if start_time is None else bisect.bisect_left(times, start_time)
+    hi = len(times) if end_time is None else bisect.bisect_right(times, end_time)
+    return table[lo:hi]
+
+
+def iter_sensor_range(filename, start_time=None, end_time=None, time_column='sys_time', chunk_size=100000):
+    """
+    The same as read_sensor_range, but yields the rows block by block.
+
+    If the file has an up-to-date binary copy (see sensor_cache), blocks are sliced from the
+    memory-mapped copy. Otherwise, the text file is parsed block by block. Either way, at most
+    one block is in memory at a time.
+
+    Yields
+    ------
+    rows : numpy structured array
+        At most chunk_size rows
+    """
+    if sensor_cache.use_copy(filename):
+        table = read_sensor_range(filename, start_time, end_time, time_column)
+        for begin in range(0, len(table), chunk_size):
+            yield table[begin: begin + chunk_size]
+        return
+
+    with open(filename, 'r') as fp:
+        names = fp.readline().replace('"', '').strip().split(',')
+    # round_trip gives exactly the same floats as float() does, see parse_csv_columns
+    for chunk in iter_csv_frames(filename, chunk_size, skiprows=[0], header=None, float_precision='round_trip'):
+        rows = sensor_cache.to_table(names, [chunk[col].to_numpy() for col in chunk.columns])
+        times = rows[time_column]
+        if start_time is not None:
+            rows = rows[times >= start_time]
+            times = rows[time_column]
+        if end_time is not None:
+            # no early stop, since the rows may not be in order
+            rows = rows[times <= end_time]
+        if len(rows):
+            yield rows
+
+
+def parse_csv_table(filename):
+    """
+    Parse a data file with header into a numpy structured array, without the cache.
+    """
+    names, cols = parse_csv_columns(filename, with_header=True)
+    return sensor_cache.to_table(names, cols)
 
-                # need to convert from string to the right type
-                if '.' in value:
-                    value = float(value)
-                elif is_int(value):
-                    value = int(value)
 
-                cur_row.append(value)
+def parse_csv_columns(filename, columns=None, with_header=True):
+    """
+    Decode a csv file into typed columns in bulk, instead of converting cell by cell.
+
+    The incomplete last line, if there is any, is dropped, i.e. everything from the first line
+    whose number of fields differs from the first data line. For gps file, the lines obtained
+    via 'network' are ignored.
+
+    Parameters:
+    -----------
+    filename : str
+        The path of the file to be read
+
+    columns : list, type of element should be 'int' or 'str'. Column name is case insensitive.
+        The indices of columns or names of columns to be returned.
+        Default is None, which means to return all columns
+
+    with_header : boolean
+        Indicate if the file has header or not. Default is 'True'.
+
+    Returns:
+    --------
+    col_names : list[str]
+        The names in the header. Empty if there is no header.
+
+    cols : list[numpy array]
+        One 1-D array per selected column, whose dtype is int64, float64 or object (str).
+    """
+    data_type = filename.split(os.sep)[-1]
+    is_gps = data_type.startswith('gps')
 
-            result.append(cur_row)
+    with open(filename, 'rb') as f:
+        data = f.read()
 
-        return np.array(result)  # to keep consistant with pandas.read_csv
+    return parse_csv_data(data, columns, with_header, is_gps)
+
+
+def parse_csv_data(data, columns=None, with_header=True, is_gps=False):
+    """
+    The same as parse_csv_columns, but from the content of the file, e.g. merged from the
+    compressed chunks in memory (see unzip.unzip_ingest_files).
+
+    Parameters:
+    -----------
+    data : bytes
+        The content of the file
+
+    is_gps : boolean, default=False
+        Ignore the lines obtained via 'network'.
+    """
+    col_names = []
+    body_start = 0
+    if with_header:
+        body_start = data.find(b'\n') + 1
+        if body_start == 0:
+            body_start = len(data)
+        header = data[:body_start].decode().replace('"', '').strip()
+        col_names = header.split(',')
+
+    num_records, num_columns = count_complete_records(data, body_start)
+    if num_records == 0:
+        return col_names, []
+
+    if columns:
+        if type(columns[0]) is int:
+            selected_cols = list(columns)
+        else:
+            lower_names = [name.lower() for name in col_names]
+            selected_cols = [lower_names.index(col.lower()) for col in columns]
+    else:
+        # use num_columns instead of len(col_names), since the length of headers might be larger, e.g. raw_obd
+        selected_cols = list(range(num_columns))
+
+    return col_names, parse_records(data, 1 if with_header else 0, num_records, num_columns, selected_cols, is_gps)
+
+
+def parse_records(data, skiprows, num_records, num_columns, selected_cols, is_gps=False):
+    """
+    Parse the given number of lines of the content of a csv file, after skiprows lines, into columns,
+    see parse_csv_data.
+    """
+    usecols = sorted(set(selected_cols) | ({num_columns - 1} if is_gps else set()))
+    # round_trip gives exactly the same floats as float() does
+    df = pd.read_csv(io.BytesIO(data), header=None, skiprows=skiprows, nrows=num_records,
+                     usecols=usecols, float_precision='round_trip')
+
+    if is_gps:
+        # ignore 'network' obtained gps
+        df = df[df[num_columns - 1].astype(str) != 'network']
+
+    return [df[col].to_numpy() for col in selected_cols]
+
+
+class CsvBlockParser(object):
+    """
+    Parse the content of a data file with header into structured arrays (see sensor_cache.to_table)
+    block by block as it is written, e.g. merged from the compressed chunks (see unzip.unzip_ingest_files),
+    so that the whole content is never in memory.
+
+    The rows are the same as parse_csv_data gives for the whole content, i.e. parsing stops at the
+    first line whose number of fields differs from the first data line. The types of the columns may
+    differ from block to block though, e.g. int in one and float in another, see sensor_cache.CopyWriter.
+    """
+
+    def __init__(self, is_gps=False, block_size=PARSE_BLOCK_SIZE):
+        """
+        Parameters
+        ----------
+        is_gps : boolean, default=False
+            Ignore the lines obtained via 'network'.
+
+        block_size : int, default=PARSE_BLOCK_SIZE
+            The bytes of lines parsed at a time
+        """
+        self.is_gps = is_gps
+        self.block_size = block_size
+        self.names = None  # in the header
+        self.num_columns = None  # in the first data line
+        self.done = False  # if a line that is not complete has been found
+        self.pending = []  # the content that has not been parsed
+        self.pending_size = 0
+
+    def feed(self, data):
+        """
+        Add the next part of the content.
+
+        Returns
+        -------
+        tables : list[numpy structured array]
+            The blocks parsed, if any.
+        """
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size < self.block_size:
+            return []
+        data = b''.join(self.pending)
+        end = data.rfind(b'\n') + 1
+        self.pending = [data[end:]]
+        self.pending_size = len(data) - end
+        return self.parse(data[:end])
+
+    def close(self):
+        """
+        Parse the rest of the content, including the last line without line break.
+
+        Returns
+        -------
+        tables : list[numpy structured array]
+        """
+        data = b''.join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        return self.parse(data)
+
+    def parse(self, data):
+        """
+        Parse the given lines, which follow those parsed before.
+        """
+        if self.done or not data:
+            return []
+        start = 0
+        if self.names is None:
+            start = data.find(b'\n') + 1 or len(data)
+            self.names = data[:start].decode().replace('"', '').strip().split(',')
+            if start == len(data):
+                return []
+
+        num_records, num_columns = count_complete_records(data, start, self.num_columns)
+        self.num_columns = self.num_columns or num_columns
+        num_lines = data.count(b'\n', start) + (0 if data.endswith(b'\n') else 1)
+        if num_records < num_lines:
+            self.done = True
+        if num_records == 0:
+            return []
+        cols = parse_records(data, 1 if start else 0, num_records, self.num_columns,
+                             list(range(self.num_columns)), self.is_gps)
+        return [sensor_cache.to_table(self.names, cols)]
+
+
+def count_complete_records(data, start=0, num_columns=None):
+    """
+    Count the complete data lines in the given content of a csv file.
+
+    The number of fields in each line is worked out from the positions of all line breaks and commas
+    at once. Counting stops at the first line whose number of fields is different from the first one,
+    which means that the line is incomplete.
+
+    Parameters:
+    -----------
+    data : bytes
+        The content of the file
+
+    start : int, default=0
+        The offset of the first data line, i.e. after the header
+
+    num_columns : int, default=None
+        The number of fields in a complete line, e.g. in the first data line of the file if the
+        content is a later part of it. Default is the number of fields in the first line.
+
+    Returns:
+    --------
+    num_records : int
+        The number of complete lines from 'start'
+
+    num_columns : int
+        The number of fields in the first data line, or the given one. 0 if there is no data.
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)[start:]
+    line_ends = np.flatnonzero(buf == ord('\n'))
+    if len(buf) and buf[-1] != ord('\n'):
+        line_ends = np.append(line_ends, len(buf))  # the last line without line break
+    if len(line_ends) == 0:
+        return 0, 0
+
+    commas = np.flatnonzero(buf == ord(','))
+    num_fields = np.diff(np.searchsorted(commas, line_ends), prepend=0) + 1
+    if num_columns is None:
+        num_columns = int(num_fields[0])
+        # an empty first line is not a record, e.g. file with header only
+        if num_columns == 1 and line_ends[0] == 0:
+            return 0, 0
+
+    mismatched = np.flatnonzero(num_fields != num_columns)
+    num_records = int(mismatched[0]) if len(mismatched) else len(num_fields)
+    return num_records, num_columns
 
 
 def read_raw_obd(filename, columns=None):
     """
-    TODO: handle cases when the last line is incomplete
+    Read the raw obd file. The speed column is kept as str, e.g. '12km/h'.
     """
     if not columns:
         columns = ['timestamp', 'Speed']
-    return pd.read_csv(filename, sep=",", usecols=columns, error_bad_lines=False, engine="python", skipfooter=1).values
+    dtype = {name: OBD_DTYPES[name] for name in columns if name in OBD_DTYPES}
+    return read_csv_frame(filename, usecols=columns, dtype=dtype).values
+
+
+def complete_size(filename, block_size=4096):
+    """
+    Get the size of the given file without its incomplete last line, if there is one.
+
+    Only the first two lines and the end of the file are read. The last line is complete
+    if it has the same number of fields as the first data line, its quotes are paired,
+    and it does not end with a comma.
+
+    Parameters
+    ----------
+    filename : str
+        The path of the file, which has header
+
+    block_size : int, default=4096
+        The number of bytes to read at a time backward from the end of the file
+
+    Returns
+    -------
+    size : int
+        The number of bytes from the beginning of the file to the end of the last complete line
+    """
+    return probe_lines(filename, block_size=block_size)[3]
+
+
+def probe_lines(filename, block_size=4096):
+    """
+    Read the header, the first data line and the last complete line of the given file,
+    without reading what is in between. See complete_size() for what a complete line is.
+
+    Parameters
+    ----------
+    filename : str
+        The path of the file, which has header
+
+    block_size : int, default=4096
+        The number of bytes to read at a time backward from the end of the file
+
+    Returns
+    -------
+    header : bytes
+
+    first_line : bytes
+        Empty if there is no complete data line.
+
+    last_line : bytes
+        Empty if there is no complete data line.
+
+    size : int
+        The number of bytes from the beginning of the file to the end of the last complete line
+    """
+    with open(filename, 'rb') as fp:
+        header = fp.readline()
+        first_line = fp.readline()
+        num_fields = first_line.count(b',') + 1
+        data_start = len(header)
+
+        size = fp.seek(0, os.SEEK_END)
+        if size <= data_start:
+            return header, b'', b'', size
+
+        last_start, last_line = read_last_line(fp, size, data_start, block_size)
+        if not is_complete_line(last_line, num_fields):
+            # the second last line, which is complete, unless the whole file is messed up
+            size = last_start
+            if size <= data_start:
+                return header, b'', b'', size
+            last_start, last_line = read_last_line(fp, size, data_start, block_size)
+
+    if last_start == data_start:
+        first_line = last_line
+    return header, first_line, last_line, size
+
+
+def read_last_line(fp, end, begin=0, block_size=4096):
+    """
+    Read the last line before the given offset of a binary file, backward block by block.
+
+    Parameters
+    ----------
+    fp : file object
+        Opened in binary mode
+
+    end : int
+        The offset where the line ends (exclusive), including its line break if there is one
+
+    begin : int, default=0
+        The offset that the search stops at
+
+    block_size : int, default=4096
+        The number of bytes to read at a time
+
+    Returns
+    -------
+    start : int
+        The offset of the beginning of the line
+
+    line : bytes
+        The line, including its line break if there is one
+    """
+    tail = b''
+    pos = end
+    while pos > begin:
+        step = min(block_size, pos - begin)
+        pos -= step
+        fp.seek(pos)
+        tail = fp.read(step) + tail
+        if tail.rfind(b'\n', 0, len(tail) - 1) != -1:
+            break
+
+    line_start = tail.rfind(b'\n', 0, len(tail) - 1) + 1
+    return pos + line_start, tail[line_start:]
+
+
+def is_complete_line(line, num_fields):
+    """
+    Check if the given line has the expected number of fields, paired quotes, and does not end with a comma.
+    """
+    line = line.rstrip(b'\r\n')
+    return line.count(b',') + 1 == num_fields and line.count(b'"') % 2 == 0 and not line.endswith(b',')
+
+
+def read_time_bounds(filename, time_column, skip_last=False):
+    """
+    Get the time of the first and the last complete data lines of the given file.
+
+    Only these two lines are read (see probe_lines), so it takes about the same time
+    no matter how large the file is. If there is only the binary copy of the file
+    (see sensor_cache.save), the first and the last rows of the copy.
+
+    Parameters
+    ----------
+    filename : str
+        The path of the file, which has header, e.g. 'raw_acc.txt'
+
+    time_column : str or int
+        The name or the index of the time column, e.g. 'sys_time'
+
+    skip_last : bool, default=False
+        If True, the end is the time of the line before the last one, as when the file is read
+        with pandas.read_csv(engine='python', skipfooter=1), i.e. the last line is dropped, and so is
+        the one before it if the last line is cut within quotes, which cannot be parsed at all.
+        For the binary copy, the row before the last one.
+
+    Returns
+    -------
+    (start, end) : (int, int)
+        None if there is no complete data line, or only one if skip_last.
+    """
+    if not os.path.isfile(filename) and sensor_cache.exists(filename):
+        # only the binary copy, see sensor_cache.save
+        table = read_csv_table(filename, mmap_mode='r')
+        if len(table) < (2 if skip_last else 1):
+            return None
+        times = table[table.dtype.names[time_column] if type(time_column) is int else time_column]
+        return int(times[0]), int(times[-2 if skip_last else -1])
+
+    header, first_line, last_line, _ = probe_lines(filename)
+    if not first_line.strip():
+        return None
+    if skip_last:
+        with open(filename, 'rb') as fp:
+            data_start = len(header)
+            last_start, line = read_last_line(fp, fp.seek(0, os.SEEK_END), data_start)
+            if line.count(b'"') % 2 and last_start > data_start:
+                last_start, _ = read_last_line(fp, last_start, data_start)
+            if last_start <= data_start:
+                return None
+            _, last_line = read_last_line(fp, last_start, data_start)
+
+    index = time_column
+    if type(time_column) is not int:
+        names = header.decode().replace('"', '').strip().split(',')
+        index = names.index(time_column)
+
+    def get_time(line):
+        value = line.decode().replace('"', '').strip().split(',')[index]
+        return int(float(value)) if '.' in value else int(value)
+
+    return get_time(first_line), get_time(last_line)
+
+
+class BoundedReader(io.RawIOBase):
+    """
+    A read only binary file that stops at the given size, so that readers never see the rest.
+    """
+
+    def __init__(self, fp, size):
+        self.fp = fp
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+        if size <= 0:
+            return 0
+        data = self.fp.read(size)
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+
+def read_csv_frame(filename, **kwargs):
+    """
+    Read a data file into a DataFrame with the C engine of pandas.
+
+    The last line might be incomplete. Instead of parsing with engine='python' and skipfooter=1,
+    which is slow and always drops the last line, the incomplete line is cut off beforehand
+    (see complete_size) and the rest is parsed with the C engine.
+
+    Parameters
+    ----------
+    filename : str
+        The path of the file to be read
+
+    kwargs :
+        Passed to pandas.read_csv, e.g. usecols, dtype, header. Explicit dtype is recommended.
+
+    Returns
+    -------
+    DataFrame
+    """
+    size = complete_size(filename)
+    with open(filename, 'rb') as fp:
+        return pd.read_csv(io.BufferedReader(BoundedReader(fp, size)), sep=',', engine='c', **kwargs)
+
+
+def iter_csv_frames(filename, chunk_size, **kwargs):
+    """
+    The same as read_csv_frame, but yields DataFrames of at most chunk_size rows one by one,
+    so that the whole file never needs to be in memory.
+    """
+    size = complete_size(filename)
+    with open(filename, 'rb') as fp:
+        reader = pd.read_csv(io.BufferedReader(BoundedReader(fp, size)), sep=',', engine='c',
+                             chunksize=chunk_size, **kwargs)
+        for chunk in reader:
+            yield chunk
+
+
+def iter_raw_sensor(filename, chunk_size=100000):
+    """
+    Read a raw motion sensor file, e.g. 'raw_acc.txt', block by block.
+
+    If the file has an up-to-date binary copy (see sensor_cache), blocks are sliced from the
+    memory-mapped copy. Otherwise, the text file is parsed block by block. Either way, at most
+    one block is in memory at a time.
+
+    Parameters
+    ----------
+    filename : str
+        The path of the raw sensor file
+
+    chunk_size : int, default=100000
+        The maximum number of rows in each block
+
+    Yields
+    ------
+    sys_time : 1-D numpy array, int64
+
+    xyz : 2-D numpy array, float64
+        The readings along x, y and z, shape (len(sys_time), 3)
+    """
+    if sensor_cache.use_copy(filename):
+        table = read_csv_table(filename, mmap_mode='r')
+        names = table.dtype.names
+        for begin in range(0, len(table), chunk_size):
+            block = table[begin: begin + chunk_size]
+            sys_time = block[names[1]].astype(np.int64)
+            xyz = np.column_stack([block[names[i]] for i in (3, 4, 5)]).astype(np.float64)
+            yield sys_time, xyz
+        return
+
+    # skip the header, since header in some files are not perfectly matching the content
+    for chunk in iter_csv_frames(filename, chunk_size, usecols=[1, 3, 4, 5], skiprows=[0], header=None,
+                                 dtype=MOTION_SENSOR_DTYPES):
+        yield chunk[1].to_numpy(), chunk[[3, 4, 5]].to_numpy()
 
 
 def read_gps(filename, columns=None, ignore_network=True):
@@ -151,7 +773,7 @@ def read_raw_acc(filename, columns=None):
     # skip the header, since header in some files are not perfectly matching the content
     # e.g. forester_weida/35823905098470/VehSenseData2018_03_20_19_56_59/raw_acc.txt
     # but this should not happen for data collected afterward
-    data = pd.read_csv(filename, sep=",", usecols=[1, 3, 4, 5], skiprows=[0], header=None, error_bad_lines=False, engine="python", skipfooter=1)
+    data = read_csv_frame(filename, usecols=[1, 3, 4, 5], skiprows=[0], header=None, dtype=MOTION_SENSOR_DTYPES)
     # time_stamps = data[['sys_time']].values
     # raw_acc = data[['raw_x_acc', 'raw_y_acc', 'raw_z_acc']].values
 
@@ -163,7 +785,7 @@ def read_raw_gyro(filename, columns=None):
     Read the raw gyroscope file.
     """
     # columns = ["sys_time", "raw_x_gyro", "raw_y_gyro", "raw_z_gyro"]
-    data = pd.read_csv(filename, sep=",", usecols=[1, 3, 4, 5], skiprows=[0], header=None, error_bad_lines=False, engine="python")
+    data = read_csv_frame(filename, usecols=[1, 3, 4, 5], skiprows=[0], header=None, dtype=MOTION_SENSOR_DTYPES)
     return data.values
 
 
@@ -209,8 +831,8 @@ def obd_file_with_valid_speed(obd_file):
     if not file_populated(obd_file):
         return False
 
-    time_speed = read_raw_obd(obd_file)
-    if not time_speed[0][1].strip():
+    time_speed = read_trip_obd_speed(obd_file)
+    if len(time_speed) == 0 or not time_speed[0][1].strip():
         return False
 
     return True
@@ -220,6 +842,8 @@ def get_speed(folder, sys_time):
     """
     Get the speed (km/h) at the given time point from OBD file or gps file under the specified folder.
 
+    The speeds of the trip are read only once, see speed_index.SpeedIndex.
+
     Parameters
     ----------
     folder: str
@@ -233,27 +857,55 @@ def get_speed(folder, sys_time):
     speed: float, unit km/h
         Return -1.0 if no speed can be retrieved.
     """
-    if type(sys_time) is int or type(sys_time) is str:
-        sys_time = timestamp_2_datetime(sys_time)
+    from trip import get_trip
+    speed = get_trip(folder).speed_index.speed_at(to_timestamp(sys_time))
+    if speed == -1.0:
+        print("NO speed from obd or gps ==> can not get speed for path %s" % folder)
+    return speed
+
+
+def get_speeds(folder, timestamps):
+    """
+    Get the speeds (km/h) at the given time points, in the same way as get_speed but all at once.
+
+    Parameters
+    ----------
+    folder: str
+        The directory that contains the obd or gps files.
+
+    timestamps: array-like, type=int
+        The sys_time (ms) to query for speed
+
+    Returns
+    -------
+    speeds: numpy array, type=float, unit km/h
+        -1.0 for the time points whose speed can not be retrieved.
+    """
+    from trip import get_trip
+    return get_trip(folder).speed_index.speeds_at(timestamps)
+
 
-    obd_file = os.path.join(folder, constants.OBD_FILE_NAME)
+def get_average_speeds(folder, windows):
+    """
+    Get the average speeds (km/h) within the given periods, from OBD file or gps file
+    under the specified folder. See average_speed.
 
-    speed = None
-    if obd_file_with_valid_speed(obd_file):
-        speed = get_speed_obd(obd_file, sys_time)
-    if speed and speed != -1.0:
-        return speed
+    Parameters
+    ----------
+    folder: str
+        The directory that contains the obd or gps files.
 
-    print("No speed from obd. Try to get from gps...", end=' ')
-    gps_file = os.path.join(folder, constants.GPS_FILE_NAME)
-    if os.path.isfile(gps_file):
-        speed = get_speed_gps(gps_file, sys_time)
-    if speed and speed != -1.0:
-        print('got it, %f km/h' % speed)
-        return speed
+    windows: array-like, shape=(n, 2), type=int
+        The (start, end) sys_time (ms) of each period
 
-    print("NO speed from gps ==> can not get speed for path %s" % folder)
-    return -1.0
+    Returns
+    -------
+    speeds: numpy array, type=float, unit km/h
+        -1.0 for the periods whose speed can not be retrieved.
+    """
+    from trip import get_trip
+    windows = np.asarray(windows, dtype=np.int64).reshape(-1, 2)
+    return get_trip(folder).speed_index.average_speeds(windows[:, 0], windows[:, 1])
 
 
 def get_speed_gps(gps_file, sys_time):
@@ -265,19 +917,62 @@ def get_speed_gps(gps_file, sys_time):
     gps_file : str
         The full path of gps file to read speed data from
 
-    sys_time : datetime object
+    sys_time : datetime object, or int/str
     """
     # TODO: get the average speed in a small window? e.g. end = sys_time + datetime.timedelta(seconds=1)
-    delta = dt.timedelta(seconds=1)
-    return get_average_speed_gps(gps_file, sys_time - delta, sys_time - delta)
+    from speed_index import GPS_DELAY
+    sys_time = to_timestamp(sys_time) - GPS_DELAY
+    return get_average_speed_gps(gps_file, sys_time, sys_time)
+
+
+def read_trip_gps_speed(gps_file):
+    """
+    Read [[time, speed (m/s)]] from the given gps file, through the trip kept in memory (see trip.py).
+    """
+    from trip import get_trip
+    folder, filename = os.path.split(gps_file)
+    return get_trip(folder).read(filename, columns=[1, 4])
+
+
+def read_trip_obd_speed(obd_file):
+    """
+    Read [[timestamp, speed (str, e.g. '12km/h')]] from the given obd file,
+    through the trip kept in memory (see trip.py).
+    """
+    from trip import get_trip
+    folder, filename = os.path.split(obd_file)
+    return get_trip(folder).read(filename, columns=['timestamp', 'Speed'])
+
+
+def get_trip_speed_series(filename, source):
+    """
+    Get the speed series (see speed_index.SpeedSeries) of the trip that the given file belongs to.
+
+    Parameters
+    ----------
+    filename : str
+        The full path of the obd or gps file
+
+    source : str, 'obd' or 'gps'
+
+    Returns
+    -------
+    None if the trip has no such speed.
+    """
+    from trip import get_trip
+    return getattr(get_trip(os.path.dirname(filename)).speed_index, source)
 
 
 def get_average_speed_gps(gps_file, start, end):
-    time_speed = read_gps(gps_file, columns=[1, 4])  # unit of gps speed is m/s
-    time_speed = [(timestamp_2_datetime(int(ts[0])), float(ts[1]) * 3.6) \
-                  for ts in time_speed]
-    ave_speed = average_speed(time_speed, start, end)
-    return ave_speed
+    """
+    Returns
+    -------
+    Return -1.0 if no valid speed
+    """
+    series = get_trip_speed_series(gps_file, 'gps')
+    if not series:
+        return -1.0
+    return series.average_speed(to_timestamp(start), to_timestamp(end))
 
 
 def get_speed_obd(obd_file, start):
@@ -286,7 +981,6 @@ def get_speed_obd(obd_file, start):
     -------
     Return -1.0 if no valid speed
     """
-    delta = dt.timedelta(seconds=1)
     return get_average_speed_obd(obd_file, start, start)
 
 
@@ -296,17 +990,10 @@ def get_average_speed_obd(obd_file, start, end):
     -------
     Return -1.0 if no valid speed
     """
-    time_speed = read_raw_obd(obd_file)
-    # TODO: no need to convert all data. only need to convert the data within the required time range.
-    try:
-        time_speed = [(timestamp_2_datetime(ts[0]), float(str(ts[1]).split('km/h')[0])) \
-                  for ts in time_speed if str(ts[1]).strip()]  # there might be some missing values
-    except:
-        print("exception in trying to get speed data from OBD file.")
-        return -1
-
-    ave_speed = average_speed(time_speed, start, end)
-    return ave_speed
+    series = get_trip_speed_series(obd_file, 'obd')
+    if not series:
+        return -1.0
+    return series.average_speed(to_timestamp(start), to_timestamp(end))
 
 
 def average_speed(time_speed, start_time, end_time):
@@ -315,21 +1002,24 @@ def average_speed(time_speed, start_time, end_time):
 
     Parameters
     ----------
-    time_speed: list[(datetime obj, speed)]
+    time_speed: list[(time, speed)], or 2-D array
+        Sorted by time. Time is int64 time stamp in ms, datetime64, or datetime object.
         Type of speed is float
 
-    start_time: datetime object
+    start_time: int, datetime64, or datetime object
 
-    end_time: datetime object
+    end_time: int, datetime64, or datetime object
 
     Returns
     -------
     Average speed between the start_time and end_time
     """
-    time = [ts[0] for ts in time_speed]
-    speed = [ts[1] for ts in time_speed]
-    start_index = look_for_time_position(start_time, time)
-    end_index = look_for_time_position(end_time, time)
+    if len(time_speed) == 0:
+        return -1.0
+    time = to_timestamps([ts[0] for ts in time_speed])
+    speed = np.array([ts[1] for ts in time_speed], dtype=np.float64)
+    start_index = look_for_time_position(to_timestamp(start_time), time)
+    end_index = look_for_time_position(to_timestamp(end_time), time)
     if start_index == -1 or end_index == -1:
         return -1.0
     return np.mean(speed[start_index: end_index + 1])
@@ -343,11 +1033,11 @@ def look_for_time_position(target, source, begin_pos=0):
 
     Parameters
     -------------
-    target : DateTime obj
-        A datetime obj to look for
+    target : int, datetime64, or DateTime obj
+        The time to look for
 
-    source : list, type=DateTime
-        A list of DateTime objects to search from
+    source : numpy array or list, of the same type as target
+        Sorted times to search from
 
     begin_pos : int, default=0
         The start position to search. Default to search from the beginning.
@@ -357,13 +1047,10 @@ def look_for_time_position(target, source, begin_pos=0):
     position : int
         The location
     """
-    # TODO: make use of the unused parameter - begin_pos
-    for i, t in enumerate(source[begin_pos:]):
-        if t >= target:
-            ans = i + begin_pos
-            # return ans
-
-    insert_index = bisect.bisect(source, target, lo=begin_pos)
+    if isinstance(source, np.ndarray):
+        insert_index = begin_pos + int(np.searchsorted(source[begin_pos:], target, side='right'))
+    else:
+        insert_index = bisect.bisect(source, target, lo=begin_pos)
     if insert_index >= len(source):
         # print("Error (look_for_time_position): the time is out of scope.")
         return -1
@@ -405,26 +1092,16 @@ def moving_average(data, windows_size):
 def moving_average_same_size(data, windows_size):
     """
     Calculate the moving average of the given data. The row number of the return is
-    the same as the input.
+    the same as the input, i.e. the first (windows_size - 1) rows are the averages of the rows so far.
     :param data: 2-D array
     :param windows_size: int
     :return: 2-D array
     """
-    result = []
-
     if len(data) < windows_size:
         print("error: size of data is too small")
-        return result
+        return []
 
-    for i in range(windows_size):
-        result.append(np.average(data[: i + 1], axis=0))
-    pre_sum = np.sum(data[:windows_size, :], axis=0)
-    for i in range(windows_size, len(data)):
-        pre_sum -= data[i - windows_size, :]
-        pre_sum += data[i, :]
-        result.append(pre_sum / windows_size)
-
-    return np.array(result)
+    return smoothing.moving_average(data, windows_size)
 
 
 def timestamp_2_datetime(timestamp):
@@ -449,6 +1126,113 @@ def timestamp_2_datetime(timestamp):
         exit
 
 
+def datetime_2_timestamp(date_time):
+    """
+    Convert datetime to time stamp, the inverse of timestamp_2_datetime.
+
+    Parameters
+    --------------
+    date_time : datetime object
+        The local time
+
+    Returns
+    --------------
+    timestamp : int
+        Number of milliseconds passed since 01/01/1970
+    """
+    return int(time.mktime(date_time.timetuple())) * 1000 + date_time.microsecond // 1000
+
+
+def to_timestamp(sys_time):
+    """
+    Convert the given time, i.e. datetime object, numpy datetime64, or time stamp in ms as int/str,
+    to time stamp in ms.
+    """
+    if isinstance(sys_time, dt.datetime):
+        return datetime_2_timestamp(sys_time)
+    if isinstance(sys_time, np.datetime64):
+        return int(sys_time.astype('datetime64[ms]').astype(np.int64))
+    return int(sys_time)
+
+
+def to_timestamps(times):
+    """
+    Convert the given times to time stamps in ms, see to_timestamp.
+
+    Parameters
+    --------------
+    times : array-like
+        int64 time stamps in ms, or datetime64, which are converted without any loop,
+        or time stamps as str, or datetime objects.
+
+    Returns
+    --------------
+    timestamps : numpy array, type=int64
+    """
+    times = np.asarray(times)
+    if times.dtype.kind == 'M':
+        return times.astype('datetime64[ms]').astype(np.int64)
+    if times.dtype.kind == 'O':
+        return np.array([to_timestamp(t) for t in times], dtype=np.int64)
+    if times.dtype.kind in 'US':
+        times = times.astype(np.float64)
+    return times.astype(np.int64)
+
+
+def timestamps_2_datetime64(timestamps):
+    """
+    Convert time stamps in ms to numpy datetime64[ms], i.e. the same instants in UTC.
+    """
+    return to_timestamps(timestamps).astype('datetime64[ms]')
+
+
+def local_time_offsets(timestamps):
+    """
+    The offsets (ms) of the local time zone from UTC at the given time stamps (ms),
+    including daylight saving time, i.e. what datetime.fromtimestamp applies.
+
+    The offset is looked up at the beginning and the end of each 15 minutes covered by the
+    time stamps, since time zones change their offsets at a quarter of an hour in UTC, e.g.
+    Australia/Adelaide at 16:30 UTC. If the two differ, i.e. the offset changes within those
+    15 minutes, it is looked up for each of the time stamps within them.
+    """
+    timestamps = to_timestamps(timestamps)
+    seconds = timestamps // 1000
+    buckets = seconds // OFFSET_BUCKET_SECONDS
+    unique_buckets, inverse = np.unique(buckets, return_inverse=True)
+    offsets = np.empty(len(unique_buckets), dtype=np.int64)
+    changed = np.zeros(len(unique_buckets), dtype=bool)
+    for i, bucket in enumerate(unique_buckets.tolist()):
+        offsets[i] = time.localtime(bucket * OFFSET_BUCKET_SECONDS).tm_gmtoff
+        changed[i] = time.localtime((bucket + 1) * OFFSET_BUCKET_SECONDS - 1).tm_gmtoff != offsets[i]
+
+    result = offsets[inverse].reshape(timestamps.shape)
+    # within the 15 minutes of a change, one by one
+    exact = changed[inverse].reshape(timestamps.shape)
+    if exact.any():
+        result[exact] = [time.localtime(s).tm_gmtoff for s in seconds[exact].tolist()]
+    return result * 1000
+
+
+def timestamps_2_str(timestamps):
+    """
+    Format time stamps (ms) as local time, the same as
+    timestamp_2_datetime(t).strftime("%Y-%m-%d-%H-%M-%S-%f") for each of them.
+
+    Returns
+    --------------
+    numpy array of str
+    """
+    timestamps = to_timestamps(timestamps)
+    local_time = (timestamps + local_time_offsets(timestamps)).astype('datetime64[ms]')
+    # e.g. '2017-10-23T22:45:24.141' => '2017-10-23-22-45-24-141000', edited as bytes in place
+    text = np.datetime_as_string(local_time, unit='ms').astype('S23')
+    chars = np.full((len(text), 26), ord('0'), dtype=np.uint8)
+    chars[:, :23] = text.view(np.uint8).reshape(-1, 23)
+    chars[:, [10, 13, 16, 19]] = ord('-')
+    return chars.view('S26').ravel().astype(str)
+
+
 def append_timedate_column(raw_data, output_file, system_time_column=0):
     """
     Append a datetime column to existing data, and save the new data to the given file.
@@ -469,10 +1253,7 @@ def append_timedate_column(raw_data, output_file, system_time_column=0):
     new_data with datetime column added
     """
     # TODO: the given column number might be invalid
-    dt_column = []
-    for d in raw_data:
-        _dt = timestamp_2_datetime(d[system_time_column])
-        dt_column.append(_dt.strftime("%Y-%m-%d-%H-%M-%S-%f"))
+    dt_column = timestamps_2_str(np.asarray(raw_data)[:, system_time_column])
     dt_column = np.reshape(dt_column, (-1, 1))
     new_data = np.append(raw_data, dt_column, axis=1)
 
@@ -851,27 +1632,19 @@ def load_data_for_profiling(filename):
 
 
 def _compare_speed_obd_vs_gps(folder):
-    loss = 0.0
-    obd_file = os.path.join(folder, constants.OBD_FILE_NAME)
-
-    gps_file = os.path.join(folder, constants.GPS_FILE_NAME)
-
-    time_speed = read_gps(gps_file, columns=[1, 4])  # unit of gps speed is m/s
-    time_speed_gps = [(timestamp_2_datetime(int(ts[0])), float(ts[1]) * 3.6) \
-                  for ts in time_speed]
-
-    time_speed = read_raw_obd(obd_file)
-    time_speed_obd = [(timestamp_2_datetime(ts[0]), float(str(ts[1]).split('km/h')[0])) \
-                  for ts in time_speed]
+    from trip import get_trip
+    speed_index = get_trip(folder).speed_index
+    obd, gps = speed_index.obd, speed_index.gps
+    if not obd or not gps:
+        print("no speed from obd or gps under %s" % folder)
+        return
 
     timer_begin = dt.datetime.now()
-    for row in time_speed_obd[100:-100]:
-        time = row[0]
-        delta = dt.timedelta(seconds=1)
-        # obd_speed = average_speed(time_speed_obd, time, time)
-        obd_speed = row[1]
-        gps_speed = average_speed(time_speed_gps, time - delta, time + delta)
-        loss += abs(obd_speed - gps_speed)
+    time = obd.times[100:-100]
+    obd_speed = obd.speeds[100:-100]
+    delta = 1000  # ms
+    gps_speed = gps.average_speeds(time - delta, time + delta)
+    loss = np.sum(np.abs(obd_speed - gps_speed))
 
     timer_end = dt.datetime.now()
     print(loss)
@@ -0,0 +1,130 @@
+"""
+Resampled and smoothed data of any part of a trip, computed on demand from the raw data
+(through its binary copy, see sensor_cache), instead of being read from the files written
+by preprocess.
+
+The rows are on the same time grid as those files, i.e. from the start to the end time of the
+trip (see file_process.get_start_end_time) at the given rate, and only the rows within the given
+time range are computed, from the raw data around them. They are the same as the rows of the
+files written with the same parameters, except that 'ema' and 'lowpass' only take into account
+the data from a while before the range (see smoothing.warmup_size), so their rounding errors
+differ, e.g. by up to 1e-12 in the gps coordinates, which have 14 decimals.
+
+    resampled_view('.../VehSenseData...', 'acc', start_time, start_time + 10000)
+    smoothed_view('.../VehSenseData...', 'gps', sampling_rate=50, rolling_window_size=100, filter_type='ema')
+"""
+
+import numpy as np
+
+import file_process
+import resample
+import smoothing
+import writer
+
+debug = False
+
+
+def trip_time_range(path):
+    """
+    The start and end time of the data of all sensors of the given trip, see file_process.get_start_end_time.
+    """
+    bounds = file_process.get_time_bounds(path).values()
+    if not bounds:
+        raise ValueError("view: no data under %s" % path)
+    return max(start for start, _ in bounds), min(end for _, end in bounds)
+
+
+def grid_rows(path, start_time=None, end_time=None, sampling_rate=200):
+    """
+    The rows of the time grid of the given trip within [start_time, end_time].
+
+    Parameters
+    ----------
+    path : str
+        The folder of the trip
+
+    start_time, end_time : int, default=None
+        System timestamps (ms). Default is from the start or till the end of the trip.
+
+    sampling_rate : int, default=200
+        The rate of the time grid, Hz
+
+    Returns
+    -------
+    trip_start, trip_end : int
+        The time range of the whole grid, see trip_time_range.
+
+    begin, end : int
+        The rows within the given range are from begin to end (not included).
+    """
+    trip_start, trip_end = trip_time_range(path)
+    num = resample.num_resamples(trip_start, trip_end, sampling_rate)
+    begin = 0 if start_time is None else resample.grid_searchsorted(trip_start, trip_end, num, start_time, 'left')
+    end = num if end_time is None else resample.grid_searchsorted(trip_start, trip_end, num, end_time, 'right')
+    if begin >= end:
+        raise ValueError("view: no time point of %d Hz within [%s, %s] of %s"
+                         % (sampling_rate, start_time, end_time, path))
+    return trip_start, trip_end, begin, end
+
+
+def resampled_view(path, sensor, start_time=None, end_time=None, sampling_rate=200):
+    """
+    The resampled data of a sensor of the trip within the given time range, i.e. the rows of
+    'resampled_[sensor]' within that range.
+
+    Parameters
+    ----------
+    path : str
+        The folder of the trip
+
+    sensor : str
+        One of ['acc', 'gyro', 'mag', 'rot', 'grav', 'gps', 'obd']
+
+    start_time, end_time, sampling_rate :
+        See grid_rows.
+
+    Returns
+    -------
+    table : numpy structured array
+        The same columns and values as the file, e.g. as saved in the 'npy' format.
+    """
+    trip_start, trip_end, begin, end = grid_rows(path, start_time, end_time, sampling_rate)
+    if debug:
+        print("view: resampled %s of %s, rows %d to %d" % (sensor, path, begin, end))
+    resampled = file_process.resample_sensor(sensor, path, trip_start, trip_end, sampling_rate, rows=(begin, end))
+    return writer.to_table(resampled.columns, resampled.take(resampled.num_rows), resampled.formats)
+
+
+def smoothed_view(path, sensor, start_time=None, end_time=None, sampling_rate=200, rolling_window_size=50,
+                  filter_type='mean'):
+    """
+    The smoothed data of a sensor of the trip within the given time range, i.e. the rows of
+    'smoothed_[sensor]' within that range.
+
+    Parameters
+    ----------
+    path, sensor, start_time, end_time, sampling_rate :
+        See resampled_view.
+
+    rolling_window_size : int, default=50
+        The sliding window size in data smoothing
+
+    filter_type : str, default='mean'
+        The filter to smooth the data, see smoothing.FILTERS
+
+    Returns
+    -------
+    table : numpy structured array
+        The same columns and values as the file, e.g. as saved in the 'npy' format.
+    """
+    trip_start, trip_end, begin, end = grid_rows(path, start_time, end_time, sampling_rate)
+    # the filter goes through the rows before the range first
+    warmup_begin = max(begin - smoothing.warmup_size(filter_type, rolling_window_size), 0)
+    if debug:
+        print("view: smoothed %s of %s, rows %d to %d, from %d" % (sensor, path, begin, end, warmup_begin))
+    resampled = file_process.resample_sensor(sensor, path, trip_start, trip_end, sampling_rate,
+                                             rows=(warmup_begin, end))
+    smooth = file_process.sensor_smoother(resampled, rolling_window_size, sampling_rate, filter_type)
+    chunks = [smooth(data) for data in resampled.chunks]
+    data = [np.concatenate(cols)[begin - warmup_begin:] for cols in zip(*chunks)]
+    return writer.to_table(resampled.columns, data, resampled.formats)
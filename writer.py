@@ -0,0 +1,565 @@
+"""
+Writers of the resampled and smoothed data files.
+
+Each column of a table is written either as int, i.e. truncated as astype(int) does, or as a
+float with a fixed number of decimals, e.g. '{:.6f}'.format(x), or as str. The CSV writer
+formats whole columns at once, with exactly the same text as the python format would give.
+Tables can be written chunk by chunk (see open_table), so that long trips never need to be
+in memory at once.
+
+The binary formats keep the same values as the CSV file, i.e. ints and rounded floats:
+    csv     : text file, e.g. 'resampled_acc.txt'
+    npy     : numpy structured array, e.g. 'resampled_acc.npy'
+    feather : 'resampled_acc.feather', requires pyarrow
+    parquet : 'resampled_acc.parquet', requires pyarrow
+"""
+
+import abc
+import os
+
+import numpy as np
+import pandas as pd
+
+debug = False
+
+# column formats
+INT = 'int'
+STR = 'str'
+
+# the largest integer that float64 represents exactly
+MAX_EXACT_INT = 2 ** 53
+
+
+# rows formatted at a time by the CSV writer, which bounds its memory
+CHUNK_SIZE = 65536
+
+COMMA = ord(',')
+NEWLINE = ord('\n')
+
+
+def round_column(values, fmt):
+    """
+    Round a column to the values that are written to files.
+
+    Parameters
+    ----------
+    values : 1-D array
+
+    fmt : INT, STR, or int
+        The format of the column, i.e. int, str or the number of decimals of float.
+
+    Returns
+    -------
+    column : 1-D array of int64, str or float64
+        For floats, the same as float('{:.nf}'.format(x)) of each value.
+    """
+    if fmt == INT:
+        return np.asarray(values).astype(np.int64)
+    if fmt == STR:
+        return np.asarray(values).astype(str)
+    return fixed_chars(values, fmt, with_text=False)[2]
+
+
+def column_chars(values, fmt):
+    """
+    Format a column as text, see round_column.
+
+    Returns
+    -------
+    chars : 2-D array of uint8, shape=(len(values), width)
+        ASCII characters of each value, right aligned
+
+    valid : 2-D array of boolean, the same shape as chars
+        False for the padding on the left of each value.
+    """
+    if fmt == INT:
+        return int_chars(np.asarray(values).astype(np.int64))
+    if fmt == STR:
+        text = np.asarray(values).astype('S')
+        chars = text.view(np.uint8).reshape(len(text), -1)
+        # left aligned, which does not matter since the padding is dropped anyway
+        return chars, chars != 0
+    chars, valid, _ = fixed_chars(values, fmt)
+    return chars, valid
+
+
+def digit_chars(numbers, width):
+    """
+    The decimal digits of non-negative integers, right aligned with leading zeros.
+
+    Returns
+    -------
+    chars : 2-D array of uint8, shape=(len(numbers), width)
+
+    num_digits : 1-D array of int
+        The number of digits of each number without leading zeros, at least 1.
+    """
+    chars = np.empty((len(numbers), width), dtype=np.uint8)
+    num_digits = np.ones(len(numbers), dtype=np.int64)
+    rest = numbers.copy()
+    for k in range(width - 1, -1, -1):
+        chars[:, k] = rest % 10 + ord('0')
+        rest //= 10
+    power = 10
+    for _ in range(1, width):
+        num_digits += numbers >= power
+        power *= 10
+    return chars, num_digits
+
+
+def max_digits(numbers):
+    """
+    The number of digits of the largest of the given non-negative integers.
+    """
+    return len(str(int(numbers.max()))) if len(numbers) else 1
+
+
+def int_chars(numbers):
+    """
+    Format int64 numbers as text, see column_chars.
+    """
+    negative = numbers < 0
+    numbers = np.abs(numbers)
+    width = max_digits(numbers)
+    digits, num_digits = digit_chars(numbers, width)
+
+    chars = np.empty((len(numbers), width + 1), dtype=np.uint8)
+    chars[:, 0] = ord('-')
+    chars[:, 1:] = digits
+    valid = np.empty(chars.shape, dtype=bool)
+    valid[:, 0] = negative
+    valid[:, 1:] = np.arange(width) >= (width - num_digits)[:, np.newaxis]
+    return chars, valid
+
+
+def exact_product(a, b):
+    """
+    The product of floats as the rounded product and its rounding error, i.e. a * b = product + error
+    exactly (Dekker's algorithm), unless it overflows or underflows.
+    """
+    a_high, a_low = split(a)
+    b_high, b_low = split(b)
+    product = a * b
+    error = ((a_high * b_high - product) + a_high * b_low + a_low * b_high) + a_low * b_low
+    return product, error
+
+
+def split(a):
+    """
+    Split floats into two halves of 26 bits each, i.e. a = high + low exactly.
+    """
+    temp = a * 134217729.0  # 2 ** 27 + 1
+    high = temp - (temp - a)
+    return high, a - high
+
+
+def fixed_point(values, decimals):
+    """
+    Round floats to a fixed number of decimals, the same as '{:.nf}'.format(x) of each value.
+
+    The values are scaled by 10^decimals exactly, i.e. as the rounded product plus its error,
+    and rounded to the nearest integers, which gives the same digits as the python format.
+    Only ties, values too large to be exact and those not finite are formatted by python.
+
+    Returns
+    -------
+    quotient : 1-D array of int64
+        The absolute values in units of the last decimal, except for the slow ones.
+
+    slow_index : 1-D array of int
+        The positions of the values formatted by python
+
+    slow_text : list[bytes]
+        Their text
+    """
+    values = np.asarray(values, dtype=np.float64)
+    with np.errstate(invalid='ignore', over='ignore'):
+        scaled, error = exact_product(np.abs(values), float(10 ** decimals))
+        floor = np.floor(scaled)
+        # scaled + error = floor + fraction, where -0.5 <= fraction < 1.5
+        fraction = (scaled - floor) + error
+        slow = ~np.isfinite(scaled) | (scaled >= MAX_EXACT_INT) | (fraction == 0.5) | (fraction == -0.5)
+
+    quotient = np.where(slow, 0.0, floor).astype(np.int64) + (fraction > 0.5)
+    slow_index = np.flatnonzero(slow)
+    fmt = '{:.%df}' % decimals
+    slow_text = [fmt.format(values[i]).encode() for i in slow_index]
+    return quotient, slow_index, slow_text
+
+
+def fixed_units(values, decimals):
+    """
+    The values rounded to a fixed number of decimals (see fixed_point), as integers in units
+    of the last decimal, e.g. 1.25 => 125 with 2 decimals.
+
+    Returns
+    -------
+    units : 1-D array of int64
+
+    valid : 1-D array of boolean
+        False for the values that are not finite, or too large for int64.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    units, slow_index, slow_text = fixed_point(values, decimals)
+    units = np.where(np.signbit(values), -units, units)
+    valid = np.ones(len(units), dtype=bool)
+    for i, text in zip(slow_index, slow_text):
+        try:
+            unit = int(text.replace(b'.', b''))
+        except ValueError:
+            unit = None  # nan or inf
+        if unit is None or abs(unit) >= 2 ** 63:
+            units[i] = 0
+            valid[i] = False
+        else:
+            units[i] = unit
+    return units, valid
+
+
+def fixed_chars(values, decimals, with_text=True):
+    """
+    Format floats with a fixed number of decimals, see fixed_point.
+
+    Parameters
+    ----------
+    values : 1-D array of float
+
+    decimals : int
+
+    with_text : boolean, default=True
+        If False, only the rounded values are returned.
+
+    Returns
+    -------
+    chars, valid : 2-D arrays, see column_chars.
+        None if not with_text.
+
+    rounded : 1-D array of float64
+        The values of the text, i.e. float(text) of each value.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    scale = 10 ** decimals
+    quotient, slow_index, slow_text = fixed_point(values, decimals)
+    rounded = np.copysign(quotient / scale, values)
+    for i, text in zip(slow_index, slow_text):
+        rounded[i] = float(text)
+    if not with_text:
+        return None, None, rounded
+
+    # sign, integer part, and '.' followed by the decimals if any
+    int_part, decimal_part = np.divmod(quotient, scale)
+    int_width = max_digits(int_part)
+    int_digits, num_digits = digit_chars(int_part, int_width)
+    width = 1 + int_width + (1 + decimals if decimals else 0)
+    width = max([width] + [len(text) for text in slow_text])
+    begin = width - (1 + int_width + (1 + decimals if decimals else 0))
+
+    chars = np.zeros((len(values), width), dtype=np.uint8)
+    valid = np.zeros(chars.shape, dtype=bool)
+    chars[:, begin] = ord('-')
+    valid[:, begin] = np.signbit(values)
+    chars[:, begin + 1: begin + 1 + int_width] = int_digits
+    valid[:, begin + 1: begin + 1 + int_width] = np.arange(int_width) >= (int_width - num_digits)[:, np.newaxis]
+    if decimals:
+        chars[:, width - decimals - 1] = ord('.')
+        chars[:, width - decimals:] = digit_chars(decimal_part, decimals)[0]
+        valid[:, width - decimals - 1:] = True
+
+    for i, text in zip(slow_index, slow_text):
+        chars[i, width - len(text):] = np.frombuffer(text, dtype=np.uint8)
+        valid[i, :width - len(text)] = False
+        valid[i, width - len(text):] = True
+    return chars, valid, rounded
+
+
+def format_lines(data, formats):
+    """
+    Format rows of the given columns as CSV lines.
+
+    Each column is formatted as right aligned characters, and the padding is dropped from
+    all lines at once.
+
+    Returns
+    -------
+    lines : bytes
+    """
+    num_rows = len(data[0])
+    separator = np.full((num_rows, 1), COMMA, dtype=np.uint8)
+    all_valid = np.ones((num_rows, 1), dtype=bool)
+
+    chars = []
+    valid = []
+    for col, fmt in zip(data, formats):
+        col_chars, col_valid = column_chars(col, fmt)
+        chars += [col_chars, separator]
+        valid += [col_valid, all_valid]
+    chars[-1] = np.full((num_rows, 1), NEWLINE, dtype=np.uint8)
+
+    chars = np.hstack(chars)
+    return chars[np.hstack(valid)].tobytes()
+
+
+def to_table(columns, data, formats):
+    """
+    Build a structured array of the rounded columns, see round_column.
+    """
+    cols = [round_column(col, fmt) for col, fmt in zip(data, formats)]
+    table = np.empty(len(cols[0]) if cols else 0, dtype=[(name, col.dtype) for name, col in zip(columns, cols)])
+    for name, col in zip(columns, cols):
+        table[name] = col
+    return table
+
+
+class TableWriter(abc.ABC):
+    """
+    Write a table chunk by chunk, so that the whole table never needs to be in memory.
+
+    Use it as a context manager, or call close() when all chunks have been written.
+    """
+
+    def __init__(self, filename, columns, formats, num_rows=None):
+        """
+        Parameters
+        ----------
+        filename : str
+
+        columns : list[str]
+            The names of the columns
+
+        formats : list
+            The format of each column, i.e. INT, STR or the number of decimals of float.
+
+        num_rows : int, default=None
+            The total number of rows, if known in advance.
+        """
+        self.filename = filename
+        self.columns = columns
+        self.formats = formats
+        self.num_rows = num_rows
+        self.rows_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data):
+        """
+        Write the next rows of the table.
+
+        Parameters
+        ----------
+        data : list[1-D array]
+            The rows of each column
+        """
+        self.write_chunk([np.asarray(col) for col in data])
+        self.rows_written += len(data[0]) if data else 0
+
+    @abc.abstractmethod
+    def write_chunk(self, data):
+        """
+        Write the next rows of the table to the file, see write.
+        """
+
+    def close(self):
+        pass
+
+    def empty_table(self):
+        return to_table(self.columns, [np.empty(0)] * len(self.columns), self.formats)
+
+
+class CsvWriter(TableWriter):
+    """
+    Write the table as CSV, in the same layout as DataFrame.to_csv(index=False).
+    """
+
+    def __init__(self, filename, columns, formats, num_rows=None):
+        super(CsvWriter, self).__init__(filename, columns, formats, num_rows)
+        self.fp = open(filename, 'wb')
+        self.fp.write((','.join(columns) + '\n').encode())
+
+    def write_chunk(self, data):
+        for begin in range(0, len(data[0]) if data else 0, CHUNK_SIZE):
+            self.fp.write(format_lines([col[begin: begin + CHUNK_SIZE] for col in data], self.formats))
+
+    def close(self):
+        self.fp.close()
+
+
+class NpyWriter(TableWriter):
+    """
+    Write the table as a numpy structured array, see to_table.
+
+    If the number of rows is known, the file is memory-mapped and filled in chunk by chunk.
+    Otherwise, the chunks are kept in memory and saved at last.
+    """
+
+    def __init__(self, filename, columns, formats, num_rows=None):
+        super(NpyWriter, self).__init__(filename, columns, formats, num_rows)
+        self.table = None
+        self.chunks = []
+
+    def write_chunk(self, data):
+        chunk = to_table(self.columns, data, self.formats)
+        if len(chunk) == 0:
+            return
+        if self.num_rows is None:
+            self.chunks.append(chunk)
+            return
+        if self.table is None:
+            self.table = np.lib.format.open_memmap(self.filename, mode='w+', dtype=chunk.dtype,
+                                                   shape=(self.num_rows,))
+        self.table[self.rows_written: self.rows_written + len(chunk)] = chunk
+
+    def close(self):
+        if self.table is not None:
+            self.table.flush()
+            self.table = None
+        elif self.chunks:
+            np.save(self.filename, np.concatenate(self.chunks), allow_pickle=False)
+        else:
+            np.save(self.filename, self.empty_table(), allow_pickle=False)
+        self.chunks = []
+
+
+class ArrowWriter(TableWriter):
+    """
+    Write the table through pyarrow, one record batch per chunk.
+    """
+
+    def __init__(self, filename, columns, formats, num_rows=None):
+        super(ArrowWriter, self).__init__(filename, columns, formats, num_rows)
+        self.writer = None
+
+    @abc.abstractmethod
+    def open(self, schema):
+        """
+        Open the file to be written with the schema of the first chunk.
+
+        Returns
+        -------
+        writer : object with write_table(table) and close(), e.g. pyarrow.ipc.RecordBatchFileWriter
+        """
+
+    def write_table(self, table):
+        import pyarrow
+
+        table = pyarrow.Table.from_pandas(pd.DataFrame(table), preserve_index=False)
+        if self.writer is None:
+            self.writer = self.open(table.schema)
+        self.writer.write_table(table)
+
+    def write_chunk(self, data):
+        self.write_table(to_table(self.columns, data, self.formats))
+
+    def close(self):
+        if self.writer is None:
+            self.write_table(self.empty_table())
+        self.writer.close()
+
+
+class FeatherWriter(ArrowWriter):
+    """
+    Write the table as a feather (version 2) file, i.e. the Arrow IPC file format.
+    """
+
+    def open(self, schema):
+        import pyarrow
+
+        return pyarrow.ipc.new_file(self.filename, schema)
+
+
+class ParquetWriter(ArrowWriter):
+    """
+    Write the table as a parquet file.
+    """
+
+    def open(self, schema):
+        import pyarrow.parquet
+
+        return pyarrow.parquet.ParquetWriter(self.filename, schema)
+
+
+# format: (extension, writer, required module)
+WRITERS = {'csv': ('.txt', CsvWriter, None),
+           'npy': ('.npy', NpyWriter, None),
+           'feather': ('.feather', FeatherWriter, 'pyarrow'),
+           'parquet': ('.parquet', ParquetWriter, 'pyarrow')}
+
+
+def is_available(output_format):
+    """
+    Check if the given output format is known and its required module is installed.
+    """
+    if output_format not in WRITERS:
+        return False
+    module = WRITERS[output_format][2]
+    if module is None:
+        return True
+    try:
+        __import__(module)
+        return True
+    except ImportError:
+        return False
+
+
+def output_file(path, name, output_format='csv'):
+    """
+    The path of the output file, e.g. output_file(path, 'resampled_acc', 'npy') => path/resampled_acc.npy
+    """
+    return os.path.join(path, name + WRITERS[output_format][0])
+
+
+def open_table(path, name, columns, formats, output_format='csv', num_rows=None):
+    """
+    Open a table to be written chunk by chunk in the given format, see TableWriter.
+
+    Parameters
+    ----------
+    path : str
+        The folder to write to
+
+    name : str
+        The name of the file without extension, e.g. 'resampled_acc'
+
+    columns : list[str]
+        The names of the columns
+
+    formats : list
+        The format of each column, i.e. INT, STR or the number of decimals of float.
+
+    output_format : str, default='csv'
+        One of WRITERS
+
+    num_rows : int, default=None
+        The total number of rows, if known in advance.
+
+    Returns
+    -------
+    table_writer : TableWriter
+    """
+    filename = output_file(path, name, output_format)
+    if debug:
+        print("write %s" % filename)
+    return WRITERS[output_format][1](filename, columns, formats, num_rows)
+
+
+def write_table(path, name, columns, data, formats, output_format='csv'):
+    """
+    Write a table in the given format at once, see open_table.
+
+    Parameters
+    ----------
+    data : list[1-D array]
+        The columns
+
+    Returns
+    -------
+    filename : str
+        The file written
+    """
+    num_rows = len(data[0]) if data else 0
+    with open_table(path, name, columns, formats, output_format, num_rows) as table_writer:
+        table_writer.write(data)
+    return table_writer.filename